@@ -0,0 +1,244 @@
+# GhithuWebApp/backend/aggregation.py
+"""
+Tổng hợp kỳ nợ theo từng nhóm (khách hàng) bằng NumPy, thay cho groupby-apply với lambda nối chuỗi.
+
+Kỳ được mã hoá thành số nguyên có cùng thứ tự với chuỗi 'MM/YYYY', dữ liệu được sắp xếp một lần, rồi các kỳ
+khác nhau của mọi nhóm được nối trong một lượt duy nhất; kết quả y hệt ','.join(sorted(x.unique())) của từng nhóm.
+"""
+import itertools
+import logging
+
+import numpy as np
+import pandas as pd
+
+_GROUP_END = '\x00'  # Ký tự ngăn cách giữa các nhóm khi nối một lượt (không xuất hiện trong chuỗi kỳ)
+VALID_YEARS = (2000, 2099)  # Năm hoá đơn hợp lệ; dòng ngoài khoảng này không được tính vào các kỳ nợ
+_MASK_BITS = 64  # Khoảng tháng vừa một số uint64 thì lưu bitmask, rộng hơn thì lưu danh sách tháng của từng danh bạ
+
+
+def period_labels(ky, nam):
+    """
+    Mã hoá kỳ của từng dòng: trả về (codes, labels) với labels là các chuỗi kỳ khác nhau đã sắp xếp
+    và labels[codes] đúng bằng KY.astype(str).str.zfill(2) + '/' + NAM.astype(str).
+    Chỉ dựng chuỗi cho từng cặp (KY, NAM) khác nhau, không dựng cho từng dòng.
+    """
+    ky_codes, ky_values = pd.factorize(pd.Series(ky), use_na_sentinel=False)
+    nam_codes, nam_values = pd.factorize(pd.Series(nam), use_na_sentinel=False)
+    width = max(len(nam_values), 1)
+    combos, inverse = np.unique(ky_codes.astype(np.int64) * width + nam_codes, return_inverse=True)
+    texts = np.array([str(ky_values[combo // width]).zfill(2) + '/' + str(nam_values[combo % width])
+                      for combo in combos.tolist()], dtype=object)
+    order = np.argsort(texts, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)], texts[order]
+
+
+def join_periods(group_ids, n_groups, period_codes, labels, sep=','):
+    """
+    Với mỗi nhóm 0..n_groups-1: (chuỗi các kỳ khác nhau sắp tăng nối bằng sep, số dòng, số kỳ khác nhau).
+    Dòng có group_ids < 0 (ví dụ khoá bị thiếu) được bỏ qua; nhóm không có dòng nào nhận chuỗi rỗng.
+    """
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    period_codes = np.asarray(period_codes, dtype=np.int64)
+    valid = group_ids >= 0
+    groups, codes = group_ids[valid], period_codes[valid]
+    order = np.lexsort((codes, groups))
+    groups, codes = groups[order], codes[order]
+
+    first = np.ones(len(groups), dtype=bool)
+    first[1:] = (groups[1:] != groups[:-1]) | (codes[1:] != codes[:-1])
+    unique_groups, unique_codes = groups[first], codes[first]
+    row_counts = np.bincount(groups, minlength=n_groups)
+    period_counts = np.bincount(unique_groups, minlength=n_groups)
+
+    joined = np.full(n_groups, '', dtype=object)
+    if len(unique_groups):
+        last = np.ones(len(unique_groups), dtype=bool)
+        last[:-1] = unique_groups[1:] != unique_groups[:-1]
+        separators = np.full(len(unique_groups), sep, dtype=object)  # Mảng chuỗi cố định của NumPy làm mất ký tự '\x00'
+        separators[last] = _GROUP_END
+        text = ''.join(itertools.chain.from_iterable(zip(labels[unique_codes].tolist(), separators.tolist())))
+        joined[unique_groups[last]] = np.array(text.split(_GROUP_END)[:-1], dtype=object)
+    return joined, row_counts, period_counts
+
+
+def _popcount(words):
+    """Số bit 1 của từng dòng trong mảng uint64 hai chiều."""
+    if hasattr(np, 'bitwise_count'):  # NumPy >= 2.0
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    return np.unpackbits(words.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+
+
+def month_indexes(ky, nam):
+    """
+    Chỉ số tháng NAM * 12 + KY - 1 của từng dòng (mảng float); NaN khi kỳ/năm không hợp lệ hoặc năm nằm ngoài
+    VALID_YEARS (ví dụ NAM = 0 hay 9999 nhập sai), để một dòng sai không kéo giãn khoảng tháng của cả hồ sơ.
+    """
+    ky = pd.to_numeric(pd.Series(ky), errors='coerce').to_numpy(dtype=np.float64)
+    nam = pd.to_numeric(pd.Series(nam), errors='coerce').to_numpy(dtype=np.float64)
+    valid = ((ky >= 1) & (ky <= 12) & (ky == np.floor(ky))
+             & (nam >= VALID_YEARS[0]) & (nam <= VALID_YEARS[1]) & (nam == np.floor(nam)))
+    return np.where(valid, nam * 12 + ky - 1, np.nan)
+
+
+class DebtProfile:
+    """
+    Hồ sơ nợ theo danh bạ (thường là khoá số keys.CUSTOMER_KEY), lưu dạng mảng: các kỳ chưa trả là bitmask uint64
+    của từng danh bạ trên chỉ số tháng NAM * 12 + KY - 1 tính từ tháng sớm nhất, kèm tổng tiền và số hoá đơn.
+    Khi các kỳ trải dài hơn 64 tháng, các kỳ được lưu thành danh sách tháng đã sắp của từng danh bạ (cell_offsets,
+    cell_months) thay cho bitmask. Các câu hỏi (nợ >= N kỳ, chỉ nợ kỳ mới nhất, có nợ kỳ X) là phép toán trên mảng;
+    chuỗi 'MM/YYYY,...' chỉ được dựng khi hiển thị (render), giống hệt ','.join(sorted(các kỳ)).
+    """
+
+    def __init__(self, keys, masks, totals, invoice_counts, base_month, latest_month=None,
+                 cell_offsets=None, cell_months=None):
+        self.keys = keys
+        self.masks = masks
+        self.cell_offsets = cell_offsets
+        self.cell_months = cell_months
+        self.totals = totals
+        self.invoice_counts = invoice_counts
+        self.period_counts = _popcount(masks) if masks is not None else np.diff(cell_offsets)
+        self.base_month = base_month
+        self.latest_month = latest_month
+        self._index = pd.Index(keys)
+
+    @classmethod
+    def from_invoices(cls, danhba, ky, nam, tongcong=None, latest_month=None):
+        """
+        Dựng từ các dòng hoá đơn (danh bạ, kỳ, năm, số tiền). Danh bạ được sắp tăng; dòng thiếu danh bạ bị bỏ qua,
+        dòng có kỳ/năm không hợp lệ (xem month_indexes) vẫn được tính vào số hoá đơn và tổng tiền nhưng không vào
+        các kỳ nợ, và được ghi vào log.
+        """
+        codes, keys = pd.factorize(pd.Series(danhba), sort=True)
+        all_months = month_indexes(ky, nam)
+        valid = codes >= 0
+        month_valid = valid & ~np.isnan(all_months)
+        bad_rows = np.flatnonzero(valid & ~month_valid)
+        if len(bad_rows):
+            samples = ', '.join(f'{keys[codes[row]]} (kỳ {pd.Series(ky).iloc[row]}, năm {pd.Series(nam).iloc[row]})'
+                                for row in bad_rows[:5])
+            logging.warning(f"Hồ sơ nợ: bỏ qua kỳ của {len(bad_rows)} hoá đơn có kỳ/năm không hợp lệ "
+                            f"(năm hợp lệ {VALID_YEARS[0]}-{VALID_YEARS[1]}), ví dụ: {samples}.")
+        months = all_months[month_valid].astype(np.int64)
+        base_month = int(months.min()) if len(months) else 0
+        cells = np.unique(np.stack([codes[month_valid].astype(np.int64), months - base_month]), axis=1)
+
+        masks = cell_offsets = cell_months = None
+        if len(months) == 0 or int(months.max()) - base_month < _MASK_BITS:
+            masks = np.zeros((len(keys), 1), dtype=np.uint64)
+            np.bitwise_or.at(masks, (cells[0], np.zeros(cells.shape[1], dtype=np.int64)),
+                             np.left_shift(np.uint64(1), cells[1].astype(np.uint64)))
+        else:
+            cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(cells[0], minlength=len(keys)))])
+            cell_months = cells[1] + base_month
+        invoice_counts = np.bincount(codes[valid], minlength=len(keys))
+        weights = None
+        if tongcong is not None:
+            weights = pd.to_numeric(pd.Series(tongcong), errors='coerce').fillna(0).to_numpy(dtype=np.float64)[valid]
+        totals = np.bincount(codes[valid], weights=weights, minlength=len(keys)).astype(np.float64)
+        return cls(np.asarray(keys), masks, totals, invoice_counts, base_month, latest_month, cell_offsets, cell_months)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def month_of(year, month):
+        return int(year) * 12 + int(month) - 1
+
+    @staticmethod
+    def period_label(month_index):
+        return f'{month_index % 12 + 1:02d}/{month_index // 12}'
+
+    @property
+    def latest_period_str(self):
+        return None if self.latest_month is None else self.period_label(self.latest_month)
+
+    def lookup(self, danhba):
+        """Vị trí của từng danh bạ trong hồ sơ, -1 nếu danh bạ không còn nợ."""
+        return self._index.get_indexer(pd.Series(danhba).to_numpy())
+
+    def _rows(self, positions):
+        positions = np.arange(len(self)) if positions is None else np.asarray(positions, dtype=np.int64)
+        return positions, positions >= 0
+
+    def _cells_of(self, positions):
+        """(thứ tự dòng trong positions, tháng) của mọi kỳ nợ của các vị trí đã cho (dạng danh sách tháng)."""
+        counts = self.period_counts[positions]
+        row_ids = np.repeat(np.arange(len(positions)), counts)
+        starts = np.repeat(self.cell_offsets[positions] - (np.cumsum(counts) - counts), counts)
+        return row_ids, self.cell_months[starts + np.arange(len(row_ids))]
+
+    def _bit_test(self, positions, month_index, exact):
+        positions, found = self._rows(positions)
+        result = np.zeros(len(positions), dtype=bool)
+        if month_index is None:
+            return result
+        if self.masks is None:
+            row_ids, months = self._cells_of(positions[found])
+            hit = np.zeros(int(found.sum()), dtype=bool)
+            hit[row_ids[months == month_index]] = True
+        else:
+            offset = month_index - self.base_month
+            if offset < 0 or offset >= self.masks.shape[1] * 64:
+                return result
+            rows = self.masks[positions[found]]
+            bit = np.uint64(1) << np.uint64(offset % 64)
+            hit = (rows[:, offset // 64] & bit) != 0
+        if exact:
+            hit &= self.period_counts[positions[found]] == 1
+        result[found] = hit
+        return result
+
+    def has_debt(self, positions=None):
+        positions, found = self._rows(positions)
+        result = np.zeros(len(positions), dtype=bool)
+        result[found] = self.period_counts[positions[found]] > 0
+        return result
+
+    def invoice_count(self, positions=None):
+        """Số hoá đơn nợ của từng vị trí, 0 cho vị trí -1."""
+        positions, found = self._rows(positions)
+        result = np.zeros(len(positions), dtype=np.int64)
+        result[found] = self.invoice_counts[positions[found]]
+        return result
+
+    def at_least(self, n_periods, positions=None):
+        """Nợ từ n_periods kỳ khác nhau trở lên."""
+        positions, found = self._rows(positions)
+        result = np.zeros(len(positions), dtype=bool)
+        result[found] = self.period_counts[positions[found]] >= n_periods
+        return result
+
+    def owes_in(self, year, month, positions=None):
+        """Có nợ kỳ (year, month)."""
+        return self._bit_test(positions, self.month_of(year, month), exact=False)
+
+    def only_period(self, year, month, positions=None):
+        """Chỉ còn nợ đúng kỳ (year, month)."""
+        return self._bit_test(positions, self.month_of(year, month), exact=True)
+
+    def only_latest(self, positions=None):
+        """Chỉ còn nợ đúng kỳ mới nhất (latest_month); toàn False nếu không biết kỳ mới nhất."""
+        return self._bit_test(positions, self.latest_month, exact=True)
+
+    def render(self, positions=None, sep=','):
+        """Chuỗi các kỳ nợ 'MM/YYYY' (sắp theo chuỗi, nối bằng sep) của các vị trí đã cho; '' cho vị trí -1."""
+        positions, found = self._rows(positions)
+        if self.masks is None:
+            row_ids, months = self._cells_of(positions[found])
+            offsets, inverse = np.unique(months - self.base_month, return_inverse=True)
+        else:
+            rows = self.masks[positions[found]]
+            offsets = np.arange(self.masks.shape[1] * 64)
+            bits = np.unpackbits(rows.astype('<u8').view(np.uint8), axis=1, bitorder='little').astype(bool)
+            row_ids, inverse = np.nonzero(bits)
+        labels = np.array([self.period_label(self.base_month + int(offset)) for offset in offsets], dtype=object)
+        order = np.argsort(labels, kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        joined = join_periods(row_ids, int(found.sum()), rank[inverse.reshape(-1)], labels[order], sep=sep)[0]
+        result = np.full(len(positions), '', dtype=object)
+        result[found] = joined
+        return result
@@ -4,6 +4,9 @@ import logging
 from datetime import date, datetime
 import sys
 import os
+import threading
+import time
+from collections import OrderedDict
 import streamlit as st  # <<< THÊM DÒNG NÀY VÀO
 
 from backend.data_sources import fetch_dataframe
@@ -12,6 +15,10 @@ from backend.data_sources import fetch_dataframe
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import config
 from backend import data_sources
+from backend import sheet_mirror
+from backend import aggregation
+from backend import keys
+from backend.query_graph import QueryGraph
 from functools import reduce # <<< Thêm import này ở đầu file backend/analysis_logic.py
 
 
@@ -44,31 +51,23 @@ def fetch_dashboard_data():
     # (Hàm này được giữ lại từ phiên bản gốc của bạn)
     try:
         logging.info("Bắt đầu lấy dữ liệu cho Dashboard...")
-        sql_hoadon = f"SELECT DANHBA, TONGCONG, NAM, KY, SOHOADON FROM {config.TABLE_SOURCE} WHERE NGAYGIAI IS NULL"
-        dtypes_hoadon = {'DANHBA': str, 'SOHOADON': str}
-        df_hoadon = data_sources.fetch_dataframe('f_Select_SQL_Thutien', sql_hoadon, dtypes=dtypes_hoadon)
-        sql_kh = "SELECT DanhBa, GB FROM KhachHang"
-        dtypes_kh = {'DanhBa': str, 'GB': str}
-        df_kh = data_sources.fetch_dataframe('f_Select_SQL_Doc_so', sql_kh, dtypes=dtypes_kh)
-        if not df_hoadon.empty and not df_kh.empty:
-            df_kh = df_kh.rename(columns={'DanhBa': 'DANHBA'})
-            df_kh['DANHBA'] = df_kh['DANHBA'].str.zfill(11)
-            df_hoadon['DANHBA'] = df_hoadon['DANHBA'].str.zfill(11)
-            df_merged = pd.merge(df_hoadon, df_kh, on='DANHBA', how='left')
+        # Hoá đơn chưa giải, đã bỏ các hoá đơn thanh toán qua BGW_HD, từ ảnh chụp dùng chung
+        # (danh bạ dùng khoá số keys.CUSTOMER_KEY, không cần chuẩn hoá chuỗi); bảng khách hàng được nạp song song
+        graph = QueryGraph('dashboard')
+        graph.add('hoadon', lambda: data_sources.get_unpaid_invoices([keys.CUSTOMER_KEY, 'TONGCONG', 'NAM', 'KY']))
+        graph.add('khachhang', data_sources.load_customer_dimension)
+        df_hoadon = graph.run()['hoadon']
+        if not df_hoadon.empty:
+            # Nhóm giá (GB) tra từ bảng khách hàng dùng chung (data_sources.get_customer_attributes)
+            df_merged = df_hoadon.join(data_sources.get_customer_attributes(df_hoadon[keys.CUSTOMER_KEY], ['GB']))
         else:
             df_merged = df_hoadon
         if df_merged.empty: return {}
-        sohoadon_list = df_merged['SOHOADON'].dropna().unique().tolist()
-        if sohoadon_list:
-            df_bgw = data_sources._get_bgw_invoices(sohoadon_list)
-            if not df_bgw.empty:
-                shdon_to_exclude = df_bgw['SHDon'].astype(str).str.strip().unique()
-                df_merged = df_merged[~df_merged['SOHOADON'].astype(str).str.strip().isin(shdon_to_exclude)]
-        if df_merged.empty: return {}
         df_merged['TONGCONG'] = pd.to_numeric(df_merged['TONGCONG'], errors='coerce').fillna(0)
         total_debt = df_merged['TONGCONG'].sum()
-        total_debtors = df_merged['DANHBA'].nunique()
-        debtor_counts = df_merged.groupby('DANHBA').size()
+        customer_keys = df_merged.loc[df_merged[keys.CUSTOMER_KEY] != keys.MISSING_KEY, keys.CUSTOMER_KEY]
+        total_debtors = customer_keys.nunique()
+        debtor_counts = customer_keys.value_counts()
         debtors_over_3_periods = (debtor_counts >= 3).sum()
         debt_by_gb = df_merged.groupby('GB')['TONGCONG'].sum().sort_values(ascending=False).head(10)
         df_merged['KY_NAM_DT'] = pd.to_datetime(df_merged['NAM'].astype(str) + '-' + df_merged['KY'].astype(str).str.zfill(2) + '-01', errors='coerce')
@@ -84,27 +83,9 @@ def fetch_dashboard_data():
 # LOGIC CHO TAB 2: BÁO CÁO TUẦN (Google Sheet)
 # ==============================================================================
 # (Các hàm này được giữ lại từ phiên bản gốc của bạn)
-def _report_prepare_initial_data():
-    db_df, on_off_df = data_sources.get_sheet_data_for_report()
-    if config.DB_COL_KY_NAM in db_df.columns:
-        db_df[config.DB_COL_DANH_BO] = db_df[config.DB_COL_DANH_BO].astype(str).str.strip().str.zfill(11)
-        db_df[config.DB_COL_KY_NAM] = db_df[config.DB_COL_KY_NAM].astype(str).str.split(',')
-        db_df = db_df.explode(config.DB_COL_KY_NAM).reset_index(drop=True)
-        db_df[config.DB_COL_KY_NAM] = db_df[config.DB_COL_KY_NAM].str.strip()
-        split_ky_nam = db_df[config.DB_COL_KY_NAM].str.split('/', expand=True)
-        if not split_ky_nam.empty:
-            db_df['ky'] = split_ky_nam[0].str.strip().str.zfill(2)
-            db_df['nam'] = split_ky_nam[1].str.strip()
-    for df, col in [(db_df, config.DB_COL_NGAY_GIAO), (on_off_df, config.ON_OFF_COL_NGAY_KHOA),
-                    (on_off_df, config.ON_OFF_COL_NGAY_MO)]:
-        if col in df.columns:
-            clean_col = df[col].astype(str).str.strip()
-            df[f'{col}_chuan_hoa'] = pd.to_datetime(clean_col, format=config.DATE_FORMAT_1, errors='coerce').fillna(
-                pd.to_datetime(clean_col, format=config.DATE_FORMAT_2, errors='coerce'))
-    for col, df in [(config.DB_COL_ID, db_df), (config.ON_OFF_COL_ID, on_off_df), (config.DB_COL_NHOM, db_df),
-                    (config.ON_OFF_COL_NHOM_KHOA, on_off_df)]:
-        if col in df.columns: df[col] = df[col].astype(str).str.strip()
-    return db_df, on_off_df
+def _report_prepare_initial_data(start_date=None, end_date=None):
+    # Đọc từ bản sao cục bộ đã chuẩn hoá sẵn (backend/sheet_mirror.py), chỉ lấy các dòng giao trong khoảng ngày
+    return sheet_mirror.load_report_data(start_date, end_date)
 
 def _report_enrich_data(df):
     hoadon_details_df = pd.DataFrame()
@@ -114,7 +95,8 @@ def _report_enrich_data(df):
         sql_details = (f"SELECT {config.API_COL_DANHBA}, {config.API_COL_KY}, {config.API_COL_NAM}, "
                        f"{config.API_COL_SOHOADON}, {config.API_COL_NGAYGIAI} "
                        f"FROM HoaDon WHERE {config.API_COL_DANHBA} IN ('{formatted_danhba_list}')")
-        dtypes = {config.API_COL_DANHBA: str, config.API_COL_KY: str, config.API_COL_NAM: str}
+        dtypes = {config.API_COL_DANHBA: str, config.API_COL_KY: str, config.API_COL_NAM: str,
+                  config.API_COL_SOHOADON: str}
         hoadon_details_df = data_sources.fetch_dataframe('f_Select_SQL_Thutien', sql_details, dtypes=dtypes)
     if not hoadon_details_df.empty:
         hoadon_details_df = hoadon_details_df.rename(columns={'KY': 'ky', 'NAM': 'nam', config.API_COL_DANHBA: config.DB_COL_DANH_BO})
@@ -132,7 +114,7 @@ def _report_enrich_data(df):
                 df = df.rename(columns={'NgayThanhToan_BGW': 'NgayThanhToan_BGW_DT'})
     return df
 
-def _report_process_final_data(df, unpaid_debt_details, latest_period, payment_deadline_str):
+def _report_process_final_data(df, unpaid_profile, payment_deadline_str):
     main_tz = df['NGAYGIAI_DT_raw'].dt.tz
     if 'NgayThanhToan_BGW_DT' in df.columns:
         bgw_not_na_mask = df['NgayThanhToan_BGW_DT'].notna()
@@ -151,10 +133,11 @@ def _report_process_final_data(df, unpaid_debt_details, latest_period, payment_d
     ]
     choices = ['Khóa nước', 'Đã Thanh Toán']
     df['Tình Trạng Nợ'] = np.select(conditions, choices, default='Chưa Thanh Toán')
-    df['ky_nam chưa thanh toán'] = df[config.DB_COL_DANH_BO].map(unpaid_debt_details).fillna('')
+    profile_positions = unpaid_profile.lookup(keys.encode_keys(df[config.DB_COL_DANH_BO]))
+    df['ky_nam chưa thanh toán'] = unpaid_profile.render(profile_positions)
     is_unpaid_now = df['Tình Trạng Nợ'] == 'Chưa Thanh Toán'
-    unpaid_periods = df['ky_nam chưa thanh toán'].astype(str).str.strip()
-    paid_in_system = (unpaid_periods == '') | ((latest_period is not None) & (unpaid_periods == latest_period))
+    # Không còn kỳ nợ nào, hoặc chỉ còn nợ đúng kỳ mới nhất: coi như đã thanh toán trên hệ thống
+    paid_in_system = ~unpaid_profile.has_debt(profile_positions) | unpaid_profile.only_latest(profile_positions)
     df.loc[is_unpaid_now & paid_in_system, 'Tình Trạng Nợ'] = 'Đã Thanh Toán'
     deadline_naive = pd.to_datetime(payment_deadline_str, dayfirst=True) + pd.Timedelta(days=1, seconds=-1)
     if main_tz is not None:
@@ -333,17 +316,42 @@ def _report_build_stats(processed_df, on_off_df, start_date_str, end_date_str, s
 def run_weekly_report_analysis(start_date_str, end_date_str, selected_group, payment_deadline_str):
     logging.info(f"Bắt đầu chạy 'Báo cáo Tuần': {start_date_str}, {end_date_str}, {selected_group}")
     try:
-        db_df, on_off_df = _report_prepare_initial_data()
         start_date = pd.to_datetime(start_date_str, dayfirst=True)
         end_date = pd.to_datetime(end_date_str, dayfirst=True)
-        mask = (db_df[f'{config.DB_COL_NGAY_GIAO}_chuan_hoa'].dt.date >= start_date.date()) & (db_df[f'{config.DB_COL_NGAY_GIAO}_chuan_hoa'].dt.date <= end_date.date())
-        danh_sach_chi_tiet_df = db_df[mask].copy()
-        if selected_group != "Tất cả các nhóm":
-            danh_sach_chi_tiet_df = danh_sach_chi_tiet_df[danh_sach_chi_tiet_df[config.DB_COL_NHOM] == selected_group]
+
+        def _select_rows(report_data):
+            db_df, on_off_df = report_data
+            mask = (db_df[f'{config.DB_COL_NGAY_GIAO}_chuan_hoa'].dt.date >= start_date.date()) & (db_df[f'{config.DB_COL_NGAY_GIAO}_chuan_hoa'].dt.date <= end_date.date())
+            danh_sach_chi_tiet_df = db_df[mask].copy()
+            if selected_group != "Tất cả các nhóm":
+                danh_sach_chi_tiet_df = danh_sach_chi_tiet_df[danh_sach_chi_tiet_df[config.DB_COL_NHOM] == selected_group]
+            return danh_sach_chi_tiet_df, on_off_df
+
+        def _load_unpaid_profile():
+            try:
+                return data_sources.fetch_unpaid_debt_profile()
+            except Exception as e:
+                logging.warning(f"Không lấy được hồ sơ nợ ({e}), xem như không có kỳ nợ tồn.")
+                return aggregation.DebtProfile.from_invoices([], [], [])
+
+        # Đồng bộ hai sheet song song rồi chọn các dòng đã giao (backend/query_graph.py)
+        graph = QueryGraph('weekly_report_sheets')
+        graph.add('sync_database', lambda: sheet_mirror.sync_sheet(config.DB_SHEET))
+        graph.add('sync_on_off', lambda: sheet_mirror.sync_sheet(config.ON_OFF_SHEET))
+        graph.add('report_data', lambda *_: _report_prepare_initial_data(start_date, end_date),
+                  depends_on=['sync_database', 'sync_on_off'])
+        danh_sach_chi_tiet_df, on_off_df = _select_rows(graph.run()['report_data'])
+        # Không có dòng nào thì dừng trước khi dựng ảnh chụp hoá đơn chưa giải và tra cứu hoá đơn
         if danh_sach_chi_tiet_df.empty:
             return {'error': "Không có dữ liệu để phân tích cho ngày và nhóm đã chọn."}
-        unpaid_debt_details, latest_period = data_sources.fetch_unpaid_debt_details()
-        processed_df = _report_enrich_data(danh_sach_chi_tiet_df)
+
+        # Bổ sung chi tiết hoá đơn và dựng hồ sơ nợ chạy song song
+        graph = QueryGraph('weekly_report')
+        graph.add('enriched', lambda: _report_enrich_data(danh_sach_chi_tiet_df))
+        graph.add('unpaid_profile', _load_unpaid_profile)
+        results = graph.run()
+        unpaid_profile = results['unpaid_profile']
+        processed_df = results['enriched']
         locked_ids = set(on_off_df[on_off_df[config.ON_OFF_COL_ID].notna()][config.ON_OFF_COL_ID])
         processed_df['is_locked'] = processed_df[config.DB_COL_ID].isin(locked_ids)
 
@@ -358,8 +366,7 @@ def run_weekly_report_analysis(start_date_str, end_date_str, selected_group, pay
                     processed_df['is_locked'] == True)
         # ===============================
 
-        processed_df = _report_process_final_data(processed_df, unpaid_debt_details, latest_period,
-                                                  payment_deadline_str)
+        processed_df = _report_process_final_data(processed_df, unpaid_profile, payment_deadline_str)
         summary_df = _report_build_summary(processed_df, selected_group)
         details_df = _report_build_details(processed_df)
         stats_df = _report_build_stats(processed_df, on_off_df, start_date_str, payment_deadline_str, selected_group)
@@ -381,81 +388,252 @@ def run_weekly_report_analysis(start_date_str, end_date_str, selected_group, pay
 # ==============================================================================
 # LOGIC CHO TAB 3: LỌC DỮ LIỆU TỒN & GỬI DS (Google Sheet)
 # ==============================================================================
-def run_debt_filter_analysis(params):
+def _debt_filter_rows(df_hoadon, df_docso):
+    """Ghép từng hoá đơn chưa giải với thông tin khách hàng (KhachHang) và DocSo của kỳ đang lọc."""
+    df_hoadon['TONGCONG'] = pd.to_numeric(df_hoadon['TONGCONG'], errors='coerce').fillna(0)
+
+    df_kh = data_sources.get_customer_attributes(df_hoadon[keys.CUSTOMER_KEY], ['MLT2', 'SoMoi', 'SoThan', 'Hieu', 'HopBaoVe', 'SDT'])
+    merged_df = df_hoadon.join(df_kh)
+    return pd.merge(merged_df, df_docso, on=keys.CUSTOMER_KEY, how='left', suffixes=('', '_docso'))
+
+
+def _debt_filter_aggregate(rows, normalize_codemoi, min_tongky):
     """
-    Lấy và xử lý dữ liệu tồn.
-    Tương đương DebtAnalysisWorker.
+    Gom nhóm các dòng hoá đơn theo danh bạ và thông tin khách hàng: TONGCONG, TONGKY, DANHBA, KY_NAM của mọi nhóm
+    (chưa áp ngưỡng). normalize_codemoi: chuẩn hoá CodeMoi (bỏ khoảng trắng, viết hoa) trước khi gom, như khi có loại trừ.
     """
-    logging.info(f"Bắt đầu chạy 'Lọc Dữ liệu Tồn' với các tham số: {params}")
-    try:
-        p = params
-        string_dtypes = {'DanhBa': str, 'DANHBA': str, 'MLT2': str, 'DOT': str, 'SOHOADON': str, 'CodeMoi': str}
+    hoadon_chua_tra = rows.copy()
+    if normalize_codemoi:
+        hoadon_chua_tra['CodeMoi'] = hoadon_chua_tra['CodeMoi'].str.strip().str.upper()
+
+    # Bỏ trước các danh bạ có ít hoá đơn hơn min_tongky: mỗi nhóm bên dưới là một phần các dòng của một danh bạ
+    # nên không thể đạt ngưỡng, khỏi phải gom nhóm theo 14 cột cho chúng
+    if min_tongky > 1:
+        debt_profile = aggregation.DebtProfile.from_invoices(hoadon_chua_tra[keys.CUSTOMER_KEY], hoadon_chua_tra['KY'],
+                                                             hoadon_chua_tra['NAM'])
+        positions = debt_profile.lookup(hoadon_chua_tra[keys.CUSTOMER_KEY])
+        enough_invoices = debt_profile.invoice_count(positions) >= min_tongky
+        hoadon_chua_tra = hoadon_chua_tra[(positions < 0) | enough_invoices]
+
+    grouping_keys = [keys.CUSTOMER_KEY, 'TENKH', 'SO', 'DUONG', 'GB', 'DOT', 'MLT2', 'SoMoi', 'SoThan', 'Hieu', 'CodeMoi', 'CoCu', 'HopBaoVe', 'SDT']
+    existing_grouping_keys = [key for key in grouping_keys if key in hoadon_chua_tra.columns]
+
+    grouped = hoadon_chua_tra.groupby(existing_grouping_keys, dropna=False)
+    aggregated_df = grouped.agg(
+        TONGCONG=('TONGCONG', 'sum'),
+        TONGKY=(keys.CUSTOMER_KEY, 'size'),
+        DANHBA=('DANHBA', 'first')
+    ).reset_index()
+    aggregated_df['DANHBA'] = aggregated_df['DANHBA'].str.zfill(11)
+    # Các kỳ 'MM/YYYY' khác nhau của mỗi nhóm, sắp tăng và nối bằng dấu phẩy (tổng hợp bằng NumPy, xem backend/aggregation.py)
+    period_codes, period_texts = aggregation.period_labels(hoadon_chua_tra['KY'], hoadon_chua_tra['NAM'])
+    aggregated_df['KY_NAM'] = aggregation.join_periods(grouped.ngroup().to_numpy(), len(aggregated_df),
+                                                       period_codes, period_texts)[0]
+    return aggregated_df
 
-        sql_docso = f"SELECT DanhBa, CodeMoi, CoCu FROM DocSo WHERE Nam = {p['nam']} AND Ky = {p['ky']}"
-        df_docso = data_sources.fetch_dataframe('f_Select_SQL_Doc_so', sql_docso, dtypes=string_dtypes)
-        if not df_docso.empty: df_docso['DanhBa'] = df_docso['DanhBa'].str.zfill(11)
 
-        sql_hoadon_base = f"SELECT DANHBA, GB, TONGCONG, KY, NAM, TENKH, SO, DUONG, SOHOADON, DOT FROM HoaDon WHERE NGAYGIAI IS NULL AND NAM <= {p['nam']}"
-        if p['dot_filter']:
-            dot_in_clause = ", ".join(map(str, p['dot_filter']))
-            sql_hoadon_base += f" AND DOT IN ({dot_in_clause})"
-        df_hoadon = data_sources.fetch_dataframe('f_Select_SQL_Thutien', sql_hoadon_base, dtypes=string_dtypes)
+def _debt_filter_select(aggregated_df, p):
+    """
+    Lọc các nhóm đã gom: bỏ CodeMoi loại trừ (CodeMoi là một cột gom nhóm nên bỏ theo nhóm y hệt bỏ theo dòng),
+    áp ngưỡng TONGKY/TONGCONG và bỏ các danh bạ đang khoá/đã huỷ trong sheet ON_OFF (chưa áp limit).
+    """
+    final_df = aggregated_df
+    if p['exclude_codemoi'] and 'CodeMoi' in final_df.columns:
+        final_df = final_df[~final_df['CodeMoi'].isin(p['exclude_codemoi'])]
+    final_df = final_df[(final_df['TONGKY'] >= p['min_tongky']) & (final_df['TONGCONG'] >= p['min_tongcong'])]
+
+    df_sheet = sheet_mirror.load_on_off_status(final_df['DANHBA'].tolist())
+    if not df_sheet.empty and config.ON_OFF_COL_DANH_BA in df_sheet.columns and config.ON_OFF_COL_TINH_TRANG in df_sheet.columns:
+        df_sheet[keys.CUSTOMER_KEY] = keys.encode_keys(df_sheet[config.ON_OFF_COL_DANH_BA])
+        df_sheet[config.ON_OFF_COL_TINH_TRANG] = df_sheet[config.ON_OFF_COL_TINH_TRANG].astype(str).str.strip()
+        df_sheet = df_sheet[df_sheet[keys.CUSTOMER_KEY] != keys.MISSING_KEY]
+        df_sheet_to_merge = df_sheet[[keys.CUSTOMER_KEY, config.ON_OFF_COL_TINH_TRANG]].drop_duplicates(subset=[keys.CUSTOMER_KEY], keep='last')
+        result_df = pd.merge(final_df, df_sheet_to_merge, on=keys.CUSTOMER_KEY, how='left')
+        statuses_to_exclude = ['đang khóa', 'đang khoá', 'đã hủy']
+        temp_status_col = result_df[config.ON_OFF_COL_TINH_TRANG].str.lower().fillna('')
+        result_df = result_df[~temp_status_col.isin(statuses_to_exclude)]
+        result_df = result_df.drop(columns=[config.ON_OFF_COL_TINH_TRANG])
+    else:
+        result_df = final_df.copy()
+    return result_df
+
 
-        if df_hoadon.empty:
+class _DebtFilterBase:
+    """
+    Bộ dữ liệu gốc của 'Lọc Dữ liệu Tồn' cho một (nam, ky, dot_filter): các dòng hoá đơn đã ghép khách hàng/DocSo và
+    kết quả gom nhóm (mỗi cách chuẩn hoá CodeMoi một bản, dựng khi cần). Đổi ngưỡng, CodeMoi loại trừ hay limit chỉ
+    lọc lại trong bộ nhớ (select), không tải lại gì.
+
+    Bộ gốc dựng từ kết quả gom nhóm trên máy chủ chỉ chứa các danh bạ qua ngưỡng lúc dựng (min_tongky, min_tongcong)
+    và, khi có limit, chỉ các danh bạ có TONGDUONG lớn hơn `bound`; select trả về None khi tham số mới vượt ra ngoài
+    phần đó để dựng lại.
+    """
+
+    def __init__(self, rows, min_tongky=1, min_tongcong=float('-inf'), bound=float('-inf')):
+        self.rows = rows
+        self.min_tongky = min_tongky
+        self.min_tongcong = min_tongcong
+        self.bound = bound
+        self.created_at = time.monotonic()
+        self._aggregates = {}
+        self._lock = threading.Lock()
+
+    def aggregated(self, normalize_codemoi):
+        with self._lock:
+            if normalize_codemoi not in self._aggregates:
+                self._aggregates[normalize_codemoi] = _debt_filter_aggregate(self.rows, normalize_codemoi, self.min_tongky)
+            return self._aggregates[normalize_codemoi]
+
+    def covers(self, p):
+        return p['min_tongky'] >= self.min_tongky and p['min_tongcong'] >= self.min_tongcong
+
+    def complete_for(self, result_df, p):
+        """Kết quả lọc từ bộ gốc có chắc y hệt khi có đủ mọi danh bạ không (xem _debt_filter_server_base)."""
+        if self.bound == float('-inf'):
+            return True
+        limit = p.get('limit')
+        if not limit or limit <= 0 or len(result_df) < limit:
+            return False
+        return result_df['TONGCONG'].nlargest(limit).iloc[-1] > self.bound
+
+    def select(self, p):
+        if not self.covers(p):
+            return None
+        if self.rows.empty:
             return pd.DataFrame()
+        result_df = _debt_filter_select(self.aggregated(bool(p['exclude_codemoi'])), p)
+        return result_df if self.complete_for(result_df, p) else None
 
-        df_hoadon['DANHBA'] = df_hoadon['DANHBA'].str.zfill(11)
-        df_hoadon['TONGCONG'] = pd.to_numeric(df_hoadon['TONGCONG'], errors='coerce').fillna(0)
 
-        sql_kh = "SELECT DanhBa, MLT2, SoMoi, SoThan, Hieu, HopBaoVe, SDT FROM KhachHang"
-        df_kh = data_sources.fetch_dataframe('f_Select_SQL_Doc_so', sql_kh, dtypes=string_dtypes)
-        if not df_kh.empty: df_kh['DanhBa'] = df_kh['DanhBa'].str.zfill(11)
+_DEBT_FILTER_BASES = OrderedDict()  # (nam, ky, các đợt) -> _DebtFilterBase, cũ nhất đứng đầu
+_DEBT_FILTER_BASES_LOCK = threading.Lock()
 
-        merged_df = pd.merge(df_hoadon, df_kh, left_on='DANHBA', right_on='DanhBa', how='left')
-        merged_df = pd.merge(merged_df, df_docso, left_on='DANHBA', right_on='DanhBa', how='left', suffixes=('', '_docso'))
 
-        if p['exclude_codemoi']:
-            merged_df['CodeMoi'] = merged_df['CodeMoi'].str.strip().str.upper()
-            merged_df = merged_df[~merged_df['CodeMoi'].isin(p['exclude_codemoi'])]
+def _debt_filter_base_key(p):
+    return int(p['nam']), int(p['ky']), tuple(sorted({int(dot) for dot in p['dot_filter'] or []}))
 
-        sohoadon_list = merged_df['SOHOADON'].dropna().unique().tolist()
-        if sohoadon_list:
-            df_bgw = data_sources._get_bgw_invoices(sohoadon_list)
-            if not df_bgw.empty:
-                shdon_to_exclude = df_bgw['SHDon'].astype(str).str.strip().unique()
-                merged_df = merged_df[~merged_df['SOHOADON'].astype(str).str.strip().isin(shdon_to_exclude)]
 
-        hoadon_chua_tra = merged_df.copy()
+def _get_debt_filter_base(key):
+    with _DEBT_FILTER_BASES_LOCK:
+        base = _DEBT_FILTER_BASES.get(key)
+        if base is not None and time.monotonic() - base.created_at > config.DEBT_FILTER_BASE_TTL:
+            del _DEBT_FILTER_BASES[key]
+            base = None
+        return base
 
-        hoadon_chua_tra['KY_NAM'] = hoadon_chua_tra['KY'].astype(str).str.zfill(2) + '/' + hoadon_chua_tra['NAM'].astype(str)
-        grouping_keys = ['DANHBA', 'TENKH', 'SO', 'DUONG', 'GB', 'DOT', 'MLT2', 'SoMoi', 'SoThan', 'Hieu', 'CodeMoi', 'CoCu', 'HopBaoVe', 'SDT']
-        existing_grouping_keys = [key for key in grouping_keys if key in hoadon_chua_tra.columns]
 
-        aggregated_df = hoadon_chua_tra.groupby(existing_grouping_keys, dropna=False).agg(
-            TONGCONG=('TONGCONG', 'sum'),
-            TONGKY=('DANHBA', 'size'),
-            KY_NAM=('KY_NAM', lambda x: ','.join(sorted(x.unique())))
-        ).reset_index()
-        final_df = aggregated_df[
-            (aggregated_df['TONGKY'] >= p['min_tongky']) & (aggregated_df['TONGCONG'] >= p['min_tongcong'])]
-
-        df_sheet = data_sources.fetch_worksheet_as_df(config.ON_OFF_SHEET)
-        if not df_sheet.empty and config.ON_OFF_COL_DANH_BA in df_sheet.columns and config.ON_OFF_COL_TINH_TRANG in df_sheet.columns:
-            df_sheet[config.ON_OFF_COL_DANH_BA] = df_sheet[config.ON_OFF_COL_DANH_BA].astype(str).str.strip().str.zfill(11)
-            df_sheet[config.ON_OFF_COL_TINH_TRANG] = df_sheet[config.ON_OFF_COL_TINH_TRANG].astype(str).str.strip()
-            df_sheet_to_merge = df_sheet[[config.ON_OFF_COL_DANH_BA, config.ON_OFF_COL_TINH_TRANG]].drop_duplicates(subset=[config.ON_OFF_COL_DANH_BA], keep='last')
-            result_df = pd.merge(final_df, df_sheet_to_merge, left_on='DANHBA', right_on=config.ON_OFF_COL_DANH_BA, how='left')
-            statuses_to_exclude = ['đang khóa', 'đang khoá', 'đã hủy']
-            temp_status_col = result_df[config.ON_OFF_COL_TINH_TRANG].str.lower().fillna('')
-            result_df = result_df[~temp_status_col.isin(statuses_to_exclude)]
-            if config.ON_OFF_COL_DANH_BA in result_df.columns:
-                result_df = result_df.drop(columns=[config.ON_OFF_COL_DANH_BA, config.ON_OFF_COL_TINH_TRANG])
+def _put_debt_filter_base(key, base):
+    with _DEBT_FILTER_BASES_LOCK:
+        _DEBT_FILTER_BASES.pop(key, None)
+        _DEBT_FILTER_BASES[key] = base
+        while len(_DEBT_FILTER_BASES) > config.DEBT_FILTER_BASE_MAX_ENTRIES:
+            _DEBT_FILTER_BASES.popitem(last=False)
+
+
+def reset_debt_filter_cache():
+    """Bỏ mọi bộ dữ liệu gốc của 'Lọc Dữ liệu Tồn' (lần lọc sau tải lại từ đầu)."""
+    with _DEBT_FILTER_BASES_LOCK:
+        _DEBT_FILTER_BASES.clear()
+
+
+def _debt_filter_server_base(df_totals, df_docso, p):
+    """
+    Dựng bộ gốc từ kết quả gom nhóm trên máy chủ (data_sources.fetch_unpaid_debtor_totals): chỉ tải chi tiết hoá đơn
+    của các danh bạ đã qua ngưỡng. Có limit thì tải theo đợt, danh bạ có TONGDUONG lớn trước; dừng khi đã đủ limit dòng
+    và dòng thứ limit lớn hơn hẳn TONGDUONG của danh bạ chưa tải đầu tiên (mọi nhóm của danh bạ đó đều nhỏ hơn nên
+    không thể vào Top N), kết quả y hệt khi tải tất cả.
+    """
+    danhba_list = df_totals[config.API_COL_DANHBA].tolist()
+    upper_bounds = df_totals['TONGDUONG'].to_numpy(dtype=float)
+    limit = p.get('limit')
+    batch = len(danhba_list)
+    if limit and limit > 0:
+        batch = min(batch, max(2 * limit, config.DEBT_FILTER_SERVER_BATCH))
+    frames, fetched = [], 0
+    base = _DebtFilterBase(pd.DataFrame(), p['min_tongky'], p['min_tongcong'])
+    while fetched < len(danhba_list):
+        frames.append(data_sources.fetch_unpaid_invoices_for(danhba_list[fetched:batch], p['nam'], p['dot_filter']))
+        fetched = batch
+        df_hoadon = pd.concat(frames, ignore_index=True)
+        if not df_hoadon.empty:
+            bound = upper_bounds[fetched] if fetched < len(danhba_list) else float('-inf')
+            base = _DebtFilterBase(_debt_filter_rows(df_hoadon, df_docso), p['min_tongky'], p['min_tongcong'], bound)
+            if base.select(p) is not None:
+                if fetched < len(danhba_list):
+                    logging.info(f"Lọc tồn: đủ Top {limit} sau khi tải chi tiết {fetched}/{len(danhba_list)} danh bạ.")
+                break
+        batch = min(len(danhba_list), 2 * batch)
+    return base
+
+
+def run_debt_filter_analysis(params):
+    """
+    Lấy và xử lý dữ liệu tồn.
+    Tương đương DebtAnalysisWorker.
+    """
+    logging.info(f"Bắt đầu chạy 'Lọc Dữ liệu Tồn' với các tham số: {params}")
+    try:
+        p = params
+        string_dtypes = {'DanhBa': str, 'DANHBA': str, 'MLT2': str, 'DOT': str, 'SOHOADON': str, 'CodeMoi': str}
+
+        def _load_docso():
+            sql_docso = f"SELECT DanhBa, CodeMoi, CoCu FROM DocSo WHERE Nam = {p['nam']} AND Ky = {p['ky']}"
+            df_docso = data_sources.fetch_dataframe('f_Select_SQL_Doc_so', sql_docso, dtypes=string_dtypes)
+            # Các phép ghép/gom nhóm theo danh bạ chạy trên khoá số (backend/keys.py); chuỗi 11 số chỉ dựng lại khi hiển thị
+            if not df_docso.empty:
+                df_docso[keys.CUSTOMER_KEY] = keys.encode_keys(df_docso['DanhBa'])
+                df_docso = df_docso.drop(columns=['DanhBa'])
+            return df_docso
+
+        def _load_hoadon():
+            # Hoá đơn chưa giải (đã bỏ các hoá đơn thanh toán qua BGW_HD) từ ảnh chụp dùng chung, lọc theo năm và đợt
+            df_hoadon = data_sources.get_unpaid_invoices(['DANHBA', keys.CUSTOMER_KEY, 'GB', 'TONGCONG', 'KY', 'NAM', 'TENKH', 'SO', 'DUONG', 'SOHOADON', 'DOT'])
+            df_hoadon = df_hoadon[pd.to_numeric(df_hoadon['NAM'], errors='coerce') <= p['nam']]
+            if p['dot_filter']:
+                df_hoadon = df_hoadon[pd.to_numeric(df_hoadon['DOT'], errors='coerce').isin([int(dot) for dot in p['dot_filter']])]
+            return df_hoadon
+
+        def _load_base():
+            # DocSo, hoá đơn chưa giải, bảng khách hàng và sheet ON_OFF không phụ thuộc nhau: đọc song song
+            graph = QueryGraph('debt_filter')
+            graph.add('docso', _load_docso)
+            # Chưa có ảnh chụp hoá đơn chưa giải trong bộ nhớ: để máy chủ gom nhóm theo danh bạ thay vì tải toàn bộ HoaDon
+            mode = p.get('server_aggregation', config.DEBT_FILTER_SERVER_AGGREGATION)
+            use_server = mode is True or (mode == 'auto' and not data_sources.is_unpaid_snapshot_loaded())
+            if use_server:
+                graph.add('hoadon', lambda: data_sources.fetch_unpaid_debtor_totals(p['nam'], p['dot_filter'],
+                                                                                   p['min_tongky'], p['min_tongcong']))
+            else:
+                graph.add('hoadon', _load_hoadon)
+            graph.add('khachhang', data_sources.load_customer_dimension)
+            graph.add('sync_on_off', lambda: sheet_mirror.sync_sheet(config.ON_OFF_SHEET))
+            results = graph.run()
+            df_docso = results['docso']
+
+            if use_server:
+                base = _debt_filter_server_base(results['hoadon'], df_docso, p)
+            elif results['hoadon'].empty:
+                base = _DebtFilterBase(pd.DataFrame())
+            else:
+                base = _DebtFilterBase(_debt_filter_rows(results['hoadon'], df_docso))
+            _put_debt_filter_base(base_key, base)
+            return base.select(p)
+
+        # Chỉ nam, ky và dot_filter quyết định phải tải gì: đổi ngưỡng/CodeMoi/limit dùng lại bộ gốc đã có
+        base_key = _debt_filter_base_key(p)
+        base = _get_debt_filter_base(base_key)
+        result_df = None
+        if base is not None and base.covers(p):
+            sheet_mirror.sync_sheet(config.ON_OFF_SHEET)
+            result_df = base.select(p)  # None: Top N mới cần các danh bạ bộ gốc chưa tải
+        if result_df is not None:
+            logging.info(f"Lọc tồn: dùng lại bộ dữ liệu gốc {base_key}, chỉ lọc lại trong bộ nhớ.")
         else:
-            result_df = final_df.copy()
+            result_df = _load_base()
 
         limit = params.get('limit')
         if limit and limit > 0 and 'TONGCONG' in result_df.columns:
-            result_df = result_df.sort_values(by='TONGCONG', ascending=False).head(limit)
+            result_df = result_df.sort_values(by='TONGCONG', ascending=False, kind='stable').head(limit)
 
         if 'MLT2' in result_df.columns and 'DOT' in result_df.columns:
             result_df = result_df.sort_values(by=['MLT2', 'DOT'])
@@ -475,44 +653,62 @@ def run_debt_filter_analysis(params):
 # ==============================================================================
 # LOGIC GỬI DỮ LIỆU LÊN SHEET
 # ==============================================================================
+def _prepare_sheet_rows(selected_df, assign_group, assign_date_str):
+    """Chuyển danh sách khách hàng đã chọn sang các cột của sheet database cho một lượt giao."""
+    df = selected_df.copy()
+    # Xử lý các cột hiện có
+    if 'HopBaoVe' in df.columns:
+        df['HopBaoVe'] = df['HopBaoVe'].fillna(False).astype(bool).astype(int)
+    if 'SoMoi' in df.columns:
+        df['SoMoi'] = df['SoMoi'].fillna('')
+
+    # === KHÔI PHỤC LẠI VIỆC TẠO CỘT STT ===
+    df.insert(0, 'STT', range(1, len(df) + 1))
+
+    # Tạo các cột khác
+    df['nhom'] = assign_group
+    df['ngay_giao_ds'] = assign_date_str
+    today_str_for_id = datetime.now().strftime('%d%m%Y')
+    df['ID'] = df['DANHBA'] + '-' + today_str_for_id
+
+    base_url = "https://capnuocbenthanh.com/tra-cuu/?code="
+    df['tra_cuu_no'] = base_url + df['DANHBA']
+
+    # Mapping bao gồm cả cột STT
+    column_mapping = {
+        'DANHBA': 'danh_bo', 'SO': 'so_nha', 'SoMoi': 'DCTT', 'DUONG': 'ten_duong',
+        'TENKH': 'ten_kh', 'TONGKY': 'tong_ky', 'TONGCONG': 'tong_tien',
+        'KY_NAM': 'ky_nam', 'GB': 'GB', 'DOT': 'DOT', 'HopBaoVe': 'hop_bv',
+        'SoThan': 'so_than', 'nhom': 'nhom', 'ngay_giao_ds': 'ngay_giao_ds',
+        'ID': 'ID', 'STT': 'STT',
+        'tra_cuu_no': 'tra_cuu_no'
+    }
+    df_to_send = df.rename(columns=column_mapping)
+    return df_to_send
+
+
 def prepare_and_send_to_sheet(selected_df, assign_group, assign_date_str):
     """
     Chuẩn bị dữ liệu và gọi hàm gửi lên Google Sheet.
     Tương đương SheetAppendWorker.
     """
+    return prepare_and_send_batches_to_sheet([(selected_df, assign_group, assign_date_str)])
+
+
+def prepare_and_send_batches_to_sheet(assignments):
+    """
+    Gửi nhiều lượt giao cùng lúc trong một lần ghi xuống sheet.
+    assignments là danh sách (selected_df, assign_group, assign_date_str).
+    """
     try:
-        df = selected_df.copy()
-        # Xử lý các cột hiện có
-        if 'HopBaoVe' in df.columns:
-            df['HopBaoVe'] = df['HopBaoVe'].fillna(False).astype(bool).astype(int)
-        if 'SoMoi' in df.columns:
-            df['SoMoi'] = df['SoMoi'].fillna('')
-
-        # === KHÔI PHỤC LẠI VIỆC TẠO CỘT STT ===
-        df.insert(0, 'STT', range(1, len(df) + 1))
-
-        # Tạo các cột khác
-        df['nhom'] = assign_group
-        df['ngay_giao_ds'] = assign_date_str
-        today_str_for_id = datetime.now().strftime('%d%m%Y')
-        df['ID'] = df['DANHBA'] + '-' + today_str_for_id
-
-        base_url = "https://capnuocbenthanh.com/tra-cuu/?code="
-        df['tra_cuu_no'] = base_url + df['DANHBA']
-
-        # Mapping bao gồm cả cột STT
-        column_mapping = {
-            'DANHBA': 'danh_bo', 'SO': 'so_nha', 'SoMoi': 'DCTT', 'DUONG': 'ten_duong',
-            'TENKH': 'ten_kh', 'TONGKY': 'tong_ky', 'TONGCONG': 'tong_tien',
-            'KY_NAM': 'ky_nam', 'GB': 'GB', 'DOT': 'DOT', 'HopBaoVe': 'hop_bv',
-            'SoThan': 'so_than', 'nhom': 'nhom', 'ngay_giao_ds': 'ngay_giao_ds',
-            'ID': 'ID', 'STT': 'STT',
-            'tra_cuu_no': 'tra_cuu_no'
-        }
-        df_to_send = df.rename(columns=column_mapping)
+        frames = [_prepare_sheet_rows(*assignment) for assignment in assignments]
+        df_to_send = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
         # Gọi hàm gửi sheet
-        return data_sources.append_df_to_worksheet(df_to_send, config.DB_SHEET)
+        count, msg = data_sources.append_df_to_worksheet(df_to_send, config.DB_SHEET)
+        if count > 0:
+            sheet_mirror.mark_stale(config.DB_SHEET)
+        return count, msg
 
     except Exception as e:
         logging.error(f"Lỗi khi chuẩn bị dữ liệu để gửi: {e}", exc_info=True)
@@ -1,19 +1,297 @@
 import gspread
+from google.auth.exceptions import RefreshError
 import pandas as pd
+import numpy as np
 import requests
-import io
+import urllib3
+from requests.adapters import HTTPAdapter
+from lxml import etree
 import html
+import io
+import pickle
+import re
+import hashlib
 import logging
 import diskcache
 import sys
 import os
+import time
+import calendar
+import threading
+import itertools
+import random
+import bisect
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import date, timedelta
 import streamlit as st
 from streamlit.errors import StreamlitAPIException  # Import thêm lỗi này
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import config
+from backend import aggregation, keys
+
+CACHE = diskcache.Cache('api_cache', size_limit=config.API_CACHE_SIZE_LIMIT,
+                        eviction_policy=config.API_CACHE_EVICTION_POLICY)
+# Mỗi nhóm truy vấn (history/reference/live/default) có vùng cache riêng với hạn mức dung lượng riêng
+_CLASS_CACHES = {}
+_CLASS_CACHES_LOCK = threading.Lock()
+
+# Pool dùng chung cho các truy vấn BGW_HD theo khối, giới hạn số kết nối đồng thời tới API
+_BGW_EXECUTOR = ThreadPoolExecutor(max_workers=config.BGW_MAX_WORKERS, thread_name_prefix='bgw_chunk')
+
+# Session HTTP dùng chung cho cả tiến trình (mọi phiên Streamlit), tạo lười khi gọi API lần đầu
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+# Thẻ của diffgram trong phản hồi SOAP: .../diffgr:diffgram/NewDataSet/Table1
+_DIFFGRAM_TAG = '{urn:schemas-microsoft-com:xml-diffgram-v1}diffgram'
+# Các chuỗi được coi là rỗng (NaN), giống mặc định của pd.read_xml
+_NA_STRINGS = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+                         '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+_TRUE_STRINGS = frozenset(['True', 'TRUE', 'true'])
+_FALSE_STRINGS = frozenset(['False', 'FALSE', 'false'])
+
+# Thống kê cache kết quả của fetch_dataframe
+_RESULT_CACHE_STATS = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'hit_seconds': 0.0, 'xml_bytes': 0,
+                       'stored_bytes': 0, 'parquet_entries': 0, 'pickle_entries': 0, 'refreshes': 0,
+                       'refresh_errors': 0}
+_RESULT_CACHE_STATS_LOCK = threading.Lock()
+
+# Làm mới nền cho các mục cache đã hết hạn (stale-while-revalidate)
+_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=config.API_CACHE_REFRESH_WORKERS, thread_name_prefix='cache_refresh')
+_REFRESHING_KEYS = set()
+_REFRESHING_LOCK = threading.Lock()
+_CACHE_STATUS = threading.local()  # Trạng thái cache của lần gọi gần nhất trong luồng hiện tại
+
+# Kết nối Google Sheets dùng chung cho cả tiến trình: client đã xác thực, spreadsheet và các worksheet đã mở
+_SHEETS_CONN = {'client': None, 'spreadsheet': None, 'worksheets': {}}
+_SHEETS_LOCK = threading.RLock()
+# Dòng dữ liệu cuối đã biết của từng worksheet (lấy từ phản hồi append), dùng khi thử lại để tránh ghi trùng
+_APPEND_WATERMARKS = {}
+_APPEND_LOCK = threading.Lock()
+_APPEND_START_COLUMN = 2  # Dữ liệu DB_SHEET_FINAL_COLUMNS ghi từ cột B
+_RETRYABLE_SHEET_STATUS = (429, 500, 502, 503, 504)
+_SHEETS_STATS = {'auths': 0, 'auth_seconds': 0.0, 'opens': 0, 'open_seconds': 0.0, 'worksheet_opens': 0,
+                 'worksheet_seconds': 0.0, 'reuses': 0, 'reconnects': 0}
+
+
+class _SingleFlight:
+    """
+    Gộp các lời gọi đồng thời có cùng khoá trong tiến trình: chỉ luồng đầu tiên gọi upstream,
+    các luồng (phiên Streamlit) khác chờ và dùng chung kết quả của lần gọi đó.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.stats = {'calls': 0, 'upstream_calls': 0, 'coalesced': 0}
+
+    def do(self, key, fn):
+        """Trả về (kết quả, shared); shared=True nghĩa là kết quả lấy từ lời gọi của luồng khác."""
+        with self._lock:
+            self.stats['calls'] += 1
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+                self.stats['upstream_calls'] += 1
+            else:
+                self.stats['coalesced'] += 1
+        if not is_leader:
+            return future.result(), True
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+
+_SINGLE_FLIGHT = _SingleFlight()
+
+
+class UpstreamUnavailableError(ConnectionError):
+    """API đang ngắt mạch sau nhiều lỗi liên tiếp; lời gọi bị từ chối ngay thay vì chờ hết thời gian."""
+
+
+class _LatencyTracker:
+    """Độ trễ các lần gọi thành công gần nhất theo nhóm truy vấn, dùng để đặt hạn chót và mốc gửi dự phòng."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, query_class, seconds):
+        with self._lock:
+            self._samples.setdefault(query_class, deque(maxlen=config.API_LATENCY_WINDOW)).append(seconds)
+
+    def percentile(self, query_class, q):
+        """Phân vị q (0-100) của độ trễ, None nếu chưa đủ API_LATENCY_MIN_SAMPLES mẫu."""
+        with self._lock:
+            samples = list(self._samples.get(query_class, ()))
+        if len(samples) < config.API_LATENCY_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, q))
+
+    def deadline(self, query_class):
+        """Hạn chót (giây) của một lần gọi: tính cả thời gian đọc hết phản hồi."""
+        p99 = self.percentile(query_class, 99)
+        if p99 is None:
+            return config.API_TIMEOUT
+        return min(config.API_TIMEOUT, max(config.API_TIMEOUT_MIN, p99 * config.API_TIMEOUT_P99_FACTOR))
+
+
+class _CircuitBreaker:
+    """
+    Ngắt mạch cho API: mở sau API_BREAKER_FAILURES lỗi tạm thời liên tiếp, từ chối mọi lời gọi trong
+    API_BREAKER_COOLDOWN giây, sau đó cho một lời gọi thử (half-open); thành công thì đóng lại.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def is_open(self):
+        with self._lock:
+            return self.state == 'open' and time.monotonic() - self._opened_at < config.API_BREAKER_COOLDOWN
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self._opened_at >= config.API_BREAKER_COOLDOWN:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return
+            raise UpstreamUnavailableError("API tạm thời không phản hồi, vui lòng thử lại sau ít phút.")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logging.info("API đã phản hồi trở lại, đóng ngắt mạch.")
+            self.state, self._failures, self._probing = 'closed', 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == 'half_open' or self._failures >= config.API_BREAKER_FAILURES:
+                if self.state != 'open':
+                    logging.warning(f"API lỗi {self._failures} lần liên tiếp, ngắt mạch {config.API_BREAKER_COOLDOWN}s.")
+                self.state, self._opened_at = 'open', time.monotonic()
+
+
+_API_LATENCY = _LatencyTracker()
+_API_BREAKER = _CircuitBreaker()
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=config.API_POOL_SIZE, thread_name_prefix='api_hedge')
+_RESILIENCE_STATS = {'attempts': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'transient_errors': 0,
+                     'rejected': 0}
+_RESILIENCE_STATS_LOCK = threading.Lock()
+
+
+class _QueryMetrics:
+    """
+    Số liệu truy cập dữ liệu theo (hàm API, dạng SQL): số lần gọi theo kết quả cache (hit/stale/miss/coalesced/
+    refresh/error), thời gian, số byte phản hồi, thời gian phân tích, số dòng và histogram tương ứng.
+    Các truy vấn chậm hơn METRICS_SLOW_QUERY_SECONDS được giữ trong một nhật ký vòng.
+    """
+
+    _HISTOGRAMS = (('latency', 'METRICS_LATENCY_BUCKETS'), ('bytes', 'METRICS_BYTES_BUCKETS'),
+                   ('rows', 'METRICS_ROWS_BUCKETS'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._slow = deque(maxlen=config.METRICS_SLOW_LOG_SIZE)
+
+    def _new_entry(self, function_name, fingerprint):
+        entry = {'function': function_name, 'fingerprint': fingerprint,
+                 'fingerprint_id': hashlib.md5(fingerprint.encode('utf-8')).hexdigest()[:12],
+                 'count': 0, 'outcomes': Counter(), 'wall_seconds': 0.0, 'max_wall_seconds': 0.0,
+                 'parse_seconds': 0.0, 'response_bytes': 0, 'rows': 0}
+        for name, buckets in self._HISTOGRAMS:
+            entry[f'{name}_hist'] = [0] * (len(getattr(config, buckets)) + 1)
+        return entry
 
-CACHE = diskcache.Cache('api_cache')
+    def record(self, function_name, canonical_sql, wall_seconds, outcome, rows=None, response_bytes=0,
+               parse_seconds=0.0):
+        fingerprint = sql_fingerprint(canonical_sql)
+        values = {'latency': wall_seconds, 'bytes': response_bytes, 'rows': rows}
+        with self._lock:
+            entry = self._entries.get((function_name, fingerprint))
+            if entry is None:
+                entry = self._entries[(function_name, fingerprint)] = self._new_entry(function_name, fingerprint)
+            entry['count'] += 1
+            entry['outcomes'][outcome] += 1
+            entry['wall_seconds'] += wall_seconds
+            entry['max_wall_seconds'] = max(entry['max_wall_seconds'], wall_seconds)
+            entry['parse_seconds'] += parse_seconds
+            entry['response_bytes'] += response_bytes
+            entry['rows'] += rows or 0
+            for name, buckets in self._HISTOGRAMS:
+                # Lời gọi lỗi không có kích thước/số dòng; lời gọi lấy từ cache không nhận byte nào từ API
+                if values[name] is None or (name == 'bytes' and outcome not in ('miss', 'refresh')):
+                    continue
+                entry[f'{name}_hist'][bisect.bisect_left(getattr(config, buckets), values[name])] += 1
+            if wall_seconds >= config.METRICS_SLOW_QUERY_SECONDS:
+                self._slow.append({'time': time.time(), 'function': function_name,
+                                   'fingerprint_id': entry['fingerprint_id'], 'sql': canonical_sql[:500],
+                                   'wall_seconds': wall_seconds, 'outcome': outcome, 'rows': rows,
+                                   'response_bytes': response_bytes, 'parse_seconds': parse_seconds})
+
+        if wall_seconds >= config.METRICS_SLOW_QUERY_SECONDS:
+            logging.warning(f"Truy vấn chậm {wall_seconds:.2f}s ({function_name}, {outcome}, {rows} dòng, "
+                            f"{response_bytes} byte): {canonical_sql[:200]}")
+
+    def snapshot(self):
+        with self._lock:
+            entries = [dict(e, outcomes=dict(e['outcomes']), **{f'{name}_hist': list(e[f'{name}_hist'])
+                                                                 for name, _ in self._HISTOGRAMS})
+                       for e in self._entries.values()]
+        return entries
+
+    def slow_queries(self):
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self._slow.clear()
+
+
+_QUERY_METRICS = _QueryMetrics()
+
+# Chuẩn hoá câu SQL để các truy vấn tương đương dùng chung một khoá cache
+_SQL_TOKEN_RE = re.compile(r"""
+      (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>N?'(?:[^']|'')*')
+    | (?P<number>\d+(?:\.\d+)?)
+    | (?P<ident>\[[^\]]*\]|\w+)
+    | (?P<space>\s+)
+    | (?P<op><>|<=|>=|!=|.)
+""", re.VERBOSE | re.DOTALL)
+_SQL_KEYWORDS = frozenset([
+    'SELECT', 'DISTINCT', 'TOP', 'FROM', 'WHERE', 'AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'AS', 'ON', 'JOIN',
+    'LEFT', 'RIGHT', 'INNER', 'OUTER', 'FULL', 'GROUP', 'BY', 'ORDER', 'HAVING', 'ASC', 'DESC', 'WITH', 'CASE',
+    'WHEN', 'THEN', 'ELSE', 'END', 'BETWEEN', 'LIKE', 'OVER', 'PARTITION', 'OFFSET', 'ROWS', 'FETCH', 'NEXT',
+    'ONLY', 'CAST', 'TRY_CAST', 'ISNULL', 'COALESCE', 'SUM', 'COUNT', 'MIN', 'MAX', 'AVG', 'YEAR', 'MONTH',
+    'ROW_NUMBER', 'LTRIM', 'RTRIM', 'INT', 'FLOAT', 'DATE', 'VARCHAR', 'UNION', 'ALL',
+])
+_CANONICAL_STATS = {'lookups': 0, 'canonical_only_hits': 0}
+# hash câu SQL gốc -> hash dạng chuẩn hoá; chỉ giữ API_CACHE_CANONICAL_TRACK_LIMIT câu dùng gần nhất
+_CANONICAL_VARIANTS = OrderedDict()
+_CANONICAL_STATS_LOCK = threading.Lock()
 
 
 def resource_path(relative_path):
@@ -35,36 +313,807 @@ def _build_soap_request(function_name, sql_query):
         function_name=function_name, sql_command=escaped_sql_command, user=config.API_USER)
 
 
-@CACHE.memoize(expire=3600)
-def execute_sql_query(function_name, sql_query):
+def _get_http_session():
+    """
+    Trả về requests.Session dùng chung, có pool kết nối keep-alive tới config.API_URL.
+    Session và pool của urllib3 an toàn khi dùng đồng thời từ nhiều luồng phiên của Streamlit.
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None:
+        return _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.API_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Connection'] = 'keep-alive' if config.API_KEEP_ALIVE else 'close'
+            session.headers['Accept-Encoding'] = 'gzip, deflate' if config.API_ACCEPT_GZIP else 'identity'
+            _HTTP_SESSION = session
+            logging.info(f"Khởi tạo HTTP session dùng chung (pool {config.API_POOL_SIZE} kết nối).")
+    return _HTTP_SESSION
+
+
+def get_transport_stats():
+    """Thống kê pool kết nối: số kết nối TCP đã mở, số request đã gửi và số lần dùng lại kết nối."""
+    stats = {'connections_opened': 0, 'requests_sent': 0, 'connections_reused': 0}
+    session = _HTTP_SESSION
+    if session is None:
+        return stats
+    pools = session.get_adapter(config.API_URL).poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats['connections_opened'] += pool.num_connections
+        stats['requests_sent'] += pool.num_requests
+    stats['connections_reused'] = max(stats['requests_sent'] - stats['connections_opened'], 0)
+    return stats
+
+
+def _post_soap(function_name, sql_query, stream=False, timeout=None):
+    """Gửi yêu cầu SOAP qua session dùng chung, trả về response (đọc dần nếu stream=True)."""
     soap_body = _build_soap_request(function_name, sql_query)
     headers = {
         'Content-Type': 'text/xml; charset=utf-8',
         'SOAPAction': f'"http://tempuri.org/{function_name}"',
         'Host': config.API_URL.split('//')[1].split('/')[0],
     }
-    try:
-        response = requests.post(
-            config.API_URL, data=soap_body.encode('utf-8'), headers=headers, timeout=config.API_TIMEOUT)
+    response = _get_http_session().post(
+        config.API_URL, data=soap_body.encode('utf-8'), headers=headers,
+        timeout=timeout or (config.API_CONNECT_TIMEOUT, config.API_TIMEOUT), stream=stream)
+    if response.status_code >= 400:
+        response.content  # Đọc hết nội dung lỗi (SOAP Fault) trước khi trả kết nối về pool
+        response.close()
         response.raise_for_status()
-        return response.text
-    except requests.exceptions.RequestException as e:
-        raise ConnectionError(f"Lỗi kết nối API: {e}")
+    return response
 
 
-def fetch_dataframe(function_name, sql_query, dtypes=None):
-    xml_response = execute_sql_query(function_name, sql_query)
+def _is_transient_error(e):
+    """Lỗi tạm thời đáng thử lại: mất kết nối, quá thời gian, HTTP 429/502/503/504 hoặc 500 không phải SOAP Fault."""
+    if isinstance(e, requests.exceptions.HTTPError):
+        response = e.response
+        status = getattr(response, 'status_code', None)
+        if status == 500:
+            # Lỗi SQL được trả về dạng SOAP Fault với mã 500: gọi lại cũng lỗi y như vậy
+            return b'Fault>' not in (response.content or b'')
+        return status in (429, 502, 503, 504)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError))
+
+
+def _is_idempotent(sql_query):
+    """Chỉ truy vấn đọc (SELECT/WITH) mới được thử lại hoặc gửi dự phòng."""
+    canonical_sql = canonicalize_sql(sql_query)
+    return (canonical_sql.startswith(('SELECT ', 'WITH '))
+            and not re.search(r'\b(?:INSERT|UPDATE|DELETE|MERGE|EXEC|EXECUTE|INTO)\b', canonical_sql, re.IGNORECASE))
+
+
+class _DeadlineReader:
+    """
+    Luồng byte (đã giải nén) của response có hạn chót tổng: read timeout của requests chỉ giới hạn từng lần đọc
+    socket, nên phản hồi gửi nhỏ giọt vẫn kéo dài mãi. Mỗi lần đọc chỉ chờ dữ liệu đang có (read1) và báo
+    requests.Timeout khi đã quá hạn; một lần đọc đang chờ vẫn bị chặn bởi read timeout của socket.
+    """
+
+    _CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, raw, deadline):
+        self.raw = raw
+        self.deadline = deadline
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self._CHUNK_SIZE), b''))
+        if time.monotonic() > self.deadline:
+            raise requests.exceptions.ReadTimeout("Quá hạn chót khi đang đọc phản hồi API.")
+        return self.raw.read1(size, decode_content=True)
+
+
+def _attempt_api_call(function_name, sql_query, query_class, consume):
+    """
+    Một lần gọi API trong hạn chót của nhóm truy vấn; consume(response, body) đọc/phân tích phản hồi từ luồng
+    body (_DeadlineReader). Độ trễ lần gọi thành công được ghi lại.
+    """
+    with _RESILIENCE_STATS_LOCK:
+        _RESILIENCE_STATS['attempts'] += 1
+    deadline = _API_LATENCY.deadline(query_class)
+    start_time = time.monotonic()
+    with _post_soap(function_name, sql_query, stream=True, timeout=(config.API_CONNECT_TIMEOUT, deadline)) as response:
+        result = consume(response, _DeadlineReader(response.raw, start_time + deadline))
+    _API_LATENCY.record(query_class, time.monotonic() - start_time)
+    return result
+
+
+def _hedged_api_call(function_name, sql_query, query_class, consume):
+    """
+    Gọi API; nếu lời gọi chạy quá p95 của nhóm, gửi thêm một yêu cầu dự phòng và lấy kết quả về trước.
+    Yêu cầu còn lại chạy nốt ở nền rồi bị bỏ.
+    """
+    p95 = _API_LATENCY.percentile(query_class, 95)
+    if not config.API_HEDGE or p95 is None:
+        return _attempt_api_call(function_name, sql_query, query_class, consume)
+    first = _HEDGE_EXECUTOR.submit(_attempt_api_call, function_name, sql_query, query_class, consume)
     try:
-        df = pd.read_xml(io.StringIO(xml_response), xpath=".//diffgr:diffgram/NewDataSet/Table1",
-                         namespaces={"diffgr": "urn:schemas-microsoft-com:xml-diffgram-v1"}, dtype=dtypes,
-                         parse_dates=False, parser='lxml')
-        return df
-    except (ValueError, KeyError):
+        return first.result(timeout=max(p95, config.API_HEDGE_MIN_DELAY))
+    except FutureTimeoutError:
+        pass
+    second = _HEDGE_EXECUTOR.submit(_attempt_api_call, function_name, sql_query, query_class, consume)
+    with _RESILIENCE_STATS_LOCK:
+        _RESILIENCE_STATS['hedges'] += 1
+    pending, error = {first, second}, None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    with _RESILIENCE_STATS_LOCK:
+                        _RESILIENCE_STATS['hedge_wins'] += 1
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+
+def _call_api(function_name, sql_query, query_class, consume):
+    """
+    Gọi API qua lớp chịu lỗi: hạn chót mỗi lần gọi theo độ trễ của nhóm truy vấn, thử lại có backoff cho truy vấn đọc,
+    yêu cầu dự phòng (API_HEDGE) và ngắt mạch khi API liên tục lỗi.
+    Lỗi kết nối được báo bằng ConnectionError (UpstreamUnavailableError khi đang ngắt mạch).
+    """
+    idempotent = _is_idempotent(sql_query)
+    retries = config.API_RETRIES if idempotent else 0
+    for attempt in range(retries + 1):
+        try:
+            _API_BREAKER.before_call()
+        except UpstreamUnavailableError:
+            with _RESILIENCE_STATS_LOCK:
+                _RESILIENCE_STATS['rejected'] += 1
+            raise
+        try:
+            if idempotent:
+                result = _hedged_api_call(function_name, sql_query, query_class, consume)
+            else:
+                result = _attempt_api_call(function_name, sql_query, query_class, consume)
+        except Exception as e:
+            if not _is_transient_error(e):
+                # API vẫn trả lời (lỗi SQL, 4xx...): không tính vào ngắt mạch
+                _API_BREAKER.record_success()
+                if isinstance(e, (requests.exceptions.RequestException, urllib3.exceptions.HTTPError)):
+                    raise ConnectionError(f"Lỗi kết nối API: {e}")
+                raise
+            _API_BREAKER.record_failure()
+            with _RESILIENCE_STATS_LOCK:
+                _RESILIENCE_STATS['transient_errors'] += 1
+            if attempt == retries or _API_BREAKER.is_open():
+                raise ConnectionError(f"Lỗi kết nối API: {e}")
+            delay = random.uniform(0, min(config.API_RETRY_BACKOFF_MAX, config.API_RETRY_BACKOFF * 2 ** attempt))
+            logging.warning(f"Gọi API {function_name} lỗi tạm thời ({e}), thử lại lần {attempt + 1} sau {delay:.1f}s.")
+            with _RESILIENCE_STATS_LOCK:
+                _RESILIENCE_STATS['retries'] += 1
+            time.sleep(delay)
+            continue
+        _API_BREAKER.record_success()
+        return result
+
+
+def get_resilience_stats():
+    """Số lần gọi/thử lại/gửi dự phòng, trạng thái ngắt mạch và độ trễ p50/p95 cùng hạn chót theo nhóm truy vấn."""
+    with _RESILIENCE_STATS_LOCK:
+        stats = dict(_RESILIENCE_STATS)
+    stats['breaker_state'] = _API_BREAKER.state
+    stats['latency'] = {query_class: {'p50': _API_LATENCY.percentile(query_class, 50),
+                                      'p95': _API_LATENCY.percentile(query_class, 95),
+                                      'deadline': _API_LATENCY.deadline(query_class)}
+                        for query_class in config.API_CACHE_POLICY}
+    return stats
+
+
+def _fetch_sql_text(key, query_class, function_name, sql_query, outcome='miss'):
+    start_time = time.perf_counter()
+
+    def _load():
+        text = _call_api(function_name, sql_query, query_class,
+                         lambda response, body: body.read().decode(response.encoding or 'utf-8', errors='replace'))
+        _swr_store(key, query_class, text)
+        return text
+
+    try:
+        text, shared = _SINGLE_FLIGHT.do(key, _load)
+    except Exception:
+        _QUERY_METRICS.record(function_name, key[2], time.perf_counter() - start_time, 'error')
+        raise
+    _QUERY_METRICS.record(function_name, key[2], time.perf_counter() - start_time,
+                          'coalesced' if shared else outcome,
+                          response_bytes=0 if shared else len(text.encode('utf-8')))
+    return text
+
+
+def execute_sql_query(function_name, sql_query):
+    """Trả về phản hồi XML thô của API (có cache, stale-while-revalidate như fetch_dataframe)."""
+    canonical_sql = canonicalize_sql(sql_query)
+    key = ('execute_sql_query', function_name, canonical_sql)
+    query_class = _query_class(function_name, canonical_sql)
+    start_time = time.perf_counter()
+    cached = _swr_lookup(key, query_class,
+                         lambda: _fetch_sql_text(key, query_class, function_name, sql_query, 'refresh'))
+    if cached is not None:
+        _QUERY_METRICS.record(function_name, canonical_sql, time.perf_counter() - start_time,
+                              'stale' if cached[2] else 'hit')
+        return cached[0]
+    return _fetch_sql_text(key, query_class, function_name, sql_query)
+
+
+def _local_name(tag):
+    return tag.split('}', 1)[1] if '}' in tag else tag
+
+
+def _column_to_series(name, values, dtype=None):
+    """
+    Chuyển một cột chuỗi thô thành Series, suy luận kiểu giống pd.read_xml:
+    số -> int/float, true/false -> bool, còn lại giữ object; các chuỗi 'NULL', 'nan'... thành NaN.
+    """
+    raw = np.array(values, dtype=object)
+    is_na_string = np.fromiter((v in _NA_STRINGS for v in values if v is not None), dtype=bool)
+    present = np.array([v is not None for v in values], dtype=bool)
+    if is_na_string.any():
+        present_idx = np.flatnonzero(present)
+        raw[present_idx[is_na_string]] = np.nan
+        present[present_idx[is_na_string]] = False
+    series = pd.Series(raw, name=name, dtype=object)
+    if dtype is not None:
+        return series if dtype is str else series.astype(dtype)
+    try:
+        return pd.to_numeric(series)
+    except (ValueError, TypeError):
+        pass
+    non_na = series[present]
+    is_true = non_na.isin(_TRUE_STRINGS)
+    if bool((is_true | non_na.isin(_FALSE_STRINGS)).all()):
+        if present.all():
+            return is_true.rename(name)
+        series[present] = is_true.to_numpy()
+        series[~present] = np.nan
+    return series
+
+
+def _parse_diffgram_stream(stream, dtypes=None):
+    """
+    Đọc dần phản hồi SOAP (luồng byte) bằng lxml.iterparse và gom các dòng diffgr:diffgram/NewDataSet/Table1
+    vào bộ đệm theo cột, giải phóng từng phần tử ngay sau khi đọc.
+    Kết quả tương đương pd.read_xml(xpath=".//diffgr:diffgram/NewDataSet/Table1") nhưng không giữ
+    cả chuỗi XML lẫn cây lxml trong bộ nhớ.
+    """
+    columns = {}
+    local_names = {}
+    row_count = 0
+    for _, elem in etree.iterparse(stream, events=('end',), tag='Table1', huge_tree=True):
+        parent = elem.getparent()
+        if parent is None or parent.tag != 'NewDataSet' or parent.getparent() is None \
+                or parent.getparent().tag != _DIFFGRAM_TAG:
+            continue
+        filled = 0
+        for tag, value in itertools.chain(elem.attrib.items(), ((child.tag, child.text or None) for child in elem)):
+            name = local_names.get(tag)
+            if name is None:
+                if not isinstance(tag, str):
+                    continue
+                name = local_names[tag] = _local_name(tag)
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = [None] * row_count
+            column.append(value)
+            filled += 1
+        row_count += 1
+        if filled != len(columns):
+            for column in columns.values():
+                if len(column) < row_count:
+                    column.append(None)
+        # Giải phóng dòng đã đọc và các dòng trước đó khỏi cây
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+    if row_count == 0:
         return pd.DataFrame()
+    dtypes = dtypes or {}
+    return pd.DataFrame({name: _column_to_series(name, columns.pop(name), dtypes.get(name))
+                         for name in list(columns)})
+
+
+class _CountingReader:
+    """Bọc luồng byte của response để đếm số byte XML đã đọc và thời gian chờ mạng khi đọc."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.raw.read(size)
+        self.read_seconds += time.perf_counter() - start
+        self.bytes_read += len(data)
+        return data
+
+
+def _canonical_literal(kind, text):
+    if kind == 'number':
+        integer, _, fraction = text.partition('.')
+        integer = integer.lstrip('0') or '0'
+        return f"{integer}.{fraction}" if fraction else integer
+    return text
+
+
+def canonicalize_sql(sql_query):
+    """
+    Đưa câu SQL về dạng chuẩn dùng làm khoá cache: bỏ chú thích và khoảng trắng thừa, viết hoa từ khoá,
+    bỏ ngoặc vuông quanh tên đơn giản, chuẩn hoá số và sắp xếp/loại trùng các danh sách IN (...) chỉ gồm hằng.
+    Tên cột giữ nguyên chữ hoa/thường vì tên cột trả về phụ thuộc vào cách viết trong câu lệnh.
+    """
+    tokens = []
+    for match in _SQL_TOKEN_RE.finditer(sql_query):
+        kind, text = match.lastgroup, match.group()
+        if kind in ('comment', 'space'):
+            continue
+        if kind == 'ident':
+            if text.startswith('[') and re.fullmatch(r'\[\w+\]', text):
+                text = text[1:-1]
+            if text.upper() in _SQL_KEYWORDS:
+                text = text.upper()
+        tokens.append((kind, _canonical_literal(kind, text)))
+    while tokens and tokens[-1][1] == ';':
+        tokens.pop()
+
+    output = []
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        output.append(text)
+        i += 1
+        if kind != 'ident' or text != 'IN' or i >= len(tokens) or tokens[i][1] != '(':
+            continue
+        # Thử đọc một danh sách IN chỉ gồm hằng: ( lit , lit , ... )
+        literals, j, is_literal_list = [], i + 1, False
+        while j < len(tokens) and tokens[j][0] in ('string', 'number'):
+            literals.append(tokens[j])
+            j += 1
+            if j < len(tokens) and tokens[j][1] == ',':
+                j += 1
+                continue
+            is_literal_list = j < len(tokens) and tokens[j][1] == ')'
+            break
+        if is_literal_list:
+            output.append('(' + ', '.join(text for _, text in sorted(set(literals))) + ')')
+            i = j + 1
+    return ' '.join(output)
+
+
+def _record_canonical_lookup(sql_query, canonical_sql, hit):
+    """Ghi nhận một lần tra cache để đo số lần hit nhờ chuẩn hoá SQL."""
+    raw_hash = hashlib.sha1(sql_query.encode('utf-8')).hexdigest()
+    canonical_hash = hashlib.sha1(canonical_sql.encode('utf-8')).hexdigest()
+    with _CANONICAL_STATS_LOCK:
+        _CANONICAL_STATS['lookups'] += 1
+        if raw_hash in _CANONICAL_VARIANTS:
+            _CANONICAL_VARIANTS.move_to_end(raw_hash)
+            return
+        if hit:
+            # Câu SQL gốc này chưa gặp (hoặc đã bị loại khỏi bộ nhớ), chỉ hit được nhờ dạng chuẩn hoá
+            _CANONICAL_STATS['canonical_only_hits'] += 1
+        _CANONICAL_VARIANTS[raw_hash] = canonical_hash
+        while len(_CANONICAL_VARIANTS) > config.API_CACHE_CANONICAL_TRACK_LIMIT:
+            _CANONICAL_VARIANTS.popitem(last=False)
+
+
+def get_canonicalization_stats():
+    """Báo cáo mức cải thiện tỉ lệ hit nhờ chuẩn hoá SQL."""
+    with _CANONICAL_STATS_LOCK:
+        stats = dict(_CANONICAL_STATS)
+        stats['distinct_canonical'] = len(set(_CANONICAL_VARIANTS.values()))
+        stats['distinct_raw'] = len(_CANONICAL_VARIANTS)
+    stats['hit_rate_gain'] = stats['canonical_only_hits'] / stats['lookups'] if stats['lookups'] else 0.0
+    return stats
+
+
+_FINGERPRINT_LITERAL_RE = re.compile(r"N?'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_FINGERPRINT_IN_LIST_RE = re.compile(r"\(\?(?:, \?)*\)")
+
+
+def sql_fingerprint(canonical_sql):
+    """Dạng của câu SQL đã chuẩn hoá: mọi hằng thay bằng ?, danh sách hằng (...) gộp thành (?)."""
+    fingerprint = _FINGERPRINT_LITERAL_RE.sub('?', canonical_sql)
+    return _FINGERPRINT_IN_LIST_RE.sub('(?)', fingerprint)
+
+
+def _result_cache_key(function_name, canonical_sql, dtypes):
+    dtype_key = tuple(sorted((col, getattr(dtype, '__name__', str(dtype))) for col, dtype in (dtypes or {}).items()))
+    return ('fetch_dataframe', function_name, canonical_sql, dtype_key)
+
+
+# Phân loại truy vấn cho chính sách cache, chạy trên SQL đã chuẩn hoá (token cách nhau một khoảng trắng)
+_LIVE_SQL_RE = re.compile(r"\bNGAYGIAI IS NULL\b|\bBGW_HD\b", re.IGNORECASE)
+_YEAR_PERIOD_RE = re.compile(r"\bNAM = '?(\d{4})'? AND KY = '?(\d{1,2})'?", re.IGNORECASE)
+_YEAR_BOUND_RE = re.compile(r"\b(?:NAM|YEAR \( [^()]* \)) (?:=|<=|<) '?(\d{4})'?", re.IGNORECASE)
+_PERIOD_BOUND_RE = re.compile(r"\bBETWEEN \d{6} AND (\d{4})(\d{2})\b", re.IGNORECASE)
+_DATE_LITERAL_RE = re.compile(r"'(\d{4})-(\d{2})-(\d{2})")
+_TRANSACTION_TABLE_RE = re.compile(r"\b(?:HoaDon|DocSo)\b", re.IGNORECASE)
+_IN_LIST_RE = re.compile(r"\bIN \( (?:'|\d)")
+# Cột ngày thanh toán (và nhân viên giải, ghi cùng lúc giải): kết quả theo năm/kỳ hoá đơn vẫn đổi khi có thanh toán muộn, chỉ khép lại theo chính ngày thanh toán
+_PAYMENT_COLUMNS = r"(?:\w+ \. )?(?:NGAYGIAI|NgayThanhToan|NgayThu|NV_GIAI)"
+_PAYMENT_COLUMN_RE = re.compile(rf"\b{_PAYMENT_COLUMNS}\b", re.IGNORECASE)
+_PAYMENT_YEAR_BOUND_RE = re.compile(rf"\bYEAR \( {_PAYMENT_COLUMNS} \) (?:=|<=|<) '?(\d{{4}})'?", re.IGNORECASE)
+_PAYMENT_DATE_BOUND_RE = re.compile(
+    rf"(?:CAST \( )?\b{_PAYMENT_COLUMNS} (?:AS DATE \) )?(?:=|<=|<|BETWEEN '[^']*' AND) '(\d{{4}})-(\d{{2}})-(\d{{2}})",
+    re.IGNORECASE)
+_SCOPE_TOKEN_RE = re.compile(r"N?'(?:[^']|'')*'|\(|\)|\bSELECT\b", re.IGNORECASE)
+
+
+def _period_end(year, month=12, day=None):
+    """Ngày cuối của kỳ (năm, tháng) hoặc chính ngày đã cho; None nếu giá trị không hợp lệ."""
+    try:
+        return date(year, month, day or calendar.monthrange(year, month)[1])
+    except ValueError:
+        return None
+
+
+def _time_upper_bounds(canonical_sql):
+    """Các mốc thời gian chặn trên trong điều kiện lọc: Nam/Ky, NAM <= năm, YEAR(...) = năm, kỳ YYYYMM, ngày."""
+    bounds = [_period_end(int(y), int(m)) for y, m in _YEAR_PERIOD_RE.findall(canonical_sql)]
+    remaining = _YEAR_PERIOD_RE.sub(' ', canonical_sql)
+    bounds += [_period_end(int(y)) for y in _YEAR_BOUND_RE.findall(remaining)]
+    bounds += [_period_end(int(y), int(m)) for y, m in _PERIOD_BOUND_RE.findall(remaining)]
+    bounds += [_period_end(int(y), int(m), int(d)) for y, m, d in _DATE_LITERAL_RE.findall(remaining)]
+    return bounds
+
+
+def _payment_upper_bounds(canonical_sql):
+    """Các mốc chặn trên đặt trực tiếp lên cột ngày thanh toán: YEAR(NGAYGIAI) = năm, NGAYGIAI < 'ngày'."""
+    bounds = [_period_end(int(y)) for y in _PAYMENT_YEAR_BOUND_RE.findall(canonical_sql)]
+    bounds += [_period_end(int(y), int(m), int(d)) for y, m, d in _PAYMENT_DATE_BOUND_RE.findall(canonical_sql)]
+    return bounds
+
+
+def _select_scopes(canonical_sql):
+    """Phần riêng của từng SELECT trong câu (CTE, truy vấn con, vế UNION), không gồm các SELECT lồng bên trong."""
+    scopes = []
+    stack = []  # (chỉ số phần, độ sâu ngoặc tại SELECT)
+    outer = []
+    depth = 0
+    position = 0
+    for match in _SCOPE_TOKEN_RE.finditer(canonical_sql):
+        (scopes[stack[-1][0]] if stack else outer).append(canonical_sql[position:match.start()])
+        position = match.start()
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+            while stack and stack[-1][1] > depth:
+                stack.pop()
+        elif token.upper() == 'SELECT':
+            while stack and stack[-1][1] >= depth:
+                stack.pop()
+            scopes.append([])
+            stack.append((len(scopes) - 1, depth))
+    (scopes[stack[-1][0]] if stack else outer).append(canonical_sql[position:])
+    return [''.join(parts) for parts in scopes]
+
+
+def _scope_is_bounded(scope_sql):
+    """SELECT có mốc thời gian chặn trên của riêng nó (và chặn cả ngày thanh toán nếu dùng cột thanh toán)."""
+    if not _time_upper_bounds(scope_sql):
+        return False
+    return not _PAYMENT_COLUMN_RE.search(scope_sql) or bool(_payment_upper_bounds(scope_sql))
+
+
+def _query_class(function_name, canonical_sql):
+    """
+    Nhóm truy vấn dùng để chọn chính sách cache (config.API_CACHE_POLICY), phân loại theo nội dung SQL:
+    - 'live': hoá đơn chưa giải (NGAYGIAI IS NULL) hoặc BGW_HD;
+    - 'history': mọi mốc thời gian chặn trên đều thuộc kỳ đã khép lại (quá API_CACHE_HISTORY_GRACE_DAYS);
+      truy vấn có cột ngày thanh toán (NGAYGIAI, ...) còn phải có mốc chặn trên đặt lên chính ngày thanh toán, vì
+      hoá đơn của năm/kỳ đã qua vẫn có thể được thanh toán muộn; câu có nhiều SELECT (CTE, truy vấn con) thì mỗi
+      SELECT đọc HoaDon/DocSo phải tự có các mốc này, một SELECT không bị chặn đủ đưa cả câu về 'default';
+    - 'reference': danh mục không gắn kỳ (KhachHang, danh sách giá trị DISTINCT cho bộ lọc);
+    - 'default': còn lại.
+    """
+    if _LIVE_SQL_RE.search(canonical_sql):
+        return 'live'
+    bounds = _time_upper_bounds(canonical_sql)
+    if _PAYMENT_COLUMN_RE.search(canonical_sql) and not _payment_upper_bounds(canonical_sql):
+        return 'default'
+    if bounds:
+        closed_before = date.today() - timedelta(days=config.API_CACHE_HISTORY_GRACE_DAYS)
+        if all(bound is not None and bound < closed_before for bound in bounds):
+            scopes = _select_scopes(canonical_sql)
+            if len(scopes) > 1 and not all(_scope_is_bounded(scope) for scope in scopes
+                                           if _TRANSACTION_TABLE_RE.search(scope)):
+                return 'default'
+            return 'history'
+        return 'default'
+    if _IN_LIST_RE.search(canonical_sql):
+        return 'default'
+    if canonical_sql.startswith('SELECT DISTINCT ') or not _TRANSACTION_TABLE_RE.search(canonical_sql):
+        return 'reference'
+    return 'default'
+
+
+def _cache_policy(query_class):
+    return config.API_CACHE_POLICY.get(query_class, config.API_CACHE_POLICY['default'])
+
+
+def _cache_ttl(query_class):
+    return _cache_policy(query_class)['ttl']
+
+
+def _cache_max_stale(query_class):
+    return _cache_policy(query_class)['max_stale']
+
+
+def _cache_for(query_class):
+    """Vùng cache của nhóm truy vấn (thư mục con của api_cache), giới hạn theo size_limit của nhóm."""
+    cache = _CLASS_CACHES.get(query_class)
+    if cache is None:
+        with _CLASS_CACHES_LOCK:
+            cache = _CLASS_CACHES.get(query_class)
+            if cache is None:
+                cache = _CLASS_CACHES[query_class] = diskcache.Cache(
+                    os.path.join(CACHE.directory, f'class_{query_class}'),
+                    size_limit=_cache_policy(query_class)['size_limit'],
+                    eviction_policy=config.API_CACHE_EVICTION_POLICY)
+    return cache
+
+
+def get_cache_usage():
+    """Số mục và dung lượng đang dùng (byte) của từng nhóm cache so với hạn mức."""
+    return {query_class: {'entries': len(_cache_for(query_class)), 'bytes': _cache_for(query_class).volume(),
+                          'size_limit': policy['size_limit']}
+            for query_class, policy in config.API_CACHE_POLICY.items()}
+
+
+def _swr_store(key, query_class, value):
+    """
+    Lưu giá trị kèm thời điểm lưu; mục được giữ thêm max_stale giây sau khi hết hạn để phục vụ bản cũ,
+    và thêm API_CACHE_OUTAGE_GRACE giây nữa chỉ để dùng khi API đang ngắt mạch.
+    """
+    _cache_for(query_class).set(key, (time.time(), value), expire=_cache_ttl(query_class)
+                                + _cache_max_stale(query_class) + config.API_CACHE_OUTAGE_GRACE)
+
+
+def _schedule_refresh(key, refresh):
+    """Làm mới một mục cache ở nền; mỗi khoá chỉ có một lần làm mới đang chạy."""
+    with _REFRESHING_LOCK:
+        if key in _REFRESHING_KEYS:
+            return
+        _REFRESHING_KEYS.add(key)
+
+    def _run():
+        try:
+            refresh()
+            with _RESULT_CACHE_STATS_LOCK:
+                _RESULT_CACHE_STATS['refreshes'] += 1
+        except Exception as e:
+            logging.warning(f"Làm mới cache ở nền thất bại: {e}")
+            with _RESULT_CACHE_STATS_LOCK:
+                _RESULT_CACHE_STATS['refresh_errors'] += 1
+        finally:
+            with _REFRESHING_LOCK:
+                _REFRESHING_KEYS.discard(key)
+
+    _REFRESH_EXECUTOR.submit(_run)
+
+
+def _swr_lookup(key, query_class, refresh):
+    """
+    Tra cache theo chính sách stale-while-revalidate.
+    Trả về (giá trị, tuổi, is_stale) hoặc None nếu không có; mục đã hết hạn vẫn được trả về
+    (is_stale=True) và được lên lịch làm mới ở nền. Khi API đang ngắt mạch, mục quá max_stale
+    cũng được trả về (trong API_CACHE_OUTAGE_GRACE) và không lên lịch làm mới.
+    """
+    entry = _cache_for(query_class).get(key)
+    upstream_down = _API_BREAKER.is_open()
+    if entry is not None and not upstream_down:
+        if time.time() - entry[0] > _cache_ttl(query_class) + _cache_max_stale(query_class):
+            entry = None
+    if entry is None:
+        _CACHE_STATUS.value = {'hit': False, 'stale': False, 'age': None}
+        return None
+    stored_at, value = entry
+    age = time.time() - stored_at
+    is_stale = age > _cache_ttl(query_class)
+    if is_stale and not upstream_down:
+        _schedule_refresh(key, refresh)
+    _CACHE_STATUS.value = {'hit': True, 'stale': is_stale, 'age': age}
+    return value, age, is_stale
+
+
+def get_last_cache_status():
+    """Trạng thái cache của lần gọi API gần nhất trong luồng hiện tại: hit, stale (dữ liệu cũ) và tuổi (giây)."""
+    return dict(getattr(_CACHE_STATUS, 'value', {'hit': False, 'stale': False, 'age': None}))
+
+
+def _serialize_frame(df):
+    """Nén DataFrame sang Parquet (dạng cột, có nén); cột object lẫn kiểu thì lưu bằng pickle."""
+    buffer = io.BytesIO()
+    try:
+        df.to_parquet(buffer, engine='pyarrow', compression=config.API_CACHE_COMPRESSION)
+        return 'parquet', buffer.getvalue()
     except Exception as e:
+        logging.debug(f"Không lưu được Parquet, chuyển sang pickle: {e}")
+        return 'pickle', pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _deserialize_frame(entry):
+    fmt, payload = entry
+    if fmt == 'parquet':
+        df = pd.read_parquet(io.BytesIO(payload), engine='pyarrow')
+        # Parquet đọc ô trống của cột object thành None; đổi lại NaN để kết quả cache giống hệt lúc tải từ API
+        # (ví dụ .astype(str) cho 'nan' chứ không phải 'None')
+        for column in df.columns[df.dtypes == object]:
+            nulls = df[column].isna()
+            if nulls.any():
+                df[column] = df[column].where(~nulls, np.nan)
+        return df
+    return pickle.loads(payload)
+
+
+def _fetch_dataframe_uncached(function_name, sql_query, dtypes=None, query_class='default'):
+    """Gọi API và phân tích phản hồi; trả về (DataFrame, số byte XML đã nhận, số giây phân tích XML)."""
+    def _consume(response, body):
+        reader = _CountingReader(body)
+        start = time.perf_counter()
+        df = _parse_diffgram_stream(reader, dtypes)
+        # Phân tích chạy xen kẽ với việc đọc luồng, nên trừ phần thời gian chờ mạng
+        return df, reader.bytes_read, time.perf_counter() - start - reader.read_seconds
+
+    try:
+        return _call_api(function_name, sql_query, query_class, _consume)
+    except etree.XMLSyntaxError as e:
         raise ValueError(f"Lỗi khi phân tích XML: {e}")
 
 
+def _store_dataframe(key, query_class, function_name, sql_query, dtypes, outcome='miss'):
+    """
+    Tải từ API (gộp các lời gọi trùng đang chạy đồng thời) rồi lưu vào cache.
+    outcome là nhãn ghi vào số liệu truy vấn: 'miss' khi người dùng chờ, 'refresh' khi làm mới ở nền.
+    """
+    canonical_sql = key[2]
+    upstream = {}
+    start_time = time.perf_counter()
+
+    def _load():
+        df, xml_bytes, parse_seconds = _fetch_dataframe_uncached(function_name, sql_query, dtypes, query_class)
+        upstream.update(response_bytes=xml_bytes, parse_seconds=parse_seconds)
+        entry = _serialize_frame(df)
+        _swr_store(key, query_class, entry)
+        with _RESULT_CACHE_STATS_LOCK:
+            _RESULT_CACHE_STATS['xml_bytes'] += xml_bytes
+            _RESULT_CACHE_STATS['stored_bytes'] += len(entry[1])
+            _RESULT_CACHE_STATS[f'{entry[0]}_entries'] += 1
+        return df
+
+    try:
+        df, shared = _SINGLE_FLIGHT.do(key, _load)
+    except Exception:
+        _QUERY_METRICS.record(function_name, canonical_sql, time.perf_counter() - start_time, 'error')
+        raise
+    # Luồng chờ được gộp không tự gọi API nên không ghi số byte/thời gian phân tích của lời gọi chung
+    _QUERY_METRICS.record(function_name, canonical_sql, time.perf_counter() - start_time,
+                          'coalesced' if shared else outcome, rows=len(df), **upstream)
+    # Người gọi thường sửa DataFrame tại chỗ, nên mỗi luồng chờ nhận một bản sao riêng
+    return df.copy() if shared else df
+
+
+def get_single_flight_stats():
+    """Số lời gọi, số lần thực sự gọi upstream và số lời gọi được gộp vào lời gọi đang chạy."""
+    with _SINGLE_FLIGHT._lock:
+        return dict(_SINGLE_FLIGHT.stats)
+
+
+def fetch_dataframe(function_name, sql_query, dtypes=None):
+    """
+    Trả về kết quả truy vấn dạng DataFrame. Kết quả đã phân tích và định kiểu được lưu trong cache
+    dưới dạng Parquet nén, nên lần gọi lặp lại chỉ cần giải nén thay vì tải và phân tích lại XML.
+    Khi mục cache đã hết hạn nhưng còn trong thời gian cũ cho phép, kết quả cũ được trả ngay
+    (df.attrs['cache_stale'] = True) và được làm mới ở nền. Thời gian sống tuỳ nhóm truy vấn (xem _query_class).
+    """
+    canonical_sql = canonicalize_sql(sql_query)
+    key = _result_cache_key(function_name, canonical_sql, dtypes)
+    query_class = _query_class(function_name, canonical_sql)
+    start_time = time.perf_counter()
+    cached = _swr_lookup(key, query_class,
+                         lambda: _store_dataframe(key, query_class, function_name, sql_query, dtypes, 'refresh'))
+    _record_canonical_lookup(sql_query, canonical_sql, cached is not None)
+    if cached is not None:
+        entry, age, is_stale = cached
+        decode_start = time.perf_counter()
+        df = _deserialize_frame(entry)
+        elapsed = time.perf_counter() - start_time
+        with _RESULT_CACHE_STATS_LOCK:
+            _RESULT_CACHE_STATS['hits'] += 1
+            _RESULT_CACHE_STATS['stale_hits'] += int(is_stale)
+            _RESULT_CACHE_STATS['hit_seconds'] += elapsed
+        _QUERY_METRICS.record(function_name, canonical_sql, elapsed, 'stale' if is_stale else 'hit', rows=len(df),
+                              parse_seconds=time.perf_counter() - decode_start)
+        if is_stale:
+            df.attrs['cache_stale'] = True
+            df.attrs['cache_age'] = age
+        return df
+
+    with _RESULT_CACHE_STATS_LOCK:
+        _RESULT_CACHE_STATS['misses'] += 1
+    return _store_dataframe(key, query_class, function_name, sql_query, dtypes)
+
+
+def _fetch_dataframe_fresh(function_name, sql_query, dtypes=None):
+    """Như fetch_dataframe nhưng luôn tải từ API, bỏ qua cache (kết quả vẫn được lưu cho các lần gọi sau)."""
+    canonical_sql = canonicalize_sql(sql_query)
+    key = _result_cache_key(function_name, canonical_sql, dtypes)
+    with _RESULT_CACHE_STATS_LOCK:
+        _RESULT_CACHE_STATS['misses'] += 1
+    return _store_dataframe(key, _query_class(function_name, canonical_sql), function_name, sql_query, dtypes)
+
+
+def get_result_cache_stats():
+    """Thống kê cache kết quả: số lần hit/miss, thời gian hit trung bình và dung lượng tiết kiệm so với XML."""
+    with _RESULT_CACHE_STATS_LOCK:
+        stats = dict(_RESULT_CACHE_STATS)
+    stats['avg_hit_ms'] = stats['hit_seconds'] / stats['hits'] * 1000 if stats['hits'] else 0.0
+    stats['bytes_saved'] = stats['xml_bytes'] - stats['stored_bytes']
+    stats['compression_ratio'] = stats['xml_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else 0.0
+    return stats
+
+
+def get_query_metrics():
+    """Số liệu theo (hàm API, dạng SQL), sắp theo tổng thời gian giảm dần để chọn truy vấn cần tối ưu."""
+    entries = _QUERY_METRICS.snapshot()
+    for entry in entries:
+        count, outcomes = entry['count'], entry['outcomes']
+        entry['avg_wall_seconds'] = entry['wall_seconds'] / count
+        entry['hit_rate'] = (outcomes.get('hit', 0) + outcomes.get('stale', 0) + outcomes.get('coalesced', 0)) / count
+    return sorted(entries, key=lambda e: e['wall_seconds'], reverse=True)
+
+
+def get_slow_queries():
+    """Nhật ký vòng các truy vấn chậm hơn METRICS_SLOW_QUERY_SECONDS, cũ nhất trước."""
+    return _QUERY_METRICS.slow_queries()
+
+
+def reset_query_metrics():
+    _QUERY_METRICS.reset()
+
+
+def export_query_metrics_text():
+    """Xuất số liệu truy vấn dạng văn bản Prometheus (counter theo kết quả cache và histogram)."""
+    histograms = (('latency', 'ghithu_query_duration_seconds', 'wall_seconds', config.METRICS_LATENCY_BUCKETS),
+                  ('bytes', 'ghithu_query_response_bytes', 'response_bytes', config.METRICS_BYTES_BUCKETS),
+                  ('rows', 'ghithu_query_rows', 'rows', config.METRICS_ROWS_BUCKETS))
+    entries = get_query_metrics()
+    lines = ['# TYPE ghithu_query_total counter']
+    for entry in entries:
+        labels = f'function="{entry["function"]}",fingerprint="{entry["fingerprint_id"]}"'
+        for outcome, count in sorted(entry['outcomes'].items()):
+            lines.append(f'ghithu_query_total{{{labels},outcome="{outcome}"}} {count}')
+    lines.append('# TYPE ghithu_query_parse_seconds_total counter')
+    for entry in entries:
+        labels = f'function="{entry["function"]}",fingerprint="{entry["fingerprint_id"]}"'
+        lines.append(f'ghithu_query_parse_seconds_total{{{labels}}} {entry["parse_seconds"]:.6f}')
+    for name, metric, total_key, buckets in histograms:
+        lines.append(f'# TYPE {metric} histogram')
+        for entry in entries:
+            labels = f'function="{entry["function"]}",fingerprint="{entry["fingerprint_id"]}"'
+            counts = entry[f'{name}_hist']
+            for bound, cumulative in zip(list(buckets) + ['+Inf'], itertools.accumulate(counts)):
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{labels}}} {entry[total_key]}')
+            lines.append(f'{metric}_count{{{labels}}} {sum(counts)}')
+    # Ánh xạ mã dạng SQL -> câu SQL dạng mẫu để tra ngược từ nhãn fingerprint
+    lines.append('# TYPE ghithu_query_fingerprint_info gauge')
+    for entry in entries:
+        sql = entry['fingerprint'][:300].replace('\\', '\\\\').replace('"', '\\"')
+        lines.append(f'ghithu_query_fingerprint_info{{fingerprint="{entry["fingerprint_id"]}",sql="{sql}"}} 1')
+    return '\n'.join(lines) + '\n'
+
+
 def _get_gspread_client():
     """Hàm helper để lấy client gspread, ưu tiên secrets."""
     try:
@@ -92,41 +1141,209 @@ def _open_spreadsheet(gc):
         return gc.open(config.SHEET_NAME)
 
 
+def _get_spreadsheet():
+    """Spreadsheet dùng chung; chỉ xác thực service account và mở file ở lần gọi đầu (hoặc sau khi kết nối lại)."""
+    with _SHEETS_LOCK:
+        if _SHEETS_CONN['spreadsheet'] is None:
+            start_time = time.perf_counter()
+            gc = _get_gspread_client()
+            auth_seconds = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            spreadsheet = _open_spreadsheet(gc)
+            open_seconds = time.perf_counter() - start_time
+            _SHEETS_CONN.update(client=gc, spreadsheet=spreadsheet, worksheets={})
+            _SHEETS_STATS['auths'] += 1
+            _SHEETS_STATS['auth_seconds'] += auth_seconds
+            _SHEETS_STATS['opens'] += 1
+            _SHEETS_STATS['open_seconds'] += open_seconds
+            logging.info(f"Kết nối Google Sheet: xác thực {auth_seconds:.2f}s, mở spreadsheet {open_seconds:.2f}s.")
+        return _SHEETS_CONN['spreadsheet']
+
+
+def _get_worksheet(worksheet_name):
+    """Worksheet theo tên, handle được giữ lại cho các lần gọi sau."""
+    with _SHEETS_LOCK:
+        spreadsheet = _get_spreadsheet()
+        worksheet = _SHEETS_CONN['worksheets'].get(worksheet_name)
+        if worksheet is not None:
+            _SHEETS_STATS['reuses'] += 1
+            return worksheet
+        start_time = time.perf_counter()
+        worksheet = _SHEETS_CONN['worksheets'][worksheet_name] = spreadsheet.worksheet(worksheet_name)
+        _SHEETS_STATS['worksheet_opens'] += 1
+        _SHEETS_STATS['worksheet_seconds'] += time.perf_counter() - start_time
+        return worksheet
+
+
+def reset_sheets_connection():
+    """Bỏ client/spreadsheet/worksheet đã cache; lần gọi tiếp theo sẽ xác thực và mở lại."""
+    with _SHEETS_LOCK:
+        _SHEETS_CONN.update(client=None, spreadsheet=None, worksheets={})
+
+
+def _sheets_call(worksheet_name, operation):
+    """
+    Chạy operation(worksheet) trên handle đã cache, hoặc operation(spreadsheet) khi worksheet_name là None.
+    Token hết hạn được google-auth tự làm mới; nếu vẫn bị từ chối (401, làm mới token thất bại)
+    hoặc worksheet không còn tồn tại, kết nối lại từ đầu và thử thêm một lần.
+    """
+    def _target():
+        return _get_spreadsheet() if worksheet_name is None else _get_worksheet(worksheet_name)
+
+    try:
+        return operation(_target())
+    except (gspread.exceptions.APIError, gspread.exceptions.WorksheetNotFound, RefreshError) as e:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        if isinstance(e, gspread.exceptions.APIError) and status not in (401, 404):
+            raise
+        logging.warning(f"Kết nối Google Sheet không còn hợp lệ ({e}), đang kết nối lại...")
+        reset_sheets_connection()
+        with _SHEETS_LOCK:
+            _SHEETS_STATS['reconnects'] += 1
+        return operation(_target())
+
+
+def get_sheets_connection_stats():
+    """Số lần xác thực/mở spreadsheet/mở worksheet và tổng thời gian (giây), số lần dùng lại handle, số lần kết nối lại."""
+    with _SHEETS_LOCK:
+        return dict(_SHEETS_STATS)
+
+
+def _frame_from_values(values, dtype=None):
+    """
+    DataFrame dựng thẳng từ ma trận giá trị của Sheets (dòng đầu là tiêu đề), cho cùng kết quả với
+    pd.DataFrame(worksheet.get_all_records()) nhưng không tạo dict cho từng dòng.
+    dtype=object giữ nguyên giá trị từng ô (không suy kiểu cột), dùng khi chỉ dựng một phần của sheet.
+    """
+    if not values or values == [[]]:
+        return pd.DataFrame()
+    width = max(len(row) for row in values)
+    header = list(values[0]) + [''] * (width - len(values[0]))
+    duplicates = [name for name, count in Counter(header).items() if count > 1]
+    if duplicates:
+        raise gspread.exceptions.GSpreadException(f"Dòng tiêu đề của worksheet bị trùng cột: {duplicates}")
+    rows = values[1:]
+    if not rows:
+        return pd.DataFrame()
+    columns = {}
+    for i, name in enumerate(header):
+        raw = [row[i] if i < len(row) else '' for row in rows]
+        # Các cột của sheet lặp lại nhiều (ngày, nhóm, kỳ): chỉ chuyển kiểu mỗi giá trị khác nhau một lần
+        converted = {value: gspread.utils.numericise(value) for value in set(raw)}
+        columns[name] = [converted[value] for value in raw]
+    return pd.DataFrame(columns, dtype=dtype)
+
+
+def _sheet_range(item):
+    return gspread.utils.absolute_range_name(*item) if isinstance(item, tuple) else gspread.utils.absolute_range_name(item)
+
+
+def fetch_sheet_values(ranges):
+    """
+    Đọc nhiều vùng trong một yêu cầu values.batchGet, trả về ma trận giá trị (dạng hiển thị) của từng vùng.
+    Mỗi phần tử là tên worksheet hoặc cặp (tên worksheet, vùng A1).
+    """
+    response = _sheets_call(None, lambda spreadsheet: spreadsheet.values_batch_get([_sheet_range(r) for r in ranges]))
+    return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+
+def fetch_worksheets_as_dfs(worksheet_names):
+    """
+    Đọc nhiều worksheet (hoặc vùng) trong một yêu cầu values.batchGet.
+    Mỗi phần tử là tên worksheet hoặc cặp (tên worksheet, vùng A1); trả về dict phần tử -> DataFrame.
+    """
+    start_time = time.perf_counter()
+    frames = {item: _frame_from_values(values) for item, values in zip(worksheet_names, fetch_sheet_values(worksheet_names))}
+    logging.info(f"Đọc {len(frames)} vùng trong một lần gọi ({time.perf_counter() - start_time:.2f}s): "
+                 + ", ".join(f"'{item}' {len(df)} dòng" for item, df in frames.items()))
+    return frames
+
+
 # === SỬA LẠI CÁC HÀM ĐỌC/GHI SHEET ===
 def fetch_worksheet_as_df(worksheet_name):
     try:
         logging.info(f"Đang đọc dữ liệu từ Google Sheet, worksheet: '{worksheet_name}'...")
-        gc = _get_gspread_client()
-        spreadsheet = _open_spreadsheet(gc)
-        worksheet = spreadsheet.worksheet(worksheet_name)
-        records = worksheet.get_all_records()
-        logging.info(f"✅ Đọc thành công {len(records)} dòng từ worksheet '{worksheet_name}'.")
-        return pd.DataFrame(records)
+        df = fetch_worksheets_as_dfs([worksheet_name])[worksheet_name]
+        logging.info(f"✅ Đọc thành công {len(df)} dòng từ worksheet '{worksheet_name}'.")
+        return df
     except Exception as e:
         logging.error(f"Lỗi khi đọc worksheet '{worksheet_name}': {e}", exc_info=True)
         raise ConnectionError(
             f"Lỗi: Không tìm thấy hoặc không thể đọc worksheet '{worksheet_name}'. Vui lòng kiểm tra file log.")
 
 
-def append_df_to_worksheet(df_to_append, worksheet_name):
+def _column_letter(column_index):
+    return gspread.utils.rowcol_to_a1(1, column_index)[:-1]
+
+
+def _is_retryable_sheet_error(e):
+    if isinstance(e, requests.exceptions.RequestException):
+        return True
+    return (isinstance(e, gspread.exceptions.APIError)
+            and getattr(e.response, 'status_code', None) in _RETRYABLE_SHEET_STATUS)
+
+
+def _append_rows_idempotent(worksheet_name, rows, key_indexes):
+    """
+    Nối rows vào cuối bảng (từ cột B) bằng values.append: chi phí không phụ thuộc số dòng đã có.
+    Khi lỗi tạm thời, không biết lần ghi trước đã vào hay chưa, nên trước khi thử lại chỉ đọc các cột khoá
+    (key_indexes, khoá là bộ giá trị của các cột này) từ watermark (dòng cuối đã biết) trở xuống
+    và bỏ các dòng có khoá đã xuất hiện.
+    """
+    first_index, last_index = min(key_indexes), max(key_indexes)
+    key_range = (f'{_column_letter(_APPEND_START_COLUMN + first_index)}{{}}:'
+                 f'{_column_letter(_APPEND_START_COLUMN + last_index)}')
+
+    def _row_key(row, offset=0):
+        return tuple(row[i - offset] if i - offset < len(row) else '' for i in key_indexes)
+
+    table_range = f'{_column_letter(_APPEND_START_COLUMN)}1'
+    with _APPEND_LOCK:
+        watermark = _APPEND_WATERMARKS.get(worksheet_name, 1)
+    pending = rows
+    for attempt in range(config.SHEET_APPEND_RETRIES + 1):
+        try:
+            if attempt:
+                existing = _sheets_call(worksheet_name,
+                                        lambda worksheet: worksheet.get(key_range.format(watermark)))
+                # Dòng watermark là dữ liệu cũ đã có trước lần ghi này
+                existing_keys = {_row_key(row, first_index) for row in existing[1:] if row}
+                pending = [row for row in rows if _row_key(row) not in existing_keys]
+                if not pending:
+                    logging.info("Lần ghi trước đã vào sheet, bỏ qua lần thử lại.")
+                    return len(rows)
+            response = _sheets_call(worksheet_name, lambda worksheet: worksheet.append_rows(
+                pending, value_input_option='USER_ENTERED', table_range=table_range))
+            updated_range = response['updates']['updatedRange']
+            last_row = gspread.utils.a1_to_rowcol(updated_range.split('!')[-1].split(':')[-1])[0]
+            with _APPEND_LOCK:
+                _APPEND_WATERMARKS[worksheet_name] = max(last_row, _APPEND_WATERMARKS.get(worksheet_name, 1))
+            return len(rows)
+        except Exception as e:
+            if attempt == config.SHEET_APPEND_RETRIES or not _is_retryable_sheet_error(e):
+                raise
+            delay = config.SHEET_APPEND_BACKOFF * 2 ** attempt
+            logging.warning(f"Ghi worksheet '{worksheet_name}' lỗi ({e}), thử lại sau {delay}s...")
+            time.sleep(delay)
+
+
+def append_df_to_worksheet(df_to_append, worksheet_name, key_columns=('ID', 'nhom')):
+    """
+    Ghi thêm các dòng xuống worksheet theo thứ tự DB_SHEET_FINAL_COLUMNS, bắt đầu từ cột B.
+    key_columns là các cột định danh dùng để chống ghi trùng khi phải thử lại (ID = danh bạ + ngày gửi,
+    nên phải kèm nhóm: cùng danh bạ có thể được giao cho hai nhóm trong cùng một ngày).
+    """
     if df_to_append.empty:
         return 0, "Không có dữ liệu để gửi."
     try:
         logging.info(f"Chuẩn bị ghi {len(df_to_append)} dòng xuống worksheet '{worksheet_name}'...")
-        gc = _get_gspread_client()
-        spreadsheet = _open_spreadsheet(gc)
-        worksheet = spreadsheet.worksheet(worksheet_name)
-
-        # Phần còn lại giữ nguyên
-        existing_data = worksheet.get_all_values()
-        next_row_index = len(existing_data) + 1
-        worksheet.add_rows(len(df_to_append))
+        start_time = time.perf_counter()
         final_df = df_to_append.reindex(columns=config.DB_SHEET_FINAL_COLUMNS)
         rows_to_append = final_df.astype(str).values.tolist()
-        start_cell = f'B{next_row_index}'
-        worksheet.update(start_cell, rows_to_append, value_input_option='USER_ENTERED')
-        logging.info(f"✅ Ghi thành công {len(rows_to_append)} dòng mới.")
-        return len(rows_to_append), f"Gửi thành công {len(rows_to_append)} khách hàng."
+        written = _append_rows_idempotent(worksheet_name, rows_to_append,
+                                          [config.DB_SHEET_FINAL_COLUMNS.index(col) for col in key_columns])
+        logging.info(f"✅ Ghi thành công {written} dòng mới ({time.perf_counter() - start_time:.2f}s).")
+        return written, f"Gửi thành công {written} khách hàng."
     except Exception as e:
         logging.error(f"Lỗi khi ghi dữ liệu xuống worksheet '{worksheet_name}': {e}", exc_info=True)
         return 0, f"Lỗi khi gửi dữ liệu: {e}\n\nXem chi tiết trong app_log.txt"
@@ -134,66 +1351,571 @@ def append_df_to_worksheet(df_to_append, worksheet_name):
 
 # ... các hàm còn lại giữ nguyên ...
 def get_sheet_data_for_report():
-    db_df = fetch_worksheet_as_df(config.DB_SHEET)
-    on_off_df = fetch_worksheet_as_df(config.ON_OFF_SHEET)
-    return db_df, on_off_df
+    try:
+        frames = fetch_worksheets_as_dfs([config.DB_SHEET, config.ON_OFF_SHEET])
+    except Exception as e:
+        logging.error(f"Lỗi khi đọc worksheet '{config.DB_SHEET}' và '{config.ON_OFF_SHEET}': {e}", exc_info=True)
+        raise ConnectionError("Lỗi: Không thể đọc dữ liệu báo cáo từ Google Sheet. Vui lòng kiểm tra file log.")
+    return frames[config.DB_SHEET], frames[config.ON_OFF_SHEET]
+
+
+_UNPAID_COLUMNS = [config.API_COL_DANHBA, config.API_COL_SOHOADON, config.API_COL_KY, config.API_COL_NAM,
+                   config.API_COL_TONGCONG, 'GB', 'DOT', 'TENKH', 'SO', 'DUONG']
+_UNPAID_DTYPES = {config.API_COL_DANHBA: str, config.API_COL_SOHOADON: str, 'DOT': str, 'TENKH': str, 'SO': str,
+                  'DUONG': str}
+
+
+class _BgwPaidIndex:
+    """
+    Chỉ mục các hoá đơn đã thanh toán qua BGW_HD theo khoá số (keys.INVOICE_KEY): mảng NumPy đã sắp xếp các khoá
+    đã thanh toán, và mảng các khoá đã tra (biết chắc có/không trong BGW_HD). Tra hàng loạt bằng np.searchsorted;
+    chỉ các khoá chưa từng tra mới được hỏi BGW_HD theo khối IN-list, còn thanh toán mới được nạp bằng truy vấn
+    theo NgayThanhToan kể từ lần đồng bộ trước (sync). Lưu trong api_cache nên dùng chung giữa các phiên và
+    tiến trình; sau BGW_INDEX_RECHECK_INTERVAL chỉ mục được bỏ để tra lại từ đầu (bắt thanh toán nhập lùi ngày, huỷ).
+    Mỗi lần tra (flags) tự đồng bộ lại nếu lần đồng bộ trước đã cũ hơn TTL của nhóm truy vấn 'live'. Truy vấn BGW_HD
+    chạy ngoài _lock (chỉ ghép kết quả vào mảng khi giữ khoá), nên các lần tra khác không phải chờ mạng.
+    """
+    _CACHE_KEY = ('bgw_paid_index', 3)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # Chỉ một lần đồng bộ chạy cùng lúc
+        self._loaded = False
+        self._clear(time.time())
+        self.stats = {'lookups': 0, 'lookup_rows': 0, 'fetched_keys': 0, 'syncs': 0, 'synced_keys': 0, 'rebuilds': 0}
+
+    def _clear(self, now):
+        self._paid = np.array([], dtype=np.int64)
+        self._checked = np.array([], dtype=np.int64)
+        self._built_at = now
+        self._synced_on = date.fromtimestamp(now)  # Trạng thái của mọi khoá đã tra đúng tính đến ngày này
+        self._synced_at = now
+
+    @staticmethod
+    def _contains(sorted_keys, values):
+        if len(sorted_keys) == 0:
+            return np.zeros(len(values), dtype=bool)
+        positions = np.minimum(np.searchsorted(sorted_keys, values), len(sorted_keys) - 1)
+        return sorted_keys[positions] == values
+
+    def _ensure_current(self):
+        now = time.time()
+        if not self._loaded:
+            self._loaded = True
+            entry = CACHE.get(self._CACHE_KEY)
+            if entry is not None:
+                self._built_at, self._synced_on, self._synced_at, self._paid, self._checked = entry
+        if now - self._built_at > config.BGW_INDEX_RECHECK_INTERVAL:
+            self._clear(now)
+            self.stats['rebuilds'] += 1
+
+    def _save(self):
+        CACHE.set(self._CACHE_KEY, (self._built_at, self._synced_on, self._synced_at, self._paid, self._checked),
+                  expire=config.BGW_INDEX_RECHECK_INTERVAL)
+
+    def _merge(self, paid, checked):
+        """Ghép các khoá vừa tra được vào chỉ mục (gọi khi đang giữ _lock)."""
+        self._paid = np.union1d(self._paid, paid)
+        self._checked = np.union1d(self._checked, np.union1d(checked, paid))
+
+    def sync(self, max_age=None):
+        """
+        Nạp các SHDon có NgayThanhToan từ lần đồng bộ trước (lùi UNPAID_SNAPSHOT_LOOKBACK_DAYS ngày).
+        max_age: bỏ qua nếu lần đồng bộ trước chưa cũ hơn số giây này.
+        """
+        with self._sync_lock:
+            with self._lock:
+                self._ensure_current()
+                now = time.time()
+                if max_age is not None and now - self._synced_at < max_age:
+                    return
+                if len(self._checked) == 0:
+                    self._synced_on, self._synced_at = date.fromtimestamp(now), now
+                    return
+                since = (self._synced_on - timedelta(days=config.UNPAID_SNAPSHOT_LOOKBACK_DAYS)).isoformat()
+            sql_bgw = (f"SELECT {config.API_COL_SHDON_BGW} FROM BGW_HD "
+                       f"WHERE {config.API_COL_NGAYTT_BGW} >= '{since}'")
+            df_bgw = _fetch_dataframe_fresh('f_Select_SQL_Nganhang', sql_bgw, dtypes={config.API_COL_SHDON_BGW: str})
+            paid = np.array([], dtype=np.int64)
+            if not df_bgw.empty:
+                paid = keys.encode_invoice_keys(df_bgw[config.API_COL_SHDON_BGW])
+                paid = paid[paid != keys.MISSING_KEY]
+            with self._lock:
+                self._merge(paid, paid)
+                self._synced_on, self._synced_at = date.fromtimestamp(now), now
+                self.stats['synced_keys'] += len(paid)
+                self.stats['syncs'] += 1
+                self._save()
+
+    def flags(self, sohoadon, invoice_keys):
+        """Cờ đã thanh toán qua BGW_HD của từng hoá đơn (Series cùng index với sohoadon); tra BGW_HD các khoá mới."""
+        invoice_keys = np.asarray(invoice_keys, dtype=np.int64)
+        valid = sohoadon.notna().to_numpy() & (invoice_keys != keys.MISSING_KEY)
+        self.sync(max_age=config.API_CACHE_POLICY['live']['ttl'])
+        while True:
+            with self._lock:
+                self._ensure_current()
+                unknown = valid & ~self._contains(self._checked, invoice_keys)
+                if not unknown.any():  # Lặp lại nếu chỉ mục vừa bị dựng lại trong lúc đang tra BGW_HD
+                    self.stats['lookups'] += 1
+                    self.stats['lookup_rows'] += len(invoice_keys)
+                    return pd.Series(valid & self._contains(self._paid, invoice_keys), index=sohoadon.index)
+            found = np.array([], dtype=np.int64)
+            df_bgw = _get_bgw_invoices(sohoadon[unknown].unique().tolist(), fresh=True,
+                                       dtypes={config.API_COL_SHDON_BGW: str})
+            if not df_bgw.empty:
+                found = keys.encode_invoice_keys(df_bgw[config.API_COL_SHDON_BGW])
+                found = found[found != keys.MISSING_KEY]
+            with self._lock:
+                self._merge(found, invoice_keys[unknown])
+                self.stats['fetched_keys'] += int(unknown.sum())
+                self._save()
+
+    def reset(self):
+        with self._lock:
+            self._clear(time.time())
+            self._loaded = True
+            CACHE.delete(self._CACHE_KEY)
+
+
+_BGW_PAID_INDEX = _BgwPaidIndex()
+
+
+class _UnpaidSnapshot:
+    """
+    Ảnh chụp dùng chung cho cả tiến trình các hoá đơn chưa giải (NGAYGIAI IS NULL), kèm cờ BGW_PAID
+    (đã có thanh toán trong BGW_HD). Dựng một lần, sau đó chỉ cập nhật phần thay đổi: tải lại các kỳ từ kỳ
+    mới nhất trở đi, bỏ các hoá đơn vừa được giải và đánh dấu các hoá đơn vừa có trong BGW_HD.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self._built_at = 0.0
+        self._refreshed_at = 0.0
+        self._refreshed_on = None  # Ngày của lần cập nhật gần nhất, làm mốc tìm hoá đơn vừa giải / vừa có BGW
+        self.stats = {'full_builds': 0, 'incremental_refreshes': 0, 'refresh_errors': 0, 'reloaded_rows': 0,
+                      'paid_rows': 0, 'bgw_flagged': 0, 'build_seconds': 0.0, 'refresh_seconds': 0.0}
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            try:
+                if self._frame is None or now - self._built_at > config.UNPAID_SNAPSHOT_FULL_REBUILD_INTERVAL:
+                    self._build(now)
+                elif now - self._refreshed_at > config.UNPAID_SNAPSHOT_REFRESH_INTERVAL:
+                    self._refresh(now)
+            except Exception as e:
+                if self._frame is None:
+                    raise
+                self.stats['refresh_errors'] += 1
+                logging.warning(f"Không cập nhật được ảnh chụp hoá đơn chưa giải ({e}), dùng ảnh chụp hiện có.")
+            return self._frame
+
+    def reset(self):
+        with self._lock:
+            self._frame = None
+
+    @staticmethod
+    def _with_keys(frame):
+        """Thêm khoá số của danh bạ và số hoá đơn (backend/keys.py), tính một lần lúc nạp."""
+        frame[keys.CUSTOMER_KEY] = keys.encode_keys(frame[config.API_COL_DANHBA])
+        frame[keys.INVOICE_KEY] = keys.encode_invoice_keys(frame[config.API_COL_SOHOADON])
+        return frame
+
+    @staticmethod
+    def _bgw_flags(frame):
+        """Cờ đã thanh toán qua BGW_HD, tra trong chỉ mục dùng chung _BGW_PAID_INDEX."""
+        return _BGW_PAID_INDEX.flags(frame[config.API_COL_SOHOADON], frame[keys.INVOICE_KEY])
+
+    def _build(self, now):
+        start_time = time.perf_counter()
+        sql = f"SELECT {', '.join(_UNPAID_COLUMNS)} FROM HoaDon WHERE {config.API_COL_NGAYGIAI} IS NULL"
+        frame = _fetch_dataframe_fresh('f_Select_SQL_Thutien', sql, dtypes=_UNPAID_DTYPES)
+        frame = self._with_keys(frame.reindex(columns=_UNPAID_COLUMNS))
+        _BGW_PAID_INDEX.sync()
+        frame['BGW_PAID'] = self._bgw_flags(frame)
+        self._frame, self._built_at, self._refreshed_at = frame, now, now
+        self._refreshed_on = date.fromtimestamp(now)
+        elapsed = time.perf_counter() - start_time
+        self.stats['full_builds'] += 1
+        self.stats['build_seconds'] += elapsed
+        logging.info(f"Dựng ảnh chụp hoá đơn chưa giải: {len(frame)} hoá đơn "
+                     f"({int(frame['BGW_PAID'].sum())} đã có BGW), {elapsed:.2f}s.")
+
+    def _refresh(self, now):
+        frame = self._frame
+        period = (pd.to_numeric(frame[config.API_COL_NAM], errors='coerce') * 100
+                  + pd.to_numeric(frame[config.API_COL_KY], errors='coerce'))
+        if period.notna().sum() == 0:
+            self._build(now)
+            return
+        start_time = time.perf_counter()
+        latest = int(period.max())
+        year, month = divmod(latest, 100)
+        since = (self._refreshed_on - timedelta(days=config.UNPAID_SNAPSHOT_LOOKBACK_DAYS)).isoformat()
+
+        # Hoá đơn kỳ mới nhất trở đi (kỳ đang thu có thể còn được bổ sung hoá đơn)
+        sql_new = (f"SELECT {', '.join(_UNPAID_COLUMNS)} FROM HoaDon WHERE {config.API_COL_NGAYGIAI} IS NULL "
+                   f"AND ({config.API_COL_NAM} > {year} OR ({config.API_COL_NAM} = {year} "
+                   f"AND {config.API_COL_KY} >= {month}))")
+        df_new = _fetch_dataframe_fresh('f_Select_SQL_Thutien', sql_new, dtypes=_UNPAID_DTYPES)
+        # Hoá đơn vừa được giải kể từ lần cập nhật trước; SHDon vừa có thanh toán qua ngân hàng được nạp vào chỉ mục
+        sql_paid = (f"SELECT {config.API_COL_SOHOADON} FROM HoaDon "
+                    f"WHERE {config.API_COL_NGAYGIAI} >= '{since}'")
+        df_paid = _fetch_dataframe_fresh('f_Select_SQL_Thutien', sql_paid, dtypes={config.API_COL_SOHOADON: str})
+        _BGW_PAID_INDEX.sync()
+
+        kept = frame[~(period >= latest)].copy()
+        if not df_new.empty:
+            df_new = self._with_keys(df_new.reindex(columns=_UNPAID_COLUMNS))
+            df_new['BGW_PAID'] = self._bgw_flags(df_new)
+            kept = pd.concat([kept, df_new], ignore_index=True)
+        paid = kept[keys.INVOICE_KEY].isin(keys.encode_invoice_keys(df_paid[config.API_COL_SOHOADON])) if not df_paid.empty \
+            else pd.Series(False, index=kept.index)
+        newly_bgw = self._bgw_flags(kept) & ~kept['BGW_PAID']
+        kept.loc[newly_bgw, 'BGW_PAID'] = True
+        frame = kept[~paid].reset_index(drop=True)
+
+        self._frame, self._refreshed_at = frame, now
+        self._refreshed_on = date.fromtimestamp(now)
+        elapsed = time.perf_counter() - start_time
+        self.stats['incremental_refreshes'] += 1
+        self.stats['reloaded_rows'] += len(df_new)
+        self.stats['paid_rows'] += int(paid.sum())
+        self.stats['bgw_flagged'] += int(newly_bgw.sum())
+        self.stats['refresh_seconds'] += elapsed
+        logging.info(f"Cập nhật ảnh chụp hoá đơn chưa giải: tải lại {len(df_new)} hoá đơn từ kỳ {month:02d}/{year}, "
+                     f"bỏ {int(paid.sum())} vừa giải, đánh dấu {int(newly_bgw.sum())} vừa có BGW, {elapsed:.2f}s.")
+
+
+_UNPAID_SNAPSHOT = _UnpaidSnapshot()
+
+
+def get_unpaid_invoices(columns=None, include_bgw_paid=False):
+    """
+    Hoá đơn chưa giải từ ảnh chụp dùng chung (bản sao riêng, người gọi được sửa tại chỗ), gồm các cột
+    DANHBA, SOHOADON, KY, NAM, TONGCONG, GB, DOT, TENKH, SO, DUONG (hoặc `columns`, có thể gồm cả các khoá số
+    keys.CUSTOMER_KEY / keys.INVOICE_KEY).
+    Mặc định bỏ các hoá đơn đã thanh toán qua ngân hàng (có trong BGW_HD); khi include_bgw_paid=True thì
+    giữ lại và thêm cột BGW_PAID.
+    """
+    frame = _UNPAID_SNAPSHOT.get()
+    columns = list(columns or _UNPAID_COLUMNS)
+    if include_bgw_paid:
+        return frame[columns + ['BGW_PAID']].copy()
+    return frame.loc[~frame['BGW_PAID'], columns].reset_index(drop=True)
+
+
+def bgw_paid_mask(sohoadon):
+    """Cờ đã thanh toán qua BGW_HD của từng số hoá đơn (Series cùng index), tra trong chỉ mục dùng chung."""
+    sohoadon = pd.Series(sohoadon)
+    return _BGW_PAID_INDEX.flags(sohoadon, keys.encode_invoice_keys(sohoadon))
+
+
+def reset_bgw_paid_index():
+    """Bỏ chỉ mục hoá đơn đã có BGW (cả bản lưu trong api_cache); lần tra sau sẽ hỏi lại BGW_HD."""
+    _BGW_PAID_INDEX.reset()
+
+
+def get_bgw_paid_index_stats():
+    """Số lần tra/đồng bộ, số khoá phải hỏi BGW_HD và kích thước chỉ mục hoá đơn đã có BGW."""
+    with _BGW_PAID_INDEX._lock:
+        stats = dict(_BGW_PAID_INDEX.stats)
+        stats['paid_keys'] = len(_BGW_PAID_INDEX._paid)
+        stats['checked_keys'] = len(_BGW_PAID_INDEX._checked)
+        stats['synced_on'] = _BGW_PAID_INDEX._synced_on.isoformat()
+        stats['age_seconds'] = time.time() - _BGW_PAID_INDEX._built_at
+    return stats
+
+
+def refresh_unpaid_snapshot(full=False):
+    """Cập nhật ngay ảnh chụp hoá đơn chưa giải (full=True: dựng lại toàn bộ), không chờ hết hạn."""
+    if full:
+        _UNPAID_SNAPSHOT.reset()
+    else:
+        with _UNPAID_SNAPSHOT._lock:
+            _UNPAID_SNAPSHOT._refreshed_at = 0.0
+    _UNPAID_SNAPSHOT.get()
+
+
+def reset_unpaid_snapshot():
+    """Bỏ ảnh chụp (và hồ sơ nợ dựng từ nó) trong bộ nhớ; lần đọc sau sẽ dựng lại từ đầu."""
+    _UNPAID_SNAPSHOT.reset()
+    with _DEBT_PROFILE_LOCK:
+        _DEBT_PROFILE['frame'] = _DEBT_PROFILE['profile'] = None
+
+
+def is_unpaid_snapshot_loaded():
+    """Ảnh chụp hoá đơn chưa giải đã có trong bộ nhớ của tiến trình chưa."""
+    return _UNPAID_SNAPSHOT._frame is not None
+
+
+def _unpaid_filter_sql(nam, dot_filter=None):
+    conditions = [f"{config.API_COL_NGAYGIAI} IS NULL", f"{config.API_COL_NAM} <= {int(nam)}"]
+    if dot_filter:
+        conditions.append(f"DOT IN ({', '.join(str(int(dot)) for dot in dot_filter)})")
+    return ' AND '.join(conditions)
+
+
+def fetch_unpaid_debtor_totals(nam, dot_filter=None, min_invoices=1, min_total=0):
+    """
+    Gom nhóm ngay trên máy chủ các hoá đơn chưa giải đến năm `nam` (và các đợt dot_filter) theo danh bạ:
+    DANHBA, SOHD (số hoá đơn) và TONGDUONG (tổng các khoản TONGCONG dương), chỉ giữ danh bạ có SOHD >= min_invoices
+    và TONGDUONG >= min_total, sắp TONGDUONG giảm dần. Chưa bỏ hoá đơn đã có BGW, nên SOHD/TONGDUONG là cận trên
+    của số hoá đơn/tổng tiền của mọi nhóm con của danh bạ sau khi lọc ở máy khách.
+    """
+    positive = f"SUM(CASE WHEN {config.API_COL_TONGCONG} > 0 THEN {config.API_COL_TONGCONG} ELSE 0 END)"
+    sql = (f"SELECT {config.API_COL_DANHBA}, COUNT(*) AS SOHD, {positive} AS TONGDUONG FROM HoaDon "
+           f"WHERE {_unpaid_filter_sql(nam, dot_filter)} GROUP BY {config.API_COL_DANHBA} "
+           f"HAVING COUNT(*) >= {int(min_invoices)} AND {positive} >= {float(min_total)} ORDER BY TONGDUONG DESC")
+    df = fetch_dataframe('f_Select_SQL_Thutien', sql, dtypes={config.API_COL_DANHBA: str})
+    if df.empty:
+        return pd.DataFrame(columns=[config.API_COL_DANHBA, 'SOHD', 'TONGDUONG'])
+    df['TONGDUONG'] = pd.to_numeric(df['TONGDUONG'], errors='coerce').fillna(0)
+    return df.sort_values('TONGDUONG', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def fetch_unpaid_invoices_for(danhba_list, nam, dot_filter=None):
+    """
+    Hoá đơn chưa giải (cùng các cột như get_unpaid_invoices, kèm keys.CUSTOMER_KEY) của các danh bạ đã cho,
+    theo khối IN-list; hoá đơn đã có BGW được bỏ sau khi tra lại trong chỉ mục _BGW_PAID_INDEX.
+    """
+    columns = _UNPAID_COLUMNS + [keys.CUSTOMER_KEY]
+    if not danhba_list:
+        return pd.DataFrame(columns=columns)
+    where = _unpaid_filter_sql(nam, dot_filter)
+
+    def build_sql(chunk):
+        formatted_chunk_list = "', '".join(map(str, chunk))
+        return (f"SELECT {', '.join(_UNPAID_COLUMNS)} FROM HoaDon "
+                f"WHERE {where} AND {config.API_COL_DANHBA} IN ('{formatted_chunk_list}')")
+
+    frames = _run_chunked_lookup('f_Select_SQL_Thutien', danhba_list, build_sql, dtypes=_UNPAID_DTYPES)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True).reindex(columns=_UNPAID_COLUMNS)
+    df[keys.CUSTOMER_KEY] = keys.encode_keys(df[config.API_COL_DANHBA])
+    return df[~bgw_paid_mask(df[config.API_COL_SOHOADON]).to_numpy()].reset_index(drop=True)
+
+
+def get_unpaid_snapshot_stats():
+    """Số lần dựng/cập nhật ảnh chụp, số hoá đơn thêm/bỏ/đánh dấu BGW và kích thước hiện tại."""
+    with _UNPAID_SNAPSHOT._lock:
+        stats = dict(_UNPAID_SNAPSHOT.stats)
+        frame = _UNPAID_SNAPSHOT._frame
+        stats['rows'] = 0 if frame is None else len(frame)
+        stats['bgw_paid_rows'] = 0 if frame is None else int(frame['BGW_PAID'].sum())
+        stats['age_seconds'] = None if frame is None else time.time() - _UNPAID_SNAPSHOT._refreshed_at
+    return stats
+
+
+_DEBT_PROFILE_LOCK = threading.Lock()
+_DEBT_PROFILE = {'frame': None, 'profile': None}  # Hồ sơ nợ dựng từ đúng đối tượng ảnh chụp đang giữ
+
+
+def fetch_unpaid_debt_profile():
+    """
+    Hồ sơ nợ theo khoá danh bạ (aggregation.DebtProfile trên keys.CUSTOMER_KEY) của các hoá đơn chưa giải và
+    chưa có trong BGW_HD; kỳ mới nhất tính trên mọi hoá đơn chưa giải. Chỉ dựng lại khi ảnh chụp thay đổi.
+    """
+    frame = _UNPAID_SNAPSHOT.get()
+    with _DEBT_PROFILE_LOCK:
+        if _DEBT_PROFILE['frame'] is frame:
+            return _DEBT_PROFILE['profile']
+        start_time = time.perf_counter()
+        months = pd.Series(aggregation.month_indexes(frame['KY'], frame['NAM'])).max()  # Bỏ qua kỳ/năm nhập sai
+        latest_month = int(months) if pd.notna(months) else None
+        unpaid = frame.loc[~frame['BGW_PAID'] & (frame[keys.CUSTOMER_KEY] != keys.MISSING_KEY)]
+        profile = aggregation.DebtProfile.from_invoices(unpaid[keys.CUSTOMER_KEY], unpaid['KY'], unpaid['NAM'],
+                                                        unpaid['TONGCONG'], latest_month=latest_month)
+        _DEBT_PROFILE['frame'], _DEBT_PROFILE['profile'] = frame, profile
+        logging.info(f"Dựng hồ sơ nợ cho {len(profile)} danh bạ trong {time.perf_counter() - start_time:.2f}s.")
+        return profile
 
 
 def fetch_unpaid_debt_details():
+    """Dạng cũ của fetch_unpaid_debt_profile: ({danh bạ: 'MM/YYYY,...'}, kỳ mới nhất 'MM/YYYY')."""
     try:
-        sql_hoadon = (f"SELECT {config.API_COL_DANHBA}, {config.API_COL_SOHOADON}, "
-                      f"{config.API_COL_KY}, {config.API_COL_NAM} "
-                      f"FROM HoaDon WHERE {config.API_COL_NGAYGIAI} IS NULL")
-        df_hoadon = fetch_dataframe('f_Select_SQL_Thutien', sql_hoadon,
-                                    dtypes={'DANHBA': str, 'SOHOADON': str, 'KY': str, 'NAM': str})
-        if df_hoadon.empty: return {}, None
-        df_hoadon = df_hoadon.rename(columns={'DANHBA': 'DANHBA', 'SOHOADON': 'SOHOADON', 'KY': 'KY', 'NAM': 'NAM'})
-        temp_date = pd.to_datetime(df_hoadon['NAM'] + '-' + df_hoadon['KY'] + '-01', errors='coerce')
-        latest_date = temp_date.max()
-        latest_period_str = latest_date.strftime('%m/%Y') if pd.notna(latest_date) else None
-        sohoadon_list = df_hoadon['SOHOADON'].dropna().unique().tolist()
-        df_bgw = _get_bgw_invoices(sohoadon_list)
-        if not df_bgw.empty:
-            df_bgw = df_bgw.rename(columns={config.API_COL_SHDON_BGW: 'SHDon'})
-            shdon_to_exclude = set(df_bgw['SHDon'].astype(str).str.strip())
-            hoadon_chua_tra = df_hoadon[~df_hoadon['SOHOADON'].astype(str).str.strip().isin(shdon_to_exclude)].copy()
-        else:
-            hoadon_chua_tra = df_hoadon.copy()
-        if hoadon_chua_tra.empty: return {}, latest_period_str
-        hoadon_chua_tra['ky_nam'] = hoadon_chua_tra['KY'].str.zfill(2) + '/' + hoadon_chua_tra['NAM']
-        unpaid_details = (
-            hoadon_chua_tra.groupby('DANHBA')['ky_nam'].apply(lambda x: ','.join(sorted(x.unique()))).to_dict())
-        return unpaid_details, latest_period_str
+        profile = fetch_unpaid_debt_profile()
+        names = get_unpaid_invoices([config.API_COL_DANHBA, keys.CUSTOMER_KEY], include_bgw_paid=True)
+        names = names.drop_duplicates(keys.CUSTOMER_KEY).set_index(keys.CUSTOMER_KEY)[config.API_COL_DANHBA]
+        return dict(zip(names.reindex(profile.keys), profile.render())), profile.latest_period_str
     except Exception as e:
         return {}, None
 
 
-def _get_bgw_invoices(sohoadon_list, function_name='f_Select_SQL_Nganhang'):
+_CUSTOMER_COLUMNS = ['GB', 'MLT2', 'SoMoi', 'SoThan', 'Hieu', 'HopBaoVe', 'SDT']
+_CUSTOMER_DTYPES = {'DanhBa': str, 'GB': str, 'MLT2': str}
+
+
+def _encode_customer_column(series):
+    """Cột chữ lặp lại nhiều (GB, Hieu, MLT2...) lưu dạng pd.Categorical; các cột khác giữ nguyên mảng NumPy."""
+    if series.dtype == object and series.nunique() <= config.CUSTOMER_DIMENSION_CATEGORY_RATIO * len(series):
+        return pd.Categorical(series)
+    return series.to_numpy()
+
+
+def _take_customer_column(column, positions):
+    """Lấy giá trị theo vị trí, vị trí -1 thành NaN (kiểu kết quả giống một phép merge how='left')."""
+    if isinstance(column, pd.Categorical):
+        return np.asarray(column.take(positions, allow_fill=True), dtype=object)
+    return pd.api.extensions.take(column, positions, allow_fill=True)
+
+
+class _CustomerDimension:
+    """
+    Bảng KhachHang dùng chung cho cả tiến trình: một bản duy nhất gồm mọi cột các chức năng cần (_CUSTOMER_COLUMNS),
+    đánh chỉ mục theo khoá số của danh bạ (keys.CUSTOMER_KEY), cột chữ mã hoá dạng category. Các chức năng tra theo chỉ mục
+    thay vì tự tải cả bảng. Nguồn là fetch_dataframe (nhóm 'reference': lưu trên đĩa, dùng chung giữa các phiên,
+    hết hạn sau 24 giờ và được làm mới ở nền), bản trong bộ nhớ được đọc lại sau CUSTOMER_DIMENSION_RELOAD_INTERVAL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._columns = {}
+        self._loaded_at = 0.0
+        self.stats = {'loads': 0, 'load_errors': 0, 'load_seconds': 0.0, 'lookups': 0, 'lookup_rows': 0,
+                      'missing_rows': 0}
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if self._index is None or now - self._loaded_at > config.CUSTOMER_DIMENSION_RELOAD_INTERVAL:
+                try:
+                    self._load(now)
+                except Exception as e:
+                    if self._index is None:
+                        raise
+                    self.stats['load_errors'] += 1
+                    logging.warning(f"Không đọc lại được bảng khách hàng ({e}), dùng bản hiện có.")
+            return self._index, self._columns
+
+    def reset(self):
+        with self._lock:
+            self._index, self._columns = None, {}
+
+    def _load(self, now):
+        start_time = time.perf_counter()
+        sql = f"SELECT DanhBa, {', '.join(_CUSTOMER_COLUMNS)} FROM KhachHang"
+        df = fetch_dataframe('f_Select_SQL_Doc_so', sql, dtypes=_CUSTOMER_DTYPES)
+        if df.empty:
+            index, columns = pd.Index([], dtype=np.int64), {}
+        else:
+            customer_keys = keys.encode_keys(df['DanhBa'])
+            # DanhBa là khoá của KhachHang; nếu lỡ trùng thì giữ dòng đầu để mỗi hoá đơn chỉ khớp một khách hàng
+            keep = (customer_keys != keys.MISSING_KEY) & ~pd.Series(customer_keys).duplicated().to_numpy()
+            index = pd.Index(customer_keys[keep])
+            columns = {name: _encode_customer_column(df.loc[keep, name].reset_index(drop=True))
+                       for name in _CUSTOMER_COLUMNS if name in df.columns}
+        self._index, self._columns, self._loaded_at = index, columns, now
+        elapsed = time.perf_counter() - start_time
+        self.stats['loads'] += 1
+        self.stats['load_seconds'] += elapsed
+        logging.info(f"Đọc bảng khách hàng: {len(index)} danh bạ, {len(columns)} cột, {elapsed:.2f}s.")
+
+
+_CUSTOMER_DIMENSION = _CustomerDimension()
+
+
+def get_customer_attributes(danhba, columns=None):
+    """
+    Các cột KhachHang (mặc định _CUSTOMER_COLUMNS) của từng danh bạ (chuỗi hoặc khoá keys.CUSTOMER_KEY), cùng
+    thứ tự và index với `danhba`; danh bạ không có trong KhachHang nhận NaN. Trả về DataFrame rỗng (không cột) khi bảng trống.
+    """
+    index, encoded = _CUSTOMER_DIMENSION.get()
+    danhba = pd.Series(danhba)
+    if not encoded:
+        return pd.DataFrame(index=danhba.index)
+    positions = index.get_indexer(keys.encode_keys(danhba))
+    with _CUSTOMER_DIMENSION._lock:
+        stats = _CUSTOMER_DIMENSION.stats
+        stats['lookups'] += 1
+        stats['lookup_rows'] += len(positions)
+        stats['missing_rows'] += int((positions < 0).sum())
+    return pd.DataFrame({name: _take_customer_column(encoded[name], positions)
+                         for name in (columns or _CUSTOMER_COLUMNS) if name in encoded}, index=danhba.index)
+
+
+def load_customer_dimension():
+    """Nạp trước bảng khách hàng (nếu chưa có hoặc đã đến hạn đọc lại); trả về số danh bạ."""
+    return len(_CUSTOMER_DIMENSION.get()[0])
+
+
+def reset_customer_dimension():
+    """Bỏ bảng khách hàng trong bộ nhớ; lần tra sau sẽ đọc lại."""
+    _CUSTOMER_DIMENSION.reset()
+
+
+def get_customer_dimension_stats():
+    """Số lần đọc bảng khách hàng, số dòng đã tra/không khớp và kích thước bản trong bộ nhớ."""
+    with _CUSTOMER_DIMENSION._lock:
+        stats = dict(_CUSTOMER_DIMENSION.stats)
+        stats['customers'] = 0 if _CUSTOMER_DIMENSION._index is None else len(_CUSTOMER_DIMENSION._index)
+        stats['memory_bytes'] = sum(column.nbytes for column in _CUSTOMER_DIMENSION._columns.values())
+    return stats
+
+
+def _run_chunked_lookup(function_name, sohoadon_list, build_sql, dtypes=None, fresh=False):
+    """
+    Chạy các truy vấn IN-list theo từng khối SHDon song song trên _BGW_EXECUTOR.
+    Mỗi khối vẫn đi qua fetch_dataframe nên được cache riêng (fresh=True: luôn tải mới từ API);
+    kết quả trả về giữ đúng thứ tự các khối.
+    """
+    fetch = _fetch_dataframe_fresh if fresh else fetch_dataframe
+    # Sắp xếp và loại trùng trước khi chia khối để cùng một tập SHDon luôn cho ra cùng các khối (cùng khoá cache)
+    sohoadon_list = sorted(set(map(str, sohoadon_list)))
+    chunk_size = config.BGW_CHUNK_SIZE
+    chunks = [sohoadon_list[i:i + chunk_size] for i in range(0, len(sohoadon_list), chunk_size)]
+
+    def _fetch_chunk(indexed_chunk):
+        index, chunk = indexed_chunk
+        start_time = time.perf_counter()
+        df_chunk = fetch(function_name, build_sql(chunk), dtypes=dtypes)
+        elapsed = time.perf_counter() - start_time
+        logging.info(f"Khối {index + 1}/{len(chunks)} ({function_name}): {len(chunk)} SHDon, "
+                     f"{len(df_chunk)} dòng, {elapsed:.2f} giây.")
+        return df_chunk, elapsed
+
+    start_time = time.perf_counter()
+    if len(chunks) == 1:
+        results = [_fetch_chunk((0, chunks[0]))]
+    else:
+        results = list(_BGW_EXECUTOR.map(_fetch_chunk, enumerate(chunks)))
+    latencies = [elapsed for _, elapsed in results]
+    logging.info(f"✅ Tra cứu {len(chunks)} khối ({function_name}) trong {time.perf_counter() - start_time:.2f} giây "
+                 f"(chậm nhất {max(latencies):.2f}s, tổng {sum(latencies):.2f}s).")
+    return [df_chunk for df_chunk, _ in results if not df_chunk.empty]
+
+
+def _get_bgw_invoices(sohoadon_list, function_name='f_Select_SQL_Nganhang', fresh=False, dtypes=None):
     if not sohoadon_list: return pd.DataFrame()
-    all_bgw_dfs = []
-    for i in range(0, len(sohoadon_list), 500):
-        chunk = sohoadon_list[i:i + 500]
+    # SHDon luôn đọc dạng chuỗi: khối toàn chữ số sẽ bị suy ra int và mất số 0 đứng đầu ('0123' -> 123)
+    dtypes = {config.API_COL_SHDON_BGW: str, **(dtypes or {})}
+
+    def build_sql(chunk):
         formatted_chunk_list = "', '".join(map(str, chunk))
-        sql_bgw_chunk = f"SELECT {config.API_COL_SHDON_BGW} FROM BGW_HD WHERE {config.API_COL_SHDON_BGW} IN ('{formatted_chunk_list}')"
-        df_bgw_chunk = fetch_dataframe(function_name, sql_bgw_chunk)
-        if not df_bgw_chunk.empty: all_bgw_dfs.append(df_bgw_chunk)
+        return f"SELECT {config.API_COL_SHDON_BGW} FROM BGW_HD WHERE {config.API_COL_SHDON_BGW} IN ('{formatted_chunk_list}')"
+
+    all_bgw_dfs = _run_chunked_lookup(function_name, sohoadon_list, build_sql, dtypes=dtypes, fresh=fresh)
     if not all_bgw_dfs: return pd.DataFrame()
     return pd.concat(all_bgw_dfs, ignore_index=True)
 
 
 def fetch_bgw_payment_dates(sohoadon_list):
     if not sohoadon_list: return pd.DataFrame()
-    all_bgw_dfs = []
-    for i in range(0, len(sohoadon_list), 500):
-        chunk = sohoadon_list[i:i + 500]
+
+    def build_sql(chunk):
         formatted_chunk_list = "', '".join(map(str, chunk))
-        sql_query = (f"SELECT {config.API_COL_SHDON_BGW}, {config.API_COL_NGAYTT_BGW} "
-                     f"FROM BGW_HD WHERE {config.API_COL_SHDON_BGW} IN ('{formatted_chunk_list}')")
-        df_chunk = fetch_dataframe('f_Select_SQL_Nganhang', sql_query, dtypes={config.API_COL_SHDON_BGW: str})
-        if not df_chunk.empty: all_bgw_dfs.append(df_chunk)
+        return (f"SELECT {config.API_COL_SHDON_BGW}, {config.API_COL_NGAYTT_BGW} "
+                f"FROM BGW_HD WHERE {config.API_COL_SHDON_BGW} IN ('{formatted_chunk_list}')")
+
+    all_bgw_dfs = _run_chunked_lookup('f_Select_SQL_Nganhang', sohoadon_list, build_sql,
+                                      dtypes={config.API_COL_SHDON_BGW: str})
     if not all_bgw_dfs: return pd.DataFrame()
     bgw_df = pd.concat(all_bgw_dfs, ignore_index=True)
     bgw_df = bgw_df.rename(
         columns={config.API_COL_SHDON_BGW: 'SOHOADON', config.API_COL_NGAYTT_BGW: 'NgayThanhToan_BGW'})
     bgw_df['NgayThanhToan_BGW'] = pd.to_datetime(bgw_df['NgayThanhToan_BGW'], errors='coerce')
-    return bgw_df.dropna(subset=['SOHOADON', 'NgayThanhToan_BGW'])
\ No newline at end of file
+    return bgw_df.dropna(subset=['SOHOADON', 'NgayThanhToan_BGW'])
@@ -0,0 +1,74 @@
+# GhithuWebApp/backend/keys.py
+"""
+Khoá số nguyên chuẩn cho danh bạ (DANHBA/DanhBa/danh_bo) và số hoá đơn (SOHOADON/SHDon).
+
+Mỗi giá trị được chuẩn hoá một lần lúc nạp dữ liệu thành int64: chuỗi chỉ gồm chữ số -> chính số đó
+(nên '123' và '00000000123' cùng một khoá, giống .str.strip().str.zfill(11)), chuỗi khác -> băm 64 bit có bit dấu
+bật (luôn âm, không trùng khoá số), thiếu hoặc rỗng -> MISSING_KEY. Số hoá đơn dùng encode_invoice_keys, giữ
+phân biệt số 0 đứng đầu. Các phép merge/isin/groupby chạy trên khoá; chuỗi đệm số 0 chỉ được dựng lại khi hiển thị
+(format_keys).
+"""
+import numpy as np
+import pandas as pd
+
+CUSTOMER_KEY = 'DANHBA_KEY'
+INVOICE_KEY = 'SOHOADON_KEY'
+CUSTOMER_KEY_WIDTH = 11  # Số chữ số của danh bạ khi hiển thị
+MISSING_KEY = np.iinfo(np.int64).min
+
+_MAX_DIGITS = 18  # Chuỗi số dài hơn không chắc vừa int64, được băm như chuỗi thường
+_HASH_FLAG = np.uint64(1) << np.uint64(63)
+
+
+def encode_keys(values, keep_leading_zeros=False):
+    """
+    Khoá int64 của từng giá trị (Series, mảng hoặc list), cùng thứ tự.
+    keep_leading_zeros=True (số hoá đơn, xem encode_invoice_keys): chuỗi số có số 0 đứng đầu được băm như chuỗi
+    thường, nên '0123', '00123' và '123' là ba khoá khác nhau (so khớp đúng chuỗi sau khi bỏ khoảng trắng).
+    """
+    series = pd.Series(values, copy=False)
+    if series.dtype.kind in 'iu':
+        return series.to_numpy(dtype=np.int64)
+    raw = series.to_numpy(dtype=object)
+    result = np.full(len(raw), MISSING_KEY, dtype=np.int64)
+    present = ~pd.isna(raw)
+    if not present.any():
+        return result
+    if series.dtype.kind == 'f':  # Cột số bị suy luận thành float vì có ô trống
+        values = series.to_numpy(dtype=np.float64)[present]
+        if ((values >= 0) & (values < 10 ** _MAX_DIGITS) & (values == np.floor(values))).all():
+            result[present] = values.astype(np.int64)
+            return result
+    # Kiểm tra chữ số bằng các hàm chuỗi của NumPy (nhanh hơn regex từng dòng); số thực kiểu object như 123.7
+    # thành chuỗi '123.7' và được băm, không bị cắt thành 123
+    text = np.char.strip(raw[present].astype(str))
+    lengths = np.char.str_len(text)
+    is_digits = np.char.isdecimal(text) & (lengths <= _MAX_DIGITS)
+    if keep_leading_zeros:
+        is_digits &= ~((lengths > 1) & np.char.startswith(text, '0'))
+    is_text = ~is_digits & (lengths > 0)
+    keys = np.full(len(text), MISSING_KEY, dtype=np.int64)
+    if is_digits.any():
+        try:
+            keys[is_digits] = text[is_digits].astype(np.int64)
+        except ValueError:  # Chữ số Unicode ngoài ASCII
+            keys[is_digits] = [int(value) for value in text[is_digits].tolist()]
+    if is_text.any():
+        hashed = pd.util.hash_array(text[is_text].astype(object), categorize=True)
+        keys[is_text] = (hashed | _HASH_FLAG).view(np.int64)
+    result[present] = keys
+    return result
+
+
+def encode_invoice_keys(values):
+    """Khoá số hoá đơn (keys.INVOICE_KEY): giữ phân biệt các chuỗi chỉ khác nhau ở số 0 đứng đầu."""
+    return encode_keys(values, keep_leading_zeros=True)
+
+
+def format_keys(keys, width=CUSTOMER_KEY_WIDTH):
+    """Chuỗi hiển thị của các khoá số (đệm 0 đủ `width`); khoá băm hoặc MISSING_KEY nhận NaN."""
+    keys = np.asarray(keys, dtype=np.int64)
+    result = np.full(len(keys), np.nan, dtype=object)
+    numeric = keys >= 0
+    result[numeric] = pd.Series(keys[numeric]).astype(str).str.zfill(width).to_numpy(dtype=object)
+    return result
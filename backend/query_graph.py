@@ -0,0 +1,103 @@
+# GhithuWebApp/backend/query_graph.py
+"""
+Chạy các bước đọc dữ liệu của một phân tích theo đồ thị phụ thuộc.
+
+Mỗi phân tích khai báo các nút (hàm đọc dữ liệu) và nút nào cần kết quả của nút nào; các nút không phụ thuộc nhau
+chạy song song trên một pool luồng dùng chung, nên thời gian chờ chỉ còn xấp xỉ đường dài nhất của đồ thị.
+Thời gian từng nút được ghi lại (QueryGraph.timings, get_query_graph_stats).
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import config
+
+# Pool dùng chung cho các nút của mọi đồ thị; nút không được tự chạy đồ thị con trên cùng pool này
+_EXECUTOR = ThreadPoolExecutor(max_workers=config.QUERY_GRAPH_MAX_WORKERS, thread_name_prefix='query_graph')
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+class QueryGraph:
+    """
+    Đồ thị các bước đọc dữ liệu. Ví dụ:
+
+        graph = QueryGraph('debt_filter')
+        graph.add('hoadon', data_sources.get_unpaid_invoices)
+        graph.add('kh', lambda df: data_sources.get_customer_attributes(df['DANHBA']), depends_on=['hoadon'])
+        results = graph.run()  # {'hoadon': ..., 'kh': ...}
+
+    Hàm của một nút nhận kết quả các nút trong depends_on làm tham số, theo đúng thứ tự khai báo.
+    Lỗi của nút đầu tiên thất bại được ném lại nguyên vẹn; các nút chưa bắt đầu bị huỷ.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._nodes = {}
+        self.timings = {}  # nút -> {'start': giây kể từ lúc chạy đồ thị, 'seconds': thời gian chạy}
+
+    def add(self, node, func, depends_on=()):
+        if node in self._nodes:
+            raise ValueError(f"Nút '{node}' đã có trong đồ thị '{self.name}'.")
+        missing = [dep for dep in depends_on if dep not in self._nodes]
+        if missing:
+            raise ValueError(f"Nút '{node}' phụ thuộc nút chưa khai báo: {missing}.")
+        self._nodes[node] = (func, tuple(depends_on))
+        return self
+
+    def _run_node(self, node, args, graph_start):
+        start = time.perf_counter()
+        try:
+            return self._nodes[node][0](*args)
+        finally:
+            self.timings[node] = {'start': start - graph_start, 'seconds': time.perf_counter() - start}
+
+    def run(self):
+        """Chạy mọi nút (song song khi được), trả về {nút: kết quả}."""
+        graph_start = time.perf_counter()
+        results, running = {}, {}
+        pending = dict(self._nodes)
+        try:
+            while pending or running:
+                for node, (_, depends_on) in list(pending.items()):
+                    if all(dep in results for dep in depends_on):
+                        args = [results[dep] for dep in depends_on]
+                        running[_EXECUTOR.submit(self._run_node, node, args, graph_start)] = node
+                        del pending[node]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+        self._record(time.perf_counter() - graph_start)
+        return results
+
+    def _record(self, wall_seconds):
+        node_seconds = sum(timing['seconds'] for timing in self.timings.values())
+        with _STATS_LOCK:
+            stats = _STATS.setdefault(self.name, {'runs': 0, 'wall_seconds': 0.0, 'node_seconds': 0.0, 'nodes': {}})
+            stats['runs'] += 1
+            stats['wall_seconds'] += wall_seconds
+            stats['node_seconds'] += node_seconds
+            for node, timing in self.timings.items():
+                stats['nodes'][node] = stats['nodes'].get(node, 0.0) + timing['seconds']
+        slowest = ', '.join(f"{node} {timing['seconds']:.2f}s"
+                            for node, timing in sorted(self.timings.items(), key=lambda item: -item[1]['seconds']))
+        logging.info(f"Đồ thị '{self.name}': {wall_seconds:.2f}s (cộng dồn các nút {node_seconds:.2f}s): {slowest}.")
+
+
+def get_query_graph_stats():
+    """Theo từng đồ thị: số lần chạy, tổng thời gian thực, tổng thời gian các nút và thời gian cộng dồn của từng nút."""
+    with _STATS_LOCK:
+        return {name: dict(stats, nodes=dict(stats['nodes'])) for name, stats in _STATS.items()}
+
+
+def reset_query_graph_stats():
+    with _STATS_LOCK:
+        _STATS.clear()
@@ -0,0 +1,381 @@
+"""
+Bản sao cục bộ (SQLite) của các worksheet 'database' và 'ON_OFF'.
+
+Mỗi lần đồng bộ chỉ tải về các dòng mới hoặc đã bị sửa. Các cột chuẩn hoá (danh bạ đủ 11 số, ngày đã phân tích,
+kỳ/năm đã tách từ ky_nam) được tính sẵn lúc đồng bộ và có chỉ mục theo ngày giao, ID/id_tb và danh bạ,
+nên báo cáo tuần chỉ cần đọc các dòng trong khoảng ngày cần thiết.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import config
+from backend import data_sources
+
+_ISO_FORMAT = '%Y-%m-%d %H:%M:%S'
+_SQLITE_MAX_PARAMS = 900
+
+
+def _parse_sheet_dates(series):
+    """Ngày trên sheet có hai định dạng (kèm giờ hoặc không)."""
+    clean_col = series.astype(str).str.strip()
+    return pd.to_datetime(clean_col, format=config.DATE_FORMAT_1, errors='coerce').fillna(
+        pd.to_datetime(clean_col, format=config.DATE_FORMAT_2, errors='coerce'))
+
+
+def _normalize_database(df):
+    """Các cột chuẩn hoá của sheet database và bảng kỳ/năm tách từ ky_nam (mỗi kỳ một dòng)."""
+    norm = pd.DataFrame(index=df.index)
+    ky_nam = None
+    if config.DB_COL_KY_NAM in df.columns:
+        norm[config.DB_COL_DANH_BO] = df[config.DB_COL_DANH_BO].astype(str).str.strip().str.zfill(11)
+        items = df[config.DB_COL_KY_NAM].astype(str).str.split(',').explode().str.strip()
+        parts = items.str.split('/')
+        ky_nam = pd.DataFrame({'pos': items.groupby(level=0).cumcount(), 'ky_nam': items,
+                               'ky': parts.str[0].str.strip().str.zfill(2), 'nam': parts.str[1].str.strip()})
+    if config.DB_COL_NGAY_GIAO in df.columns:
+        norm[f'{config.DB_COL_NGAY_GIAO}_chuan_hoa'] = _parse_sheet_dates(df[config.DB_COL_NGAY_GIAO])
+    for col in (config.DB_COL_ID, config.DB_COL_NHOM):
+        if col in df.columns:
+            norm[col] = df[col].astype(str).str.strip()
+    return norm, ky_nam
+
+
+def _normalize_on_off(df):
+    """Các cột chuẩn hoá của sheet ON_OFF; cột bắt đầu bằng '_' chỉ dùng để tra cứu, không đưa vào DataFrame."""
+    norm = pd.DataFrame(index=df.index)
+    for col in (config.ON_OFF_COL_NGAY_KHOA, config.ON_OFF_COL_NGAY_MO):
+        if col in df.columns:
+            norm[f'{col}_chuan_hoa'] = _parse_sheet_dates(df[col])
+    for col in (config.ON_OFF_COL_ID, config.ON_OFF_COL_NHOM_KHOA):
+        if col in df.columns:
+            norm[col] = df[col].astype(str).str.strip()
+    if config.ON_OFF_COL_DANH_BA in df.columns and config.ON_OFF_COL_TINH_TRANG in df.columns:
+        norm['_danh_ba'] = df[config.ON_OFF_COL_DANH_BA].astype(str).str.strip().str.zfill(11)
+        norm['_tinh_trang'] = df[config.ON_OFF_COL_TINH_TRANG].astype(str).str.strip()
+    return norm, None
+
+
+_MIRRORS = {
+    config.DB_SHEET: {
+        'table': 'database_rows',
+        'normalize': _normalize_database,
+        'columns': [config.DB_COL_DANH_BO, f'{config.DB_COL_NGAY_GIAO}_chuan_hoa', config.DB_COL_ID,
+                    config.DB_COL_NHOM],
+        'datetime_columns': [f'{config.DB_COL_NGAY_GIAO}_chuan_hoa'],
+        'indexes': [f'{config.DB_COL_NGAY_GIAO}_chuan_hoa', config.DB_COL_ID, config.DB_COL_DANH_BO],
+        'exploded': True,
+    },
+    config.ON_OFF_SHEET: {
+        'table': 'on_off_rows',
+        'normalize': _normalize_on_off,
+        'columns': [f'{config.ON_OFF_COL_NGAY_KHOA}_chuan_hoa', f'{config.ON_OFF_COL_NGAY_MO}_chuan_hoa',
+                    config.ON_OFF_COL_ID, config.ON_OFF_COL_NHOM_KHOA, '_danh_ba', '_tinh_trang'],
+        'datetime_columns': [f'{config.ON_OFF_COL_NGAY_KHOA}_chuan_hoa', f'{config.ON_OFF_COL_NGAY_MO}_chuan_hoa'],
+        'indexes': [config.ON_OFF_COL_ID, '_danh_ba'],
+        'exploded': False,
+    },
+}
+_SYNC_LOCKS = {sheet_name: threading.Lock() for sheet_name in _MIRRORS}
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _connect():
+    conn = sqlite3.connect(config.SHEET_MIRROR_PATH, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS mirror_meta (sheet TEXT PRIMARY KEY, header TEXT, norm_columns TEXT, '
+                 'row_count INTEGER, synced_at REAL, full_synced_at REAL)')
+    for spec in _MIRRORS.values():
+        table = spec['table']
+        columns = ''.join(f', {_quote(col)} TEXT' for col in spec['columns'])
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (row INTEGER PRIMARY KEY, raw TEXT, watch_hash TEXT{columns})')
+        for col in spec['indexes']:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {_quote(f"idx_{table}_{col}")} ON {table} ({_quote(col)})')
+        if spec['exploded']:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {table}_ky_nam (row INTEGER, pos INTEGER, ky_nam TEXT, '
+                         f'ky TEXT, nam TEXT, PRIMARY KEY (row, pos))')
+    return conn
+
+
+def _read_meta(conn, sheet_name):
+    row = conn.execute('SELECT header, norm_columns, row_count, synced_at, full_synced_at FROM mirror_meta '
+                       'WHERE sheet = ?', (sheet_name,)).fetchone()
+    if row is None:
+        return None
+    return {'header': json.loads(row[0]), 'norm_columns': json.loads(row[1]), 'row_count': row[2],
+            'synced_at': row[3], 'full_synced_at': row[4]}
+
+
+def _watch_hash(raw, watch_index):
+    values = raw if watch_index is None else [raw[i] if i < len(raw) else '' for i in watch_index]
+    return hashlib.md5(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _watch_index(sheet_name, header):
+    watch = config.SHEET_MIRROR_WATCH_COLUMNS.get(sheet_name)
+    return None if watch is None else [header.index(col) for col in watch if col in header]
+
+
+def _store_rows(conn, sheet_name, header, numbered_rows):
+    """Ghi (đè) các dòng (số dòng trên sheet, giá trị thô) cùng các cột chuẩn hoá; trả về danh sách cột chuẩn hoá."""
+    spec = _MIRRORS[sheet_name]
+    table = spec['table']
+    row_numbers = [row_number for row_number, _ in numbered_rows]
+    for start in range(0, len(row_numbers), _SQLITE_MAX_PARAMS):
+        chunk = row_numbers[start:start + _SQLITE_MAX_PARAMS]
+        placeholders = ','.join('?' * len(chunk))
+        conn.execute(f'DELETE FROM {table} WHERE row IN ({placeholders})', chunk)
+        if spec['exploded']:
+            conn.execute(f'DELETE FROM {table}_ky_nam WHERE row IN ({placeholders})', chunk)
+    if not numbered_rows or not header:
+        return []
+
+    frame = data_sources._frame_from_values([header] + [raw for _, raw in numbered_rows], dtype=object)
+    norm, ky_nam = spec['normalize'](frame)
+    norm_columns = list(norm.columns)
+    stored = {}
+    for col in norm_columns:
+        values = norm[col].dt.strftime(_ISO_FORMAT) if col in spec['datetime_columns'] else norm[col]
+        stored[col] = values.astype(object).where(values.notna(), None).tolist()
+    watch_index = _watch_index(sheet_name, header)
+    records = [(row_number, json.dumps(raw, ensure_ascii=False), _watch_hash(raw, watch_index),
+                *(stored[col][i] for col in norm_columns))
+               for i, (row_number, raw) in enumerate(numbered_rows)]
+    columns = ''.join(f', {_quote(col)}' for col in norm_columns)
+    placeholders = ', ?' * len(norm_columns)
+    conn.executemany(f'INSERT INTO {table} (row, raw, watch_hash{columns}) VALUES (?, ?, ?{placeholders})', records)
+    if ky_nam is not None:
+        row_of = np.asarray(row_numbers)[ky_nam.index.to_numpy()]
+        nam = ky_nam['nam'].astype(object).where(ky_nam['nam'].notna(), None)
+        conn.executemany(f'INSERT INTO {table}_ky_nam (row, pos, ky_nam, ky, nam) VALUES (?, ?, ?, ?, ?)',
+                         zip(row_of.tolist(), ky_nam['pos'].tolist(), ky_nam['ky_nam'].tolist(),
+                             ky_nam['ky'].tolist(), nam.tolist()))
+    return norm_columns
+
+
+def _write_meta(conn, sheet_name, header, norm_columns, row_count, full):
+    now = time.time()
+    meta = _read_meta(conn, sheet_name)
+    full_synced_at = now if full or meta is None else meta['full_synced_at']
+    if not norm_columns and meta is not None and not full:
+        norm_columns = meta['norm_columns']
+    conn.execute('INSERT OR REPLACE INTO mirror_meta (sheet, header, norm_columns, row_count, synced_at, '
+                 'full_synced_at) VALUES (?, ?, ?, ?, ?, ?)',
+                 (sheet_name, json.dumps(header, ensure_ascii=False), json.dumps(norm_columns, ensure_ascii=False),
+                  row_count, now, full_synced_at))
+
+
+def _sync_full(conn, sheet_name):
+    values = data_sources.fetch_sheet_values([sheet_name])[0]
+    header = values[0] if values else []
+    spec = _MIRRORS[sheet_name]
+    conn.execute(f'DELETE FROM {spec["table"]}')
+    if spec['exploded']:
+        conn.execute(f'DELETE FROM {spec["table"]}_ky_nam')
+    norm_columns = _store_rows(conn, sheet_name, header, list(enumerate(values[1:], start=2)))
+    _write_meta(conn, sheet_name, header, norm_columns, max(len(values), 1), full=True)
+    return max(len(values) - 1, 0)
+
+
+def _sync_incremental(conn, sheet_name, meta):
+    """
+    Chỉ tải các dòng mới (sau row_count đã biết) và các dòng có cột theo dõi thay đổi.
+    Trả về None khi cần tải lại toàn bộ (đổi tiêu đề, quá nhiều dòng bị sửa).
+    """
+    header, known_rows = meta['header'], meta['row_count']
+    table = _MIRRORS[sheet_name]['table']
+    stored_hashes = dict(conn.execute(f'SELECT row, watch_hash FROM {table}'))
+    watch_index = _watch_index(sheet_name, header)
+
+    if watch_index is None:
+        # Sheet nhỏ, sửa trực tiếp nhiều chỗ: đọc cả sheet nhưng chỉ ghi lại các dòng khác bản sao
+        values = data_sources.fetch_sheet_values([sheet_name])[0]
+        if (values[0] if values else []) != header:
+            return None
+        row_count = max(len(values), 1)
+        changed = [(row_number, raw) for row_number, raw in enumerate(values[1:], start=2)
+                   if stored_hashes.get(row_number) != _watch_hash(raw, None)]
+    else:
+        letters = [data_sources._column_letter(i + 1) for i in watch_index]
+        results = data_sources.fetch_sheet_values(
+            [(sheet_name, '1:1')] + [(sheet_name, f'{letter}:{letter}') for letter in letters])
+        if (results[0][0] if results[0] else []) != header:
+            return None
+        columns = results[1:]
+        row_count = max([len(col) for col in columns] + [1])
+
+        def _watched(row_number):
+            return [col[row_number - 1][0] if row_number <= len(col) and col[row_number - 1] else ''
+                    for col in columns]
+
+        edited_rows = [row_number for row_number in range(2, min(known_rows, row_count) + 1)
+                       if stored_hashes.get(row_number) != _watch_hash(_watched(row_number), None)]
+        if len(edited_rows) > config.SHEET_MIRROR_MAX_CHANGED_ROWS:
+            return None
+        last_letter = data_sources._column_letter(max(len(header), 1))
+        ranges = [(sheet_name, f'A{row_number}:{last_letter}{row_number}') for row_number in edited_rows]
+        if row_count > known_rows:
+            ranges.insert(0, (sheet_name, f'A{known_rows + 1}:{last_letter}{row_count}'))
+        results = data_sources.fetch_sheet_values(ranges) if ranges else []
+        changed = []
+        if row_count > known_rows:
+            tail = results.pop(0)
+            changed += [(known_rows + 1 + i, tail[i] if i < len(tail) else [])
+                        for i in range(row_count - known_rows)]
+        changed += [(row_number, values[0] if values else []) for row_number, values in zip(edited_rows, results)]
+
+    conn.execute(f'DELETE FROM {table} WHERE row > ?', (row_count,))
+    if _MIRRORS[sheet_name]['exploded']:
+        conn.execute(f'DELETE FROM {table}_ky_nam WHERE row > ?', (row_count,))
+    norm_columns = _store_rows(conn, sheet_name, header, changed)
+    _write_meta(conn, sheet_name, header, norm_columns, row_count, full=False)
+    return len(changed)
+
+
+def sync_sheet(sheet_name, force=False):
+    """
+    Đồng bộ bản sao của một worksheet với Google Sheets; trả về số dòng đã tải về.
+    Nếu không kết nối được nhưng đã có bản sao, vẫn dùng bản sao hiện có (ghi cảnh báo vào log).
+    """
+    with _SYNC_LOCKS[sheet_name]:
+        conn = _connect()
+        try:
+            meta = _read_meta(conn, sheet_name)
+            now = time.time()
+            if not force and meta is not None and now - meta['synced_at'] < config.SHEET_MIRROR_MIN_SYNC_INTERVAL:
+                return 0
+            start_time = time.perf_counter()
+            try:
+                fetched = None
+                full = (force or meta is None
+                        or now - meta['full_synced_at'] > config.SHEET_MIRROR_FULL_RESYNC_INTERVAL)
+                if not full:
+                    fetched = _sync_incremental(conn, sheet_name, meta)
+                    full = fetched is None
+                if full:
+                    fetched = _sync_full(conn, sheet_name)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                if meta is None:
+                    raise ConnectionError(f"Lỗi: Không thể đồng bộ worksheet '{sheet_name}': {e}")
+                logging.warning(f"Không đồng bộ được worksheet '{sheet_name}' ({e}), dùng bản sao cục bộ hiện có.")
+                return 0
+            logging.info(f"Đồng bộ bản sao '{sheet_name}' ({'toàn bộ' if full else 'tăng dần'}): "
+                         f"{fetched} dòng, {time.perf_counter() - start_time:.2f}s.")
+            return fetched
+        finally:
+            conn.close()
+
+
+def mark_stale(sheet_name):
+    """Buộc lần đọc tiếp theo đồng bộ lại (ví dụ ngay sau khi ghi thêm dòng xuống sheet)."""
+    conn = _connect()
+    try:
+        conn.execute('UPDATE mirror_meta SET synced_at = 0 WHERE sheet = ?', (sheet_name,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _load_frame(conn, sheet_name, where='', params=(), object_dtype=False):
+    """Dựng lại DataFrame như đọc trực tiếp từ sheet rồi chuẩn hoá, chỉ gồm các dòng thoả điều kiện where."""
+    spec = _MIRRORS[sheet_name]
+    table = spec['table']
+    meta = _read_meta(conn, sheet_name)
+    header = meta['header']
+    frame_columns = [col for col in meta['norm_columns'] if not col.startswith('_')]
+    select = ''.join(f', r.{_quote(col)}' for col in frame_columns)
+    rows = conn.execute(f'SELECT r.row, r.raw{select} FROM {table} r {where} ORDER BY r.row', params).fetchall()
+    if rows:
+        frame = data_sources._frame_from_values([header] + [json.loads(row[1]) for row in rows],
+                                                dtype=object if object_dtype else None)
+    else:
+        frame = pd.DataFrame(columns=header)
+    norm_values = {col: [row[2 + j] for row in rows] for j, col in enumerate(frame_columns)}
+
+    # Cột chuẩn hoá trùng tên cột gốc được thay tại chỗ; cột mới được thêm sau phần tách kỳ/năm
+    for col in frame_columns:
+        if col in frame.columns:
+            frame[col] = pd.Series(norm_values[col], index=frame.index, dtype=object)
+    take = np.arange(len(rows))
+    if spec['exploded'] and config.DB_COL_KY_NAM in header:
+        ky_nam = pd.DataFrame(
+            conn.execute(f'SELECT k.row, k.ky_nam, k.ky, k.nam FROM {table}_ky_nam k JOIN {table} r ON r.row = k.row '
+                         f'{where} ORDER BY k.row, k.pos', params).fetchall(),
+            columns=['row', 'ky_nam', 'ky', 'nam'])
+        counts = ky_nam.groupby('row').size().reindex([row[0] for row in rows], fill_value=0).to_numpy()
+        take = np.repeat(take, counts)
+        frame = frame.iloc[take].reset_index(drop=True)
+        frame[config.DB_COL_KY_NAM] = ky_nam['ky_nam'].to_numpy(dtype=object)
+        frame['ky'] = ky_nam['ky'].to_numpy(dtype=object)
+        frame['nam'] = ky_nam['nam'].where(ky_nam['nam'].notna(), np.nan).to_numpy(dtype=object)
+    for col in frame_columns:
+        if col not in frame.columns:
+            values = pd.Series(norm_values[col], dtype=object).iloc[take].reset_index(drop=True)
+            frame[col] = pd.to_datetime(values, format=_ISO_FORMAT) if col in spec['datetime_columns'] else values
+    return frame
+
+
+def load_report_data(start_date=None, end_date=None):
+    """
+    Dữ liệu cho báo cáo tuần từ bản sao cục bộ: (db_df, on_off_df) đã chuẩn hoá như khi đọc và xử lý cả sheet.
+    Nếu có start_date/end_date, db_df chỉ gồm các dòng có ngày giao trong khoảng đó (tra theo chỉ mục).
+    """
+    for sheet_name in (config.DB_SHEET, config.ON_OFF_SHEET):
+        sync_sheet(sheet_name)
+    conn = _connect()
+    try:
+        date_column = _quote(f'{config.DB_COL_NGAY_GIAO}_chuan_hoa')
+        conditions, params = [], []
+        if start_date is not None:
+            conditions.append(f'r.{date_column} >= ?')
+            params.append(pd.Timestamp(start_date).strftime('%Y-%m-%d'))
+        if end_date is not None:
+            conditions.append(f'r.{date_column} < ?')
+            params.append((pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)).strftime('%Y-%m-%d'))
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        db_df = _load_frame(conn, config.DB_SHEET, where, params, object_dtype=bool(conditions))
+        on_off_df = _load_frame(conn, config.ON_OFF_SHEET)
+        return db_df, on_off_df
+    finally:
+        conn.close()
+
+
+def load_on_off_status(danh_ba_list=None):
+    """
+    Danh bạ (đủ 11 số) và tình trạng trong sheet ON_OFF, theo thứ tự dòng trên sheet.
+    Nếu có danh_ba_list thì chỉ tra các danh bạ đó qua chỉ mục.
+    """
+    sync_sheet(config.ON_OFF_SHEET)
+    columns = [config.ON_OFF_COL_DANH_BA, config.ON_OFF_COL_TINH_TRANG]
+    conn = _connect()
+    try:
+        meta = _read_meta(conn, config.ON_OFF_SHEET)
+        if '_danh_ba' not in meta['norm_columns']:
+            return pd.DataFrame(columns=columns)
+        query = 'SELECT row, _danh_ba, _tinh_trang FROM on_off_rows'
+        if danh_ba_list is None:
+            rows = conn.execute(query).fetchall()
+        else:
+            keys = list(dict.fromkeys(map(str, danh_ba_list)))
+            rows = []
+            for start in range(0, len(keys), _SQLITE_MAX_PARAMS):
+                chunk = keys[start:start + _SQLITE_MAX_PARAMS]
+                rows += conn.execute(f'{query} WHERE _danh_ba IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+        rows.sort()
+        return pd.DataFrame([row[1:] for row in rows], columns=columns)
+    finally:
+        conn.close()
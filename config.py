@@ -5,8 +5,88 @@
 # CẤU HÌNH API
 # ==============================================================================
 API_URL = 'http://14.161.13.194:8065/ws_Banggia.asmx'
+# Thử nghiệm/đo hiệu năng không cần máy chủ thật: chạy máy chủ giả lập (python -m tools.soap_stub_server)
+# rồi đặt API_URL = 'http://127.0.0.1:8065/ws_Banggia.asmx'
 API_USER = 'BENTHANH@194'
-API_TIMEOUT = 180  # Thời gian chờ (giây)
+API_TIMEOUT = 180  # Hạn chót tối đa (giây) của một lần gọi API, tính cả thời gian đọc hết phản hồi
+
+# Lớp chịu lỗi khi gọi ws_Banggia.asmx
+API_CONNECT_TIMEOUT = 10  # Thời gian chờ mở kết nối (giây)
+# Hạn chót của mỗi lần gọi theo độ trễ thực tế của từng nhóm truy vấn: p99 * hệ số, trong khoảng [MIN, API_TIMEOUT].
+# Tính trên tổng thời gian gọi (kể cả phản hồi gửi nhỏ giọt), không chỉ từng lần đọc socket.
+API_TIMEOUT_MIN = 30
+API_TIMEOUT_P99_FACTOR = 3
+API_LATENCY_WINDOW = 200  # Số lần gọi gần nhất dùng để tính phân vị độ trễ
+API_LATENCY_MIN_SAMPLES = 20  # Ít mẫu hơn thì dùng API_TIMEOUT và không gửi yêu cầu dự phòng
+# Thử lại (chỉ với truy vấn đọc SELECT/WITH) khi lỗi tạm thời: mất kết nối, quá thời gian, HTTP 429/5xx
+API_RETRIES = 2
+API_RETRY_BACKOFF = 1.0  # Thời gian chờ cơ sở (giây), nhân đôi sau mỗi lần, có jitter
+API_RETRY_BACKOFF_MAX = 15
+# Gửi thêm một yêu cầu dự phòng khi lời gọi chạy quá p95 của nhóm; lấy kết quả về trước
+API_HEDGE = False
+API_HEDGE_MIN_DELAY = 2  # Không gửi dự phòng sớm hơn số giây này
+# Ngắt mạch: sau N lỗi tạm thời liên tiếp, ngừng gọi API trong COOLDOWN giây (báo lỗi ngay hoặc dùng cache cũ)
+API_BREAKER_FAILURES = 5
+API_BREAKER_COOLDOWN = 30
+
+# Tra cứu BGW_HD theo từng khối SHDon (IN-list)
+BGW_CHUNK_SIZE = 500  # Số SHDon trong một câu lệnh IN (...)
+BGW_MAX_WORKERS = 4  # Số khối được gửi song song tối đa
+
+# Các bước đọc dữ liệu độc lập của một phân tích chạy song song (backend/query_graph.py)
+QUERY_GRAPH_MAX_WORKERS = 8  # Số luồng của pool dùng chung cho mọi đồ thị
+
+# Kết nối HTTP dùng chung (keep-alive) tới ws_Banggia.asmx
+API_POOL_SIZE = 10  # Số kết nối giữ lại trong pool, nên >= BGW_MAX_WORKERS
+API_KEEP_ALIVE = True
+API_ACCEPT_GZIP = True
+
+# Cache kết quả truy vấn (DataFrame đã phân tích) trong thư mục api_cache
+API_CACHE_COMPRESSION = 'zstd'  # Nén Parquet: 'zstd', 'snappy', 'gzip' hoặc None
+# Chính sách cache theo nhóm truy vấn (phân loại từ nội dung SQL):
+#   history   - kỳ/năm đã khép lại, dữ liệu không còn thay đổi
+#   reference - danh mục thay đổi chậm (KhachHang, danh sách giá trị bộ lọc)
+#   live      - trạng thái nợ đang thay đổi (hoá đơn chưa giải, BGW_HD)
+#   default   - các truy vấn còn lại
+# ttl: thời gian dữ liệu còn tươi (giây).
+# max_stale: sau khi hết hạn, kết quả cũ vẫn được trả ngay (kèm đánh dấu) trong khi làm mới ở nền; 0 là tắt.
+# size_limit: dung lượng tối đa (byte) vùng cache riêng của nhóm; khi đầy, mục ít dùng nhất trong nhóm bị loại.
+#   Nhóm rẻ tải lại / nhanh cũ (live) có hạn mức nhỏ nên bị loại trước, lịch sử được giữ lâu nhất.
+API_CACHE_POLICY = {
+    'history': {'ttl': 30 * 24 * 3600, 'max_stale': 30 * 24 * 3600, 'size_limit': 1024 * 1024 ** 2},
+    'reference': {'ttl': 24 * 3600, 'max_stale': 7 * 24 * 3600, 'size_limit': 256 * 1024 ** 2},
+    'default': {'ttl': 3600, 'max_stale': 1800, 'size_limit': 256 * 1024 ** 2},
+    'live': {'ttl': 1800, 'max_stale': 1800, 'size_limit': 128 * 1024 ** 2},
+}
+API_CACHE_EVICTION_POLICY = 'least-recently-used'
+API_CACHE_SIZE_LIMIT = 64 * 1024 ** 2  # Hạn mức của thư mục api_cache gốc (các mục không thuộc nhóm nào)
+API_CACHE_HISTORY_GRACE_DAYS = 7  # Số ngày sau khi kỳ kết thúc mới coi là đã khép lại (chờ điều chỉnh muộn)
+API_CACHE_REFRESH_WORKERS = 2  # Số luồng làm mới cache ở nền
+API_CACHE_OUTAGE_GRACE = 24 * 3600  # Giữ thêm (giây) sau max_stale, chỉ dùng khi API đang ngắt mạch
+API_CACHE_CANONICAL_TRACK_LIMIT = 10000  # Số câu SQL gốc gần nhất được nhớ để đếm hit nhờ chuẩn hoá SQL
+
+# Số liệu truy vấn (theo hàm API và dạng câu SQL): thời gian, dung lượng, số dòng, kết quả tra cache
+METRICS_SLOW_QUERY_SECONDS = 5  # Lời gọi lâu hơn được ghi vào nhật ký truy vấn chậm
+METRICS_SLOW_LOG_SIZE = 200  # Số truy vấn chậm gần nhất được giữ lại
+METRICS_LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]  # Mốc histogram thời gian (giây)
+METRICS_BYTES_BUCKETS = [1024 * 4 ** i for i in range(10)]  # Mốc histogram dung lượng phản hồi (byte)
+METRICS_ROWS_BUCKETS = [10 ** i for i in range(8)]  # Mốc histogram số dòng
+
+# Ảnh chụp dùng chung các hoá đơn chưa giải kèm cờ đã thanh toán qua BGW_HD (data_sources.get_unpaid_invoices)
+UNPAID_SNAPSHOT_REFRESH_INTERVAL = 300  # Ảnh chụp cũ hơn (giây) thì cập nhật tăng dần: hoá đơn kỳ mới, vừa giải, vừa có BGW
+UNPAID_SNAPSHOT_FULL_REBUILD_INTERVAL = 6 * 3600  # Định kỳ dựng lại toàn bộ để bắt điều chỉnh lùi ngày, huỷ giải
+UNPAID_SNAPSHOT_LOOKBACK_DAYS = 3  # Lùi mốc ngày khi tìm hoá đơn vừa giải / vừa có BGW, để bắt các khoản nhập trễ
+BGW_INDEX_RECHECK_INTERVAL = 24 * 3600  # Chỉ mục hoá đơn đã có BGW cũ hơn (giây) thì bỏ, tra lại BGW_HD từ đầu
+
+# Lọc dữ liệu tồn: gom nhóm theo danh bạ ngay trên máy chủ (COUNT/SUM/HAVING), chỉ tải chi tiết các danh bạ còn lại
+DEBT_FILTER_SERVER_AGGREGATION = 'auto'  # True/False, hoặc 'auto': chỉ dùng khi chưa có ảnh chụp hoá đơn chưa giải trong bộ nhớ
+DEBT_FILTER_SERVER_BATCH = 500  # Có giới hạn Top N: đợt đầu tải chi tiết của max(2N, số này) danh bạ, sau đó gấp đôi
+DEBT_FILTER_BASE_TTL = 600  # Giây giữ bộ dữ liệu gốc theo (năm, kỳ, đợt): đổi ngưỡng/CodeMoi/Top N chỉ lọc lại trong bộ nhớ
+DEBT_FILTER_BASE_MAX_ENTRIES = 4  # Số bộ dữ liệu gốc (năm, kỳ, đợt) khác nhau giữ cùng lúc
+
+# Bảng khách hàng (KhachHang) dùng chung, tra theo danh bạ đã chuẩn hoá (data_sources.get_customer_attributes)
+CUSTOMER_DIMENSION_RELOAD_INTERVAL = 3600  # Giây giữa hai lần đọc lại từ cache kết quả (nhóm 'reference' tự làm mới sau 24 giờ)
+CUSTOMER_DIMENSION_CATEGORY_RATIO = 0.5  # Cột chữ có số giá trị khác nhau / số dòng không quá tỉ lệ này thì lưu dạng category
 
 
 # ==============================================================================
@@ -16,6 +96,9 @@ SERVICE_ACCOUNT_FILE = 'chung_chi.json'
 SHEET_NAME = 'Thông báo - Khoá nước'
 DB_SHEET = 'database'
 ON_OFF_SHEET = 'ON_OFF'
+# Ghi danh sách xuống sheet database (nối dòng bằng values.append, không tải lại cả sheet)
+SHEET_APPEND_RETRIES = 3  # Số lần thử lại khi lỗi tạm thời (429/5xx, mất kết nối)
+SHEET_APPEND_BACKOFF = 2  # Thời gian chờ trước lần thử lại đầu tiên (giây), nhân đôi sau mỗi lần
 
 
 # ==============================================================================
@@ -48,6 +131,19 @@ ON_OFF_COL_NGAY_MO = 'ngay_mo'
 ON_OFF_COL_NHOM_KHOA = 'nhom_khoa'
 ON_OFF_COL_KIEU_KHOA = 'kieu_khoa'
 
+# Bản sao cục bộ (SQLite) của sheet database và ON_OFF, chỉ tải các dòng mới hoặc đã sửa mỗi lần đồng bộ
+SHEET_MIRROR_PATH = 'sheet_mirror.db'
+SHEET_MIRROR_MIN_SYNC_INTERVAL = 60  # Trong khoảng này (giây) dùng luôn bản sao, không hỏi lại Google Sheets
+SHEET_MIRROR_FULL_RESYNC_INTERVAL = 24 * 3600  # Định kỳ tải lại toàn bộ để bắt các thay đổi ngoài các cột theo dõi
+SHEET_MIRROR_MAX_CHANGED_ROWS = 500  # Nhiều dòng bị sửa hơn thì tải lại toàn bộ thay vì từng dòng
+# Các cột có thể bị sửa trực tiếp trên sheet, được đọc lại cả cột mỗi lần đồng bộ; None là theo dõi mọi cột.
+# Phải gồm mọi cột mà bản sao chuẩn hoá (danh bạ, ngày giao, kỳ nợ) để sửa trên sheet vào được báo cáo tuần ngay
+SHEET_MIRROR_WATCH_COLUMNS = {
+    DB_SHEET: [DB_COL_ID, DB_COL_DANH_BO, DB_COL_NGAY_GIAO, DB_COL_NHOM, DB_COL_KY_NAM, DB_COL_TINH_TRANG,
+               DB_COL_GHI_CHU],
+    ON_OFF_SHEET: None,
+}
+
 # ==============================================================================
 # CẤU HÌNH TÊN CỘT TRONG DATABASE (API)
 # ==============================================================================
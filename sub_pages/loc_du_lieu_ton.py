@@ -9,7 +9,7 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Bây giờ mới import các module của dự án
-from backend.analysis_logic import run_debt_filter_analysis, prepare_and_send_to_sheet
+from backend.analysis_logic import run_debt_filter_analysis, prepare_and_send_batches_to_sheet
 import config
 
 def show():
@@ -25,6 +25,9 @@ def show():
         st.session_state.debt_filter_results = None
     if 'select_all_toggle' not in st.session_state:
         st.session_state.select_all_toggle = False
+    # Các lượt giao (danh sách, nhóm, ngày giao) chờ gửi chung trong một lần ghi xuống sheet
+    if 'pending_assignments' not in st.session_state:
+        st.session_state.pending_assignments = []
 
 
     # --- Hàm callback để xử lý sự kiện "Chọn tất cả"
@@ -133,16 +136,28 @@ def show():
                 assign_date = st.date_input("Ngày giao")
             with action_col3:
                 selected_rows = df[df["_is_selected"]]
-                disable_send_button = selected_rows.empty
+                pending = st.session_state.pending_assignments
+                assign_date_str = assign_date.strftime("%d/%m/%Y")
+                if st.button("Thêm vào lượt gửi", disabled=selected_rows.empty,
+                             help="Giữ danh sách đã chọn cho nhóm này, chọn tiếp cho nhóm khác rồi gửi tất cả một lần."):
+                    # Khi gửi đi, loại bỏ các cột hiển thị thừa
+                    pending.append((selected_rows.drop(columns=["_is_selected", "Tổng Cộng Formatted"]),
+                                    assign_group, assign_date_str))
+                    st.session_state.debt_filter_results.loc[st.session_state.debt_filter_results["_is_selected"], "_is_selected"] = False
+                    st.rerun()
+                disable_send_button = selected_rows.empty and not pending
                 if st.button("Gửi DS đã chọn", type="primary", disabled=disable_send_button):
-                    with st.spinner(f"Đang gửi {len(selected_rows)} khách hàng cho nhóm {assign_group}..."):
+                    assignments = list(pending)
+                    if not selected_rows.empty:
+                        assignments.append((selected_rows.drop(columns=["_is_selected", "Tổng Cộng Formatted"]),
+                                            assign_group, assign_date_str))
+                    total_rows = sum(len(rows) for rows, _, _ in assignments)
+                    with st.spinner(f"Đang gửi {total_rows} khách hàng cho {len(assignments)} lượt giao..."):
                         try:
-                            assign_date_str = assign_date.strftime("%d/%m/%Y")
-                            # Khi gửi đi, loại bỏ các cột hiển thị thừa
-                            df_to_send = selected_rows.drop(columns=["_is_selected", "Tổng Cộng Formatted"])
-                            count, msg = prepare_and_send_to_sheet(df_to_send, assign_group, assign_date_str)
+                            count, msg = prepare_and_send_batches_to_sheet(assignments)
                             if count > 0:
                                 st.success(msg)
+                                st.session_state.pending_assignments = []
                                 st.session_state.debt_filter_results.loc[st.session_state.debt_filter_results["_is_selected"], "_is_selected"] = False
                                 st.rerun()
                             else:
@@ -150,6 +165,9 @@ def show():
                         except Exception as e:
                             st.error("Lỗi nghiêm trọng khi gửi dữ liệu.")
                             st.exception(e)
+                if pending:
+                    st.caption("Chờ gửi: " + "; ".join(f"{group} ({len(rows)} KH, {date_str})"
+                                                       for rows, group, date_str in pending))
 
             with action_col4:
                 st.checkbox(
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def pytest_configure(config):
+    sys.path.insert(0, ROOT)
+    # diskcache 'api_cache' của data_sources tạo theo thư mục hiện hành khi import: chạy test trong thư mục tạm
+    os.chdir(tempfile.mkdtemp(prefix='tests_'))
@@ -0,0 +1,119 @@
+import re
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import diskcache
+import pandas as pd
+import pytest
+
+import config
+from backend import data_sources, keys
+
+
+@pytest.fixture
+def bgw_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_sources, 'CACHE', diskcache.Cache(str(tmp_path / 'api_cache')))
+    return data_sources._BgwPaidIndex()
+
+
+def _fake_bgw_fetch(bgw_invoices, calls):
+    """Giả lập _fetch_dataframe_fresh trên BGW_HD: trả các SHDon trong IN-list, suy kiểu cột như khi đọc XML."""
+    def fetch(function_name, sql_query, dtypes=None):
+        calls.append(sql_query)
+        match = re.search(r"IN \('(.*)'\)", sql_query)
+        if match is None:
+            return pd.DataFrame()
+        wanted = set(match.group(1).split("', '"))
+        rows = [shdon for shdon in bgw_invoices if shdon in wanted]
+        if not rows:
+            return pd.DataFrame()
+        name = config.API_COL_SHDON_BGW
+        return pd.DataFrame({name: data_sources._column_to_series(name, rows, (dtypes or {}).get(name))})
+    return fetch
+
+
+def test_bgw_flags_keep_leading_zero_invoices(bgw_index, monkeypatch):
+    calls = []
+    monkeypatch.setattr(data_sources, '_fetch_dataframe_fresh', _fake_bgw_fetch(['0123'], calls))
+    sohoadon = pd.Series(['0123', '0456', '123'], index=[10, 11, 12])
+
+    flags = bgw_index.flags(sohoadon, keys.encode_invoice_keys(sohoadon))
+
+    assert calls
+    assert flags.index.tolist() == [10, 11, 12]
+    assert flags.tolist() == [True, False, False]
+    # Lần tra sau dùng chỉ mục, không hỏi lại BGW_HD
+    calls.clear()
+    assert bgw_index.flags(sohoadon, keys.encode_invoice_keys(sohoadon)).tolist() == [True, False, False]
+    assert not calls
+
+
+def _yearly_revenue_sql(monkeypatch):
+    from backend import analysis_logic
+    captured = []
+
+    def fake_fetch(function_name, sql_query, dtypes=None):
+        captured.append(sql_query)
+        return pd.DataFrame()
+    monkeypatch.setattr(data_sources, 'fetch_dataframe', fake_fetch)
+    analysis_logic.run_yearly_revenue_analysis_from_db(2018, 2020, date(2020, 12, 31))
+    return data_sources.canonicalize_sql(captured[0])
+
+
+def test_yearly_revenue_query_is_not_history(monkeypatch):
+    # TermA_CTE lọc NV_GIAI (đổi khi hoá đơn được giải) mà không chặn ngày giải: cả câu không được vào 'history'
+    sql = _yearly_revenue_sql(monkeypatch)
+    assert len(data_sources._select_scopes(sql)) == 4
+    assert data_sources._query_class('f_Select_SQL_Thutien', sql) == 'default'
+
+
+def test_multi_select_query_with_bounded_selects_is_history():
+    sql = data_sources.canonicalize_sql(
+        "WITH A AS (SELECT NAM, SUM(TONGCONG) AS S FROM HoaDon WHERE NAM <= 2020 "
+        "AND CAST(NGAYGIAI AS DATE) < '2021-01-01' GROUP BY NAM) "
+        "SELECT a.NAM, a.S, (SELECT COUNT(*) FROM HoaDon h WHERE h.NAM = 2020 AND h.KY = 5) AS N FROM A a")
+    assert data_sources._query_class('f_Select_SQL_Thutien', sql) == 'history'
+    unbounded = sql.replace("h . NAM = 2020 AND h . KY = 5", "h . DANHBA = a . NAM")
+    assert unbounded != sql
+    assert data_sources._query_class('f_Select_SQL_Thutien', unbounded) == 'default'
+
+
+class _TrickleHandler(BaseHTTPRequestHandler):
+    """Trả phản hồi nhỏ giọt: mỗi byte cách nhau 0,1 giây (không lần đọc socket nào chờ quá read timeout)."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', '1000')
+        self.end_headers()
+        try:
+            for _ in range(1000):
+                self.wfile.write(b' ')
+                self.wfile.flush()
+                time.sleep(0.1)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def test_api_call_enforces_total_deadline(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _TrickleHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(config, 'API_URL', f'http://127.0.0.1:{server.server_address[1]}/ws_Banggia.asmx')
+    monkeypatch.setattr(config, 'API_TIMEOUT', 1)
+    monkeypatch.setattr(config, 'API_RETRIES', 0)
+    monkeypatch.setattr(data_sources, '_API_BREAKER', data_sources._CircuitBreaker())
+    start = time.monotonic()
+    try:
+        with pytest.raises(ConnectionError):
+            data_sources._fetch_dataframe_uncached('f_Select_SQL_Thutien', 'SELECT 1')
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert time.monotonic() - start < 5
@@ -0,0 +1,499 @@
+"""
+Đo hiệu năng các luồng phân tích trên dữ liệu giả lập ở nhiều quy mô và so với kết quả đo chuẩn (baseline).
+
+Mỗi quy mô (số hoá đơn, ví dụ 10k, 100k, 1m) dùng một tệp dữ liệu sinh bằng tools/synthetic_data.py (có seed,
+tạo một lần rồi dùng lại), máy chủ SOAP giả lập (tools/soap_stub_server.py) chạy ở tiến trình riêng với độ trễ 0,
+và hai sheet database/ON_OFF giả lập dựng từ chính dữ liệu đó thay cho Google Sheets. Với mỗi luồng đo:
+- thời gian chạy (trung vị của --repeat lần, mỗi lần bắt đầu với cache API và bản sao sheet trống),
+- bộ nhớ cấp phát đỉnh (tracemalloc, một lần chạy riêng để không làm sai thời gian),
+- thời gian theo từng bước (tính gộp: bước con được tính cả trong bước cha) cùng số truy vấn và số byte nhận về,
+- dấu vân tay (sha256) của kết quả, để bản tối ưu phải cho ra kết quả y hệt bản trước.
+
+    python -m tools.benchmark --scales 10k,100k --update-baseline   # ghi kết quả đo chuẩn
+    python -m tools.benchmark --scales 10k,100k                      # so với kết quả đo chuẩn
+
+Trả về mã lỗi 1 nếu kết quả của một luồng khác bản chuẩn hoặc chậm hơn quá --tolerance.
+Dashboard lọc theo năm hiện tại (date.today()), nên bản chuẩn cần ghi lại khi sang năm mới.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(_ROOT)
+import config
+from tools import synthetic_data
+
+DEFAULT_AS_OF = date(2024, 6, 30)
+DEFAULT_SEED = 20240101
+DEFAULT_YEARS = 3
+_SCALE_SUFFIXES = {'k': 1_000, 'm': 1_000_000}
+_FLOAT_DECIMALS = 6  # Làm tròn số thực trước khi băm để bỏ qua sai số do đổi thứ tự cộng
+_LOCK_TYPES = ['Khóa van từ', 'Khóa van bấm chì', 'Khóa nút bít']
+
+# Các bước được đo trong từng luồng: (module, tên hàm); hàm được bọc tạm thời trong lúc đo
+_COMMON_STAGES = [('data_sources', 'fetch_dataframe'), ('data_sources', '_call_api')]
+PIPELINE_STAGES = {
+    'weekly_report': [('analysis_logic', '_report_prepare_initial_data'),
+                      ('data_sources', 'fetch_unpaid_debt_profile'),
+                      ('analysis_logic', '_report_enrich_data'),
+                      ('data_sources', 'fetch_bgw_payment_dates'), ('analysis_logic', '_report_process_final_data'),
+                      ('analysis_logic', '_report_build_summary'), ('analysis_logic', '_report_build_details'),
+                      ('analysis_logic', '_report_build_stats')],
+    'debt_filter': [('data_sources', 'get_unpaid_invoices'), ('data_sources', '_get_bgw_invoices'),
+                    ('data_sources', 'fetch_unpaid_debtor_totals'), ('data_sources', 'fetch_unpaid_invoices_for'),
+                    ('data_sources', 'get_customer_attributes'), ('analysis_logic', '_debt_filter_aggregate'),
+                    ('analysis_logic', '_debt_filter_select'), ('sheet_mirror', 'load_on_off_status')],
+    'dashboard': [('data_sources', 'get_unpaid_invoices'), ('data_sources', '_get_bgw_invoices'),
+                  ('data_sources', 'get_customer_attributes')],
+    'ghi_team': [],
+    'pdf_weekly_report': [('pdf_generator', '_build_html_content'), ('pdf_generator', 'HTML')],
+    'pdf_detailed_list': [('pdf_generator', 'HTML')],
+}
+# Một phiên làm việc: dashboard, báo cáo tuần rồi lọc tồn liên tiếp, dùng chung cache và ảnh chụp trong phiên
+PIPELINE_STAGES['session'] = list(dict.fromkeys(PIPELINE_STAGES['dashboard'] + PIPELINE_STAGES['weekly_report']
+                                                + PIPELINE_STAGES['debt_filter']))
+PDF_PIPELINES = ('pdf_weekly_report', 'pdf_detailed_list')
+
+
+def parse_scale(text):
+    """'10k' -> 10000, '1m' -> 1000000, '2500' -> 2500."""
+    text = text.strip().lower()
+    if text and text[-1] in _SCALE_SUFFIXES:
+        return int(float(text[:-1]) * _SCALE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+# ==============================================================================
+# DỮ LIỆU GIẢ LẬP
+# ==============================================================================
+def prepare_database(work_dir, invoices, seed=DEFAULT_SEED, as_of=DEFAULT_AS_OF, years=DEFAULT_YEARS):
+    """Tệp dữ liệu cho một quy mô; chỉ sinh lại khi chưa có hoặc được sinh với tham số khác."""
+    customers = max(1, -(-invoices // len(synthetic_data._periods(as_of, years))))
+    path = os.path.join(work_dir, f'data_{invoices}.db')
+    params = synthetic_data.read_params(path)
+    expected = {'customers': customers, 'years': years, 'seed': seed, 'as_of': as_of.isoformat()}
+    if params is None or any(params.get(key) != value for key, value in expected.items()):
+        synthetic_data.generate_database(path, customers=customers, years=years, seed=seed, as_of=as_of)
+        params = synthetic_data.read_params(path)
+    return path, params
+
+
+def build_sheet_values(db_path, seed, as_of, assignments, weeks=8):
+    """
+    Ma trận giá trị của sheet database và ON_OFF như Google Sheets trả về, dựng từ khách hàng còn nợ >= 2 kỳ:
+    `assignments` lượt giao rải trong `weeks` tuần tính đến as_of, khoảng một phần tư đã khoá (một số đã mở lại).
+    """
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        debtors = conn.execute(
+            "SELECT h.DANHBA, MAX(h.SO), MAX(h.DUONG), MAX(h.TENKH), COUNT(*), SUM(h.TONGCONG), "
+            "GROUP_CONCAT(printf('%02d/%d', h.KY, h.NAM), ','), MAX(h.GB), MAX(h.DOT), "
+            "MAX(k.SoMoi), MAX(k.HopBaoVe), MAX(k.SoThan) "
+            "FROM (SELECT * FROM HoaDon WHERE NGAYGIAI IS NULL ORDER BY DANHBA, NAM, KY) h "
+            "LEFT JOIN KhachHang k ON k.DanhBa = h.DANHBA "
+            "GROUP BY h.DANHBA HAVING COUNT(*) >= 2 ORDER BY h.DANHBA").fetchall()
+    finally:
+        conn.close()
+
+    rng = np.random.default_rng(seed)
+    count = min(assignments, len(debtors))
+    picked = np.sort(rng.choice(len(debtors), size=count, replace=False)) if count else np.array([], dtype=int)
+    offsets = rng.integers(0, weeks * 7, size=count)
+    groups = np.asarray(config.GROUP_OPTIONS[1:], dtype=object)[rng.integers(0, len(config.GROUP_OPTIONS) - 1,
+                                                                              size=count)]
+    order = np.lexsort((picked, -offsets))
+    locked = rng.random(count) < 0.25
+    lock_delay = rng.integers(0, 5, size=count)
+    reopened = rng.random(count) < 0.3
+    reopen_delay = rng.integers(1, 10, size=count)
+    lock_types = rng.integers(0, len(_LOCK_TYPES), size=count)
+    water_off = rng.random(count) < 0.05
+
+    header = config.DB_SHEET_FINAL_COLUMNS + [config.DB_COL_TINH_TRANG, config.DB_COL_GHI_CHU]
+    database = [header]
+    on_off = [[config.ON_OFF_COL_ID, config.ON_OFF_COL_DANH_BA, config.ON_OFF_COL_TINH_TRANG,
+               config.ON_OFF_COL_NGAY_KHOA, config.ON_OFF_COL_NGAY_MO, config.ON_OFF_COL_NHOM_KHOA,
+               config.ON_OFF_COL_KIEU_KHOA]]
+    for stt, i in enumerate(order, start=1):
+        danhba, so, duong, tenkh, tong_ky, tong_tien, ky_nam, gb, dot, so_moi, hop_bv, so_than = debtors[picked[i]]
+        assigned = as_of - timedelta(days=int(offsets[i]))
+        row_id = f"{danhba}-{assigned.strftime('%d%m%Y')}"
+        database.append([str(stt), danhba, so or '', so_moi or '', duong or '', tenkh or '', str(tong_ky),
+                         f'{tong_tien:.0f}', ky_nam, gb or '', str(dot), str(hop_bv or 0), so_than or '',
+                         groups[i], assigned.strftime(config.DATE_FORMAT_2), row_id,
+                         f'https://capnuocbenthanh.com/tra-cuu/?code={danhba}',
+                         'Khoá nước' if water_off[i] else '', ''])
+        if locked[i]:
+            lock_date = min(assigned + timedelta(days=int(lock_delay[i])), as_of)
+            open_date = lock_date + timedelta(days=int(reopen_delay[i]))
+            is_open = reopened[i] and open_date <= as_of
+            on_off.append([row_id, danhba, 'Đã mở' if is_open else 'Đang khóa',
+                           f"{lock_date.strftime(config.DATE_FORMAT_2)} 08:30:00",
+                           open_date.strftime(config.DATE_FORMAT_2) if is_open else '',
+                           groups[i], _LOCK_TYPES[lock_types[i]]])
+    return {config.DB_SHEET: database, config.ON_OFF_SHEET: on_off}
+
+
+# ==============================================================================
+# MÔI TRƯỜNG CHẠY
+# ==============================================================================
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_server(db_path, timeout=30.0, latency=0.0):
+    """
+    Chạy máy chủ SOAP giả lập ở tiến trình riêng (không tranh GIL, không lẫn vào số đo bộ nhớ).
+    latency: độ trễ giả lập mỗi yêu cầu (giây), để thấy tác dụng của việc gửi truy vấn song song.
+    """
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'tools.soap_stub_server', '--db', db_path, '--port', str(port),
+                                '--latency', str(latency)],
+                               cwd=_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Máy chủ giả lập dừng với mã {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, f'http://127.0.0.1:{port}/ws_Banggia.asmx'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Máy chủ giả lập không khởi động kịp.")
+
+
+class _StageTimer:
+    """Bọc tạm thời các hàm của từng bước để cộng dồn thời gian và số lần gọi (an toàn khi gọi từ nhiều luồng)."""
+
+    def __init__(self, modules, stages):
+        self._targets = [(modules[module], name) for module, name in stages if hasattr(modules.get(module), name)]
+        self._originals = []
+        self._lock = threading.Lock()
+        self.totals = {}
+
+    def _wrap(self, label, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    entry = self.totals.setdefault(label, {'seconds': 0.0, 'calls': 0})
+                    entry['seconds'] += elapsed
+                    entry['calls'] += 1
+        return timed
+
+    def __enter__(self):
+        for module, name in self._targets:
+            original = getattr(module, name)
+            self._originals.append((module, name, original))
+            setattr(module, name, self._wrap(name, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for module, name, original in reversed(self._originals):
+            setattr(module, name, original)
+        self._originals = []
+
+
+class BenchmarkEnvironment:
+    """
+    Môi trường cô lập cho các backend module: thư mục làm việc riêng (api_cache, bản sao sheet),
+    API_URL trỏ tới máy chủ giả lập và data_sources.fetch_sheet_values trả về sheet giả lập.
+    """
+
+    def __init__(self, work_dir, api_url, sheet_values):
+        os.makedirs(work_dir, exist_ok=True)
+        os.chdir(work_dir)  # diskcache 'api_cache' của data_sources tạo theo thư mục hiện hành khi import
+        config.API_URL = api_url
+        config.SHEET_MIRROR_PATH = os.path.join(work_dir, 'sheet_mirror.db')
+        from backend import analysis_logic, data_sources, sheet_mirror
+        self.modules = {'analysis_logic': analysis_logic, 'data_sources': data_sources, 'sheet_mirror': sheet_mirror}
+        try:
+            from backend import pdf_generator
+            self.modules['pdf_generator'] = pdf_generator
+        except (ImportError, OSError) as e:
+            # WeasyPrint (và thư viện hệ thống của nó) là phụ thuộc tuỳ chọn khi đo
+            logging.warning(f"Bỏ qua đo PDF, không tải được pdf_generator: {e}")
+        self.sheet_values = sheet_values
+        data_sources.fetch_sheet_values = self._fetch_sheet_values
+
+    def _fetch_sheet_values(self, ranges):
+        for item in ranges:
+            if not isinstance(item, str):
+                raise NotImplementedError(f"Sheet giả lập chỉ hỗ trợ đọc cả worksheet, không hỗ trợ vùng {item!r}")
+        return [self.sheet_values.get(name, []) for name in ranges]
+
+    def reset(self):
+        """Xoá cache API, bản sao sheet, ảnh chụp hoá đơn chưa giải, bộ gốc lọc tồn và số liệu truy vấn để mỗi lần đo như nhau."""
+        data_sources = self.modules['data_sources']
+        data_sources.CACHE.clear()
+        for query_class in config.API_CACHE_POLICY:
+            data_sources._cache_for(query_class).clear()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(config.SHEET_MIRROR_PATH + suffix):
+                os.remove(config.SHEET_MIRROR_PATH + suffix)
+        data_sources.reset_query_metrics()
+        data_sources.reset_unpaid_snapshot()
+        data_sources.reset_customer_dimension()
+        data_sources.reset_bgw_paid_index()
+        self.modules['analysis_logic'].reset_debt_filter_cache()
+
+
+# ==============================================================================
+# CÁC LUỒNG ĐƯỢC ĐO
+# ==============================================================================
+def _weekly_report_args(as_of):
+    return ((as_of - timedelta(days=6)).strftime(config.DATE_FORMAT_2), as_of.strftime(config.DATE_FORMAT_2),
+            config.GROUP_OPTIONS[0], as_of.strftime(config.DATE_FORMAT_2))
+
+
+def _debt_filter_params(as_of):
+    return {'nam': as_of.year, 'ky': as_of.month, 'min_tongky': 2, 'min_tongcong': 0,
+            'exclude_codemoi': ['K', 'N', '66', 'K2'], 'dot_filter': [], 'limit': 1000}
+
+
+def _weekly_pdf_data(report):
+    return {'start_date_str': report['start_date_str'], 'end_date_str': report['end_date_str'],
+            'selected_group': report['selected_group'],
+            'tables': {'BẢNG TỔNG HỢP:': report['summary_df'], 'BẢNG THỐNG KÊ CHI TIẾT:': report['stats_df']}}
+
+
+def _pdf_bytes(result):
+    success, payload = result
+    if not success:
+        raise RuntimeError(payload)
+    return payload
+
+
+def build_pipelines(env, as_of):
+    """Hàm không tham số cho từng luồng; các luồng PDF dùng kết quả báo cáo tuần dựng sẵn (không tính vào thời gian)."""
+    analysis_logic = env.modules['analysis_logic']
+    pipelines = {
+        'weekly_report': lambda: analysis_logic.run_weekly_report_analysis(*_weekly_report_args(as_of)),
+        'debt_filter': lambda: analysis_logic.run_debt_filter_analysis(_debt_filter_params(as_of)),
+        'dashboard': analysis_logic.fetch_dashboard_data,
+        'ghi_team': lambda: analysis_logic.get_ghi_team_analysis_data(None, as_of.year, as_of.month),
+    }
+    pipelines['session'] = lambda: [pipelines[name]() for name in ('dashboard', 'weekly_report', 'debt_filter')]
+    pdf_generator = env.modules.get('pdf_generator')
+    if pdf_generator is not None:
+        env.reset()
+        report = pipelines['weekly_report']()
+        details = report.get('details_df', pd.DataFrame()).astype(str) if 'error' not in report else pd.DataFrame()
+        pipelines['pdf_weekly_report'] = lambda: _pdf_bytes(pdf_generator.create_pdf_report(_weekly_pdf_data(report)))
+        pipelines['pdf_detailed_list'] = lambda: _pdf_bytes(
+            pdf_generator.create_detailed_list_pdf('DANH SÁCH KHÁCH HÀNG CHI TIẾT', details))
+    return pipelines
+
+
+# ==============================================================================
+# ĐO VÀ SO SÁNH
+# ==============================================================================
+def _canonical(value):
+    """Dạng văn bản ổn định của kết quả để băm (số thực làm tròn, khoá dict sắp xếp)."""
+    if isinstance(value, pd.Series):
+        value = value.to_frame()
+    if isinstance(value, pd.DataFrame):
+        header = json.dumps([list(map(str, value.columns)), [str(t) for t in value.dtypes]], ensure_ascii=False)
+        return header + '\n' + value.to_csv(float_format=f'%.{_FLOAT_DECIMALS}f', date_format='%Y-%m-%d %H:%M:%S%z')
+    if isinstance(value, dict):
+        return '{' + ','.join(f'{json.dumps(str(k), ensure_ascii=False)}:{_canonical(value[k])}'
+                              for k in sorted(value, key=str)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_canonical(v) for v in value) + ']'
+    if isinstance(value, (float, np.floating)):
+        return repr(round(float(value), _FLOAT_DECIMALS))
+    if isinstance(value, np.generic):
+        return repr(value.item())
+    return repr(value)
+
+
+def output_summary(name, value):
+    """Dấu vân tay và kích thước kết quả; PDF chứa ngày tạo nên chỉ ghi kích thước."""
+    if name in PDF_PIPELINES:
+        return {'output_digest': None, 'output_size': len(value)}
+    size = len(value) if isinstance(value, (pd.DataFrame, pd.Series, dict)) else None
+    return {'output_digest': hashlib.sha256(_canonical(value).encode('utf-8')).hexdigest(), 'output_size': size}
+
+
+def run_pipeline(env, name, func, repeat):
+    """Chạy một luồng `repeat` lần để đo thời gian (kèm từng bước) và một lần có tracemalloc để đo bộ nhớ đỉnh."""
+    data_sources = env.modules['data_sources']
+    runs, stage_runs, output = [], [], None
+    for _ in range(repeat):
+        env.reset()
+        with _StageTimer(env.modules, _COMMON_STAGES + PIPELINE_STAGES[name]) as timer:
+            start = time.perf_counter()
+            output = func()
+            runs.append(time.perf_counter() - start)
+        stage_runs.append(timer.totals)
+    metrics = data_sources.get_query_metrics()
+
+    env.reset()
+    tracemalloc.start()
+    try:
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    median_index = runs.index(statistics.median_low(runs))
+    result = {
+        'wall_seconds': statistics.median(runs),
+        'runs': runs,
+        'peak_mb': peak_bytes / 2 ** 20,
+        'stages': stage_runs[median_index],
+        'queries': sum(entry['count'] for entry in metrics),
+        'response_bytes': sum(entry['response_bytes'] for entry in metrics),
+    }
+    result.update(output_summary(name, output))
+    return result
+
+
+def compare_results(current, baseline, tolerance):
+    """Danh sách (quy mô, luồng, tỉ lệ thời gian, trạng thái) so với bản chuẩn; trạng thái 'ok' khi không có vấn đề."""
+    rows = []
+    for scale, scale_result in current['scales'].items():
+        base_scale = baseline.get('scales', {}).get(scale)
+        if base_scale is None:
+            continue
+        if base_scale['data'] != scale_result['data']:
+            rows.append((scale, '*', None, 'dữ liệu khác bản chuẩn, bỏ qua so sánh'))
+            continue
+        for name, result in scale_result['pipelines'].items():
+            base = base_scale['pipelines'].get(name)
+            if base is None:
+                continue
+            ratio = result['wall_seconds'] / base['wall_seconds'] if base['wall_seconds'] else None
+            if result['output_digest'] != base['output_digest']:
+                status = 'KẾT QUẢ KHÁC'
+            elif ratio is not None and ratio > 1 + tolerance:
+                status = 'CHẬM HƠN'
+            elif ratio is not None and ratio < 1 - tolerance:
+                status = 'nhanh hơn'
+            else:
+                status = 'ok'
+            rows.append((scale, name, ratio, status))
+    return rows
+
+
+def _format_report(current, comparison):
+    lines = []
+    for scale, scale_result in current['scales'].items():
+        counts = scale_result['data']['counts']
+        lines.append(f"\n=== {scale}: {counts['HoaDon']:,} hoá đơn, {counts['KhachHang']:,} khách hàng ===")
+        lines.append(f"{'Luồng':<20}{'Thời gian (s)':>15}{'Bộ nhớ đỉnh (MB)':>18}{'Truy vấn':>10}{'KB nhận':>12}")
+        for name, result in scale_result['pipelines'].items():
+            lines.append(f"{name:<20}{result['wall_seconds']:>15.3f}{result['peak_mb']:>18.1f}"
+                         f"{result['queries']:>10}{result['response_bytes'] / 1024:>12.0f}")
+            for stage, entry in sorted(result['stages'].items(), key=lambda item: -item[1]['seconds']):
+                lines.append(f"    {stage:<36}{entry['seconds']:>9.3f}s  x{entry['calls']}")
+    if comparison:
+        lines.append("\n=== So với bản chuẩn ===")
+        for scale, name, ratio, status in comparison:
+            ratio_text = f"{ratio:.2f}x" if ratio is not None else '-'
+            lines.append(f"{scale:<8}{name:<20}{ratio_text:>8}  {status}")
+    return '\n'.join(lines)
+
+
+def run_benchmarks(scales, work_dir, repeat=3, seed=DEFAULT_SEED, as_of=DEFAULT_AS_OF, pipelines=None, latency=0.0):
+    """Đo các luồng ở từng quy mô (số hoá đơn); trả về kết quả dạng dict có thể ghi ra JSON."""
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    current = {'created_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+               'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+               'repeat': repeat, 'api_latency': latency, 'scales': {}}
+    env = None
+    for invoices in scales:
+        label = f'{invoices:,}'
+        db_path, params = prepare_database(work_dir, invoices, seed=seed, as_of=as_of)
+        sheet_values = build_sheet_values(db_path, seed, as_of, assignments=max(50, invoices // 200))
+        process, api_url = start_stub_server(db_path, latency=latency)
+        try:
+            if env is None:
+                env = BenchmarkEnvironment(os.path.join(work_dir, 'runtime'), api_url, sheet_values)
+            else:
+                config.API_URL, env.sheet_values = api_url, sheet_values
+            available = build_pipelines(env, as_of)
+            results = {}
+            for name, func in available.items():
+                if pipelines and name not in pipelines:
+                    continue
+                logging.info(f"[{label}] Đo '{name}'...")
+                results[name] = run_pipeline(env, name, func, repeat)
+            current['scales'][label] = {
+                'data': {key: params[key] for key in ('customers', 'years', 'seed', 'as_of', 'counts')},
+                'sheet_rows': {name: len(values) - 1 for name, values in sheet_values.items()},
+                'pipelines': results,
+            }
+        finally:
+            process.terminate()
+            process.wait()
+    return current
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Đo hiệu năng các luồng phân tích trên dữ liệu giả lập.')
+    parser.add_argument('--scales', default='10k,100k', help='Các quy mô (số hoá đơn), ví dụ 10k,100k,1m')
+    parser.add_argument('--pipelines', default=None, help=f'Chỉ đo các luồng này: {",".join(PIPELINE_STAGES)}')
+    parser.add_argument('--repeat', type=int, default=3, help='Số lần đo thời gian mỗi luồng (lấy trung vị)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--as-of', type=date.fromisoformat, default=DEFAULT_AS_OF,
+                        help='Ngày "hiện tại" của dữ liệu giả lập (YYYY-MM-DD)')
+    parser.add_argument('--work-dir', default='.benchmark', help='Thư mục chứa dữ liệu sinh ra và cache khi đo')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='Tệp kết quả đo chuẩn')
+    parser.add_argument('--update-baseline', action='store_true', help='Ghi kết quả lần này làm bản chuẩn')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Mức chậm hơn cho phép so với bản chuẩn')
+    parser.add_argument('--output', default=None, help='Ghi kết quả lần này ra tệp JSON')
+    parser.add_argument('--latency', type=float, default=0.0, help='Độ trễ giả lập mỗi truy vấn API (giây)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    baseline_path, output_path = os.path.abspath(args.baseline), args.output and os.path.abspath(args.output)
+    scales = [parse_scale(s) for s in args.scales.split(',') if s.strip()]
+    pipelines = set(args.pipelines.split(',')) if args.pipelines else None
+    logging.getLogger().setLevel(logging.WARNING)  # Log của backend quá nhiều khi đo
+    warnings.simplefilter('ignore', FutureWarning)
+    current = run_benchmarks(scales, args.work_dir, repeat=args.repeat, seed=args.seed, as_of=args.as_of,
+                             pipelines=pipelines, latency=args.latency)
+
+    comparison = []
+    if os.path.exists(baseline_path) and not args.update_baseline:
+        with open(baseline_path, encoding='utf-8') as f:
+            comparison = compare_results(current, json.load(f), args.tolerance)
+    print(_format_report(current, comparison))
+
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.update_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"\nĐã ghi bản chuẩn: {baseline_path}")
+    return 1 if any(status in ('KẾT QUẢ KHÁC', 'CHẬM HƠN') for _, _, _, status in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""
+Máy chủ SOAP giả lập ws_Banggia.asmx cho thử nghiệm và đo hiệu năng không cần máy chủ thật.
+
+Nhận đúng phong bì SOAP mà data_sources._build_soap_request gửi (f_Select_SQL_Thutien, f_Select_SQL_Doc_so,
+f_Select_SQL_Nganhang), dịch câu T-SQL sang SQLite, chạy trên tệp dữ liệu giả lập (tools/synthetic_data.py)
+và trả về phản hồi dạng DataSet diffgram như ASP.NET. Có thể giả lập độ trễ, băng thông, lỗi tạm thời và nén gzip.
+
+    python -m tools.soap_stub_server --db stub_data.db --port 8065 --latency 0.2 --bandwidth 2000000
+    # rồi đặt config.API_URL = 'http://127.0.0.1:8065/ws_Banggia.asmx'
+
+Chỉ hỗ trợ phần T-SQL mà ứng dụng dùng (TOP, OFFSET/FETCH, ISNULL, TRY_CAST, YEAR/MONTH/DAY,
+CAST(... AS DATE), N'...', VARCHAR(MAX)); câu lệnh không dịch được trả về SOAP Fault như máy chủ thật.
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from tools import synthetic_data
+
+FUNCTIONS = frozenset(['f_Select_SQL_Thutien', 'f_Select_SQL_Doc_so', 'f_Select_SQL_Nganhang'])
+_SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+_FETCH_ROWS = 2000  # Số dòng lấy từ SQLite và ghi ra mỗi lần
+_WRITE_CHUNK = 64 * 1024
+
+_STRING_RE = re.compile(r"N?'(?:[^']|'')*'")
+_TOP_RE = re.compile(r"\bSELECT\s+(DISTINCT\s+)?TOP\s*\(?\s*(\d+)\s*\)?", re.IGNORECASE)
+_OFFSET_FETCH_RE = re.compile(r"\bOFFSET\s+(\d+)\s+ROWS?\s+FETCH\s+(?:NEXT|FIRST)\s+(\d+)\s+ROWS?\s+ONLY\b",
+                              re.IGNORECASE)
+_CALL_RE = re.compile(r"\b(YEAR|MONTH|DAY|CAST)\s*\(", re.IGNORECASE)
+_SIMPLE_REWRITES = [
+    (re.compile(r"\bISNULL\s*\(", re.IGNORECASE), 'IFNULL('),
+    (re.compile(r"\bTRY_CAST\s*\(", re.IGNORECASE), 'CAST('),
+    (re.compile(r"\bN?VARCHAR\s*\(\s*MAX\s*\)", re.IGNORECASE), 'TEXT'),
+    (re.compile(r"\bGETDATE\s*\(\s*\)", re.IGNORECASE), "datetime('now', 'localtime')"),
+    (re.compile(r"\bLEN\s*\(", re.IGNORECASE), 'LENGTH('),
+]
+_DATE_VALUE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}:\d{2})?$")
+
+
+def _matching_paren(text, open_pos):
+    depth = 0
+    for pos in range(open_pos, len(text)):
+        if text[pos] == '(':
+            depth += 1
+        elif text[pos] == ')':
+            depth -= 1
+            if depth == 0:
+                return pos
+    raise ValueError("Thiếu dấu ')' trong câu lệnh SQL.")
+
+
+def _split_top_level_as(inner):
+    """Tách 'biểu thức AS kiểu' ở mức ngoặc ngoài cùng của CAST(...)."""
+    depth = 0
+    for match in re.finditer(r"[()]|\bAS\b", inner, re.IGNORECASE):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0:
+            return inner[:match.start()], inner[match.end():].strip()
+    raise ValueError(f"CAST không có AS: {inner}")
+
+
+def _rewrite_calls(text):
+    # Xử lý từ phải sang trái: lời gọi lồng bên trong (nằm bên phải dấu '(' của lời gọi ngoài) được dịch trước
+    for match in reversed(list(_CALL_RE.finditer(text))):
+        name = match.group(1).upper()
+        open_pos = match.end() - 1
+        close_pos = _matching_paren(text, open_pos)
+        inner = text[open_pos + 1:close_pos]
+        if name == 'CAST':
+            expression, target = _split_top_level_as(inner)
+            if target.upper() == 'DATE':
+                replacement = f"date({expression})"
+            elif target.upper() in ('DATETIME', 'SMALLDATETIME'):
+                replacement = f"datetime({expression})"
+            else:
+                continue
+        else:
+            pattern = {'YEAR': '%Y', 'MONTH': '%m', 'DAY': '%d'}[name]
+            replacement = f"CAST(strftime('{pattern}', {inner}) AS INTEGER)"
+        text = text[:match.start()] + replacement + text[close_pos + 1:]
+    return text
+
+
+def translate_tsql(sql):
+    """Dịch câu T-SQL của ứng dụng sang SQLite; báo ValueError nếu gặp cú pháp không hỗ trợ."""
+    literals = []
+
+    def _stash(match):
+        literals.append(match.group().lstrip('N'))
+        return f'\x00{len(literals) - 1}\x00'
+
+    text = _STRING_RE.sub(_stash, sql)
+    for pattern, replacement in _SIMPLE_REWRITES:
+        text = pattern.sub(replacement, text)
+    text = _OFFSET_FETCH_RE.sub(lambda m: f"LIMIT {m.group(2)} OFFSET {m.group(1)}", text)
+
+    tops = list(_TOP_RE.finditer(text))
+    if tops:
+        first_select = re.search(r"\bSELECT\b", text, re.IGNORECASE)
+        if len(tops) > 1 or tops[0].start() != first_select.start() or re.match(r"\s*WITH\b", text, re.IGNORECASE):
+            raise ValueError("Chỉ hỗ trợ TOP ở câu SELECT ngoài cùng.")
+        top = tops[0]
+        text = text[:top.start()] + 'SELECT ' + (top.group(1) or '') + text[top.end():]
+        text = re.sub(r"[\s;]*$", '', text) + f" LIMIT {top.group(2)}"
+
+    text = _rewrite_calls(text)
+    return re.sub('\x00(\\d+)\x00', lambda m: literals[int(m.group(1))], text)
+
+
+def _xml_name(name, index, seen):
+    """Tên cột hợp lệ cho phần tử XML; cột không tên thành ColumnN, trùng tên thì thêm số như DataSet."""
+    if not name or not re.fullmatch(r"[^\W\d]\w*", name):
+        name = f'Column{index + 1}'
+    base, suffix = name, 1
+    while name in seen:
+        name = f'{base}{suffix}'
+        suffix += 1
+    seen.add(name)
+    return name
+
+
+def _xml_value(value):
+    if isinstance(value, str):
+        if _DATE_VALUE_RE.match(value):
+            # DataSet ghi DateTime theo ISO 8601 kèm múi giờ máy chủ
+            return value.replace(' ', 'T') + ('T00:00:00' if len(value) == 10 else '') + '+07:00'
+        return escape(value)
+    return repr(value)
+
+
+def render_response(function_name, cursor):
+    """Sinh dần (theo từng khối byte) phản hồi SOAP chứa DataSet diffgram từ cursor SQLite đã thực thi."""
+    seen = set()
+    columns = [_xml_name(desc[0], i, seen) for i, desc in enumerate(cursor.description or [])]
+    yield (f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{_SOAP_NS}" '
+           'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">'
+           f'<soap:Body><{function_name}Response xmlns="http://tempuri.org/"><{function_name}Result>'
+           '<xs:schema id="NewDataSet" xmlns="" xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+           'xmlns:msdata="urn:schemas-microsoft-com:xml-msdata"><xs:element name="NewDataSet" '
+           'msdata:IsDataSet="true" msdata:UseCurrentLocale="true"/></xs:schema>'
+           '<diffgr:diffgram xmlns:msdata="urn:schemas-microsoft-com:xml-msdata" '
+           'xmlns:diffgr="urn:schemas-microsoft-com:xml-diffgram-v1">').encode('utf-8')
+    row_index = 0
+    opened = False
+    while True:
+        rows = cursor.fetchmany(_FETCH_ROWS)
+        if not rows:
+            break
+        parts = [] if opened else ['<NewDataSet xmlns="">']
+        opened = True
+        for row in rows:
+            row_index += 1
+            parts.append(f'<Table1 diffgr:id="Table1{row_index}" msdata:rowOrder="{row_index - 1}">')
+            # Giống DataSet: cột NULL không được ghi ra
+            parts.extend(f'<{name}>{_xml_value(value)}</{name}>'
+                         for name, value in zip(columns, row) if value is not None)
+            parts.append('</Table1>')
+        yield ''.join(parts).encode('utf-8')
+    tail = '</NewDataSet>' if opened else ''
+    yield (f'{tail}</diffgr:diffgram></{function_name}Result></{function_name}Response>'
+           '</soap:Body></soap:Envelope>').encode('utf-8')
+
+
+def _soap_fault(message):
+    return (f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{_SOAP_NS}"><soap:Body>'
+            f'<soap:Fault><faultcode>soap:Server</faultcode><faultstring>{escape(message)}</faultstring>'
+            '</soap:Fault></soap:Body></soap:Envelope>').encode('utf-8')
+
+
+def parse_request(body):
+    """Trả về (tên hàm, câu SQL) từ phong bì SOAP của _build_soap_request."""
+    root = ElementTree.fromstring(body)
+    call = next(iter(root.find(f'{{{_SOAP_NS}}}Body')))
+    function_name = call.tag.split('}', 1)[-1]
+    sql = call.findtext('{http://tempuri.org/}m_sql') or ''
+    return function_name, sql
+
+
+class StubSettings:
+    """Thông số giả lập mạng/máy chủ; đọc mỗi lần có yêu cầu nên có thể đổi khi máy chủ đang chạy."""
+
+    def __init__(self, db_path, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, gzip=True):
+        self.db_path = db_path
+        self.latency = latency  # Độ trễ cố định trước khi trả lời (giây)
+        self.jitter = jitter  # Cộng thêm ngẫu nhiên trong [0, jitter] giây
+        self.bandwidth = bandwidth  # Byte/giây khi gửi phản hồi; None là không giới hạn
+        self.error_rate = error_rate  # Tỉ lệ yêu cầu trả về HTTP 503 (lỗi tạm thời)
+        self.gzip = gzip  # Nén gzip khi client gửi Accept-Encoding: gzip
+        self.stats = {'requests': 0, 'errors': 0, 'faults': 0, 'bytes_sent': 0}
+        self.lock = threading.Lock()
+        self.query_log = []  # (hàm, SQL) của các yêu cầu đã nhận, để kiểm tra trong phép đo
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Microsoft-IIS/10.0'
+    settings = None  # Gán bởi make_server
+
+    def log_message(self, fmt, *args):
+        logging.debug(fmt % args)
+
+    def _send_bytes(self, status, body, content_type='text/xml; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_throttled(self, data, state):
+        bandwidth = self.settings.bandwidth
+        for start in range(0, len(data), _WRITE_CHUNK):
+            piece = data[start:start + _WRITE_CHUNK]
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+            state['sent'] += len(piece)
+            if bandwidth:
+                delay = state['start'] + state['sent'] / bandwidth - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def do_POST(self):
+        settings = self.settings
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with settings.lock:
+            settings.stats['requests'] += 1
+        if settings.error_rate and random.random() < settings.error_rate:
+            with settings.lock:
+                settings.stats['errors'] += 1
+            self._send_bytes(503, b'Service Unavailable', 'text/plain')
+            return
+        delay = settings.latency + (random.uniform(0, settings.jitter) if settings.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        conn = None
+        try:
+            function_name, sql = parse_request(body)
+            if function_name not in FUNCTIONS:
+                raise ValueError(f"Không có hàm {function_name}.")
+            with settings.lock:
+                settings.query_log.append((function_name, sql))
+            conn = sqlite3.connect(f'file:{settings.db_path}?mode=ro', uri=True, check_same_thread=False)
+            cursor = conn.execute(translate_tsql(sql))
+            chunks = render_response(function_name, cursor)
+            first = next(chunks)  # Lỗi khi chạy câu lệnh xuất hiện trước khi gửi header
+        except (ValueError, sqlite3.Error, ElementTree.ParseError, StopIteration, AttributeError) as e:
+            if conn is not None:
+                conn.close()
+            with settings.lock:
+                settings.stats['faults'] += 1
+            logging.warning(f"SOAP Fault: {e}")
+            self._send_bytes(500, _soap_fault(f"System.Data.SqlClient.SqlException: {e}"))
+            return
+
+        use_gzip = settings.gzip and 'gzip' in self.headers.get('Accept-Encoding', '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+        state = {'start': time.monotonic(), 'sent': 0}
+        try:
+            for piece in itertools.chain([first], chunks):
+                out = compressor.compress(piece) if compressor else piece
+                if out:
+                    self._write_throttled(out, state)
+            if compressor:
+                self._write_throttled(compressor.flush(), state)
+            self.wfile.write(b'0\r\n\r\n')
+        except sqlite3.Error as e:
+            # Header đã gửi: ngắt kết nối để client nhận lỗi đọc phản hồi thay vì dữ liệu cắt cụt
+            logging.warning(f"Lỗi khi đọc kết quả: {e}")
+            self.close_connection = True
+        finally:
+            conn.close()
+        with settings.lock:
+            settings.stats['bytes_sent'] += state['sent']
+
+
+def make_server(db_path, host='127.0.0.1', port=0, **settings):
+    """
+    Tạo máy chủ giả lập (chưa chạy); port=0 để hệ điều hành chọn cổng trống.
+    Trả về (server, settings); URL dùng cho config.API_URL là http://host:port/ws_Banggia.asmx.
+    """
+    if synthetic_data.read_params(db_path) is None:
+        raise FileNotFoundError(f"Không tìm thấy dữ liệu giả lập: {db_path} (chạy tools/synthetic_data.py trước).")
+    stub_settings = StubSettings(db_path, **settings)
+    handler = type('StubHandler', (_Handler,), {'settings': stub_settings})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server, stub_settings
+
+
+def start_in_background(db_path, **settings):
+    """Chạy máy chủ giả lập trên một luồng nền; trả về (server, settings, url). Dừng bằng server.shutdown()."""
+    server, stub_settings = make_server(db_path, **settings)
+    threading.Thread(target=server.serve_forever, name='soap_stub', daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, stub_settings, f'http://{host}:{port}/ws_Banggia.asmx'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Máy chủ SOAP giả lập ws_Banggia.asmx trên dữ liệu SQLite.')
+    parser.add_argument('--db', default='stub_data.db', help='Tệp dữ liệu giả lập (tools/synthetic_data.py)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8065)
+    parser.add_argument('--latency', type=float, default=0.0, help='Độ trễ mỗi yêu cầu (giây)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Độ trễ ngẫu nhiên cộng thêm tối đa (giây)')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Giới hạn băng thông (byte/giây)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Tỉ lệ yêu cầu trả về HTTP 503')
+    parser.add_argument('--no-gzip', action='store_true', help='Không nén phản hồi')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server, _ = make_server(args.db, args.host, args.port, latency=args.latency, jitter=args.jitter,
+                            bandwidth=args.bandwidth, error_rate=args.error_rate, gzip=not args.no_gzip)
+    logging.info(f"Máy chủ giả lập chạy tại http://{args.host}:{server.server_address[1]}/ws_Banggia.asmx "
+                 f"(dữ liệu {synthetic_data.read_params(args.db)['counts']})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Sinh dữ liệu giả lập (có seed, tái lập được) cho các bảng HoaDon, DocSo, KhachHang, BGW_HD và ThuUNC
+vào một tệp SQLite, dùng cho máy chủ SOAP giả lập (tools/soap_stub_server.py) và các phép đo hiệu năng.
+
+Số hoá đơn = số khách hàng x số kỳ (tháng) trong khoảng `years` năm tính đến `as_of`; dữ liệu được sinh
+theo từng khối khách hàng nên có thể lên tới hàng triệu hoá đơn mà không giữ cả bảng trong bộ nhớ.
+Cùng seed, as_of và kích thước luôn cho ra cùng một cơ sở dữ liệu.
+
+    python -m tools.synthetic_data --db stub_data.db --invoices 1000000 --years 4 --as-of 2024-06-30
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import date
+
+import numpy as np
+
+# Tên cột theo đúng cách các câu SQL của ứng dụng tham chiếu tới (SQLite không phân biệt hoa/thường)
+SCHEMA = {
+    'HoaDon': [
+        ('DANHBA', 'TEXT'), ('SOHOADON', 'TEXT'), ('NAM', 'INTEGER'), ('KY', 'INTEGER'), ('DOT', 'INTEGER'),
+        ('GB', 'TEXT'), ('TENKH', 'TEXT'), ('SO', 'TEXT'), ('DUONG', 'TEXT'), ('TONGCONG_BD', 'REAL'),
+        ('TONGCONG', 'REAL'), ('Ngay_NhanHD', 'TEXT'), ('NGAYGIAI', 'TEXT'), ('NV_GIAI', 'TEXT'),
+    ],
+    'KhachHang': [
+        ('DanhBa', 'TEXT'), ('MLT2', 'TEXT'), ('GB', 'TEXT'), ('Dot', 'INTEGER'), ('May', 'INTEGER'),
+        ('SoMoi', 'TEXT'), ('Duong', 'TEXT'), ('SoThan', 'TEXT'), ('Hieu', 'TEXT'), ('Co', 'INTEGER'),
+        ('HopBaoVe', 'INTEGER'), ('SDT', 'TEXT'),
+    ],
+    'DocSo': [
+        ('DanhBa', 'TEXT'), ('MLT2', 'TEXT'), ('SoNhaCu', 'TEXT'), ('SoNhaMoi', 'TEXT'), ('Duong', 'TEXT'),
+        ('SDT', 'TEXT'), ('GB', 'TEXT'), ('DM', 'INTEGER'), ('Nam', 'INTEGER'), ('Ky', 'INTEGER'),
+        ('Dot', 'INTEGER'), ('May', 'INTEGER'), ('TBTT', 'INTEGER'), ('CSCu', 'INTEGER'), ('CSMoi', 'INTEGER'),
+        ('CodeMoi', 'TEXT'), ('TieuThuCu', 'INTEGER'), ('TieuThuMoi', 'INTEGER'), ('TuNgay', 'TEXT'),
+        ('DenNgay', 'TEXT'), ('TienNuoc', 'REAL'), ('BVMT', 'REAL'), ('Thue', 'REAL'), ('TongTien', 'REAL'),
+        ('SoThanCu', 'TEXT'), ('HieuCu', 'TEXT'), ('CoCu', 'INTEGER'), ('ViTriCu', 'TEXT'),
+        ('CongDungCu', 'TEXT'), ('CongDungMoi', 'TEXT'), ('DMACu', 'INTEGER'), ('GhiChuKH', 'TEXT'),
+        ('GhiChuDS', 'TEXT'), ('GhiChuTV', 'TEXT'), ('NVGHI', 'TEXT'), ('GIOGHI', 'TEXT'), ('GPSDATA', 'TEXT'),
+        ('VTGHI', 'TEXT'), ('StaCapNhat', 'TEXT'), ('MayTheoMLT', 'INTEGER'), ('LichSu', 'TEXT'),
+        ('SDTNT', 'TEXT'), ('BVMTVAT', 'REAL'),
+    ],
+    'BGW_HD': [
+        ('SHDon', 'TEXT'), ('DanhBa', 'TEXT'), ('SoTien', 'REAL'), ('NgayThanhToan', 'TEXT'), ('NganHang', 'TEXT'),
+    ],
+    'ThuUNC': [
+        ('SoBK', 'TEXT'), ('SHDon', 'TEXT'), ('DanhBa', 'TEXT'), ('NgayThu', 'TEXT'), ('Giaban', 'REAL'),
+        ('Thue', 'REAL'), ('Phi', 'REAL'), ('ThueDVTN', 'REAL'),
+    ],
+}
+INDEXES = [
+    ('HoaDon', 'NGAYGIAI'), ('HoaDon', 'NAM, KY'), ('HoaDon', 'DANHBA'), ('HoaDon', 'SOHOADON'),
+    ('KhachHang', 'DanhBa'), ('DocSo', 'Nam, Ky'), ('DocSo', 'DanhBa'), ('DocSo', 'May'),
+    ('BGW_HD', 'SHDon'), ('ThuUNC', 'NgayThu'),
+]
+
+_HO = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ', 'Hồ', 'Ngô']
+_TEN = ['Văn An', 'Thị Bình', 'Minh Châu', 'Quốc Dũng', 'Thị Hoa', 'Văn Hùng', 'Ngọc Lan', 'Thanh Long',
+        'Thị Mai', 'Văn Nam', 'Hữu Phúc', 'Thị Thu', 'Minh Tuấn', 'Thị Yến', 'Công Ty TNHH Sao Mai']
+_DUONG = ['Lê Lợi', 'Nguyễn Huệ', 'Hàm Nghi', 'Pasteur', 'Lý Tự Trọng', 'Bến Chương Dương', 'Calmette',
+          'Nguyễn Thái Học', 'Trần Hưng Đạo', 'Cô Giang', 'Đề Thám', 'Bùi Viện', 'Phạm Ngũ Lão', 'Cống Quỳnh']
+_GB = (['11', '21', '31', '51', '52', '58', '68'], [0.55, 0.1, 0.08, 0.12, 0.07, 0.04, 0.04])
+_GIA_NUOC = {'11': 6700, '21': 12900, '31': 14400, '51': 8600, '52': 20400, '58': 17500, '68': 11000}
+_HIEU = ['ASAHI', 'KENT', 'ZENNER', 'ACTARIS', 'SENSUS', 'ITRON']
+_CO = ([15, 20, 25, 50], [0.85, 0.08, 0.05, 0.02])
+_CODE_MOI = (['40', '41', 'K', 'N', '66', 'K2', 'F1'], [0.85, 0.05, 0.03, 0.02, 0.02, 0.01, 0.02])
+_NV_GIAI = ([f'NV{i:02d}' for i in range(1, 13)] + ['NKD'], [0.98 / 12] * 12 + [0.02])
+# Mã sổ bảng kê theo ngân hàng (khớp với Config.PATTERN/BANK_DICT trong analysis_logic)
+_SOBK_PREFIX = ['A', 'Ai', 'B', 'BP', 'D', 'E', 'K', 'M', 'OC', 'P', 'Pv', 'Q', 'V', 'VC', 'VT', 'Vn', 'Z']
+_NGAN_HANG = ['VCB', 'BIDV', 'AGRIBANK', 'VIETTIN', 'MOMO', 'ZALOPAY', 'PAYOO', 'VNPAY']
+
+_CHUNK_ROWS = 200_000  # Số hoá đơn sinh và ghi mỗi khối
+
+
+def _periods(as_of, years):
+    """Danh sách (năm, kỳ) từ tháng 1 của năm (as_of.year - years + 1) đến kỳ của as_of."""
+    return [(y, m) for y in range(as_of.year - years + 1, as_of.year + 1) for m in range(1, 13)
+            if (y, m) <= (as_of.year, as_of.month)]
+
+
+def _pick(rng, choices, size):
+    values, weights = choices
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=size, p=weights)]
+
+
+def _date_text(days, seconds=None):
+    """Mảng datetime64[D] (+ giây) -> chuỗi 'YYYY-MM-DD HH:MM:SS' như SQL Server trả về khi CAST sang chuỗi."""
+    stamps = days.astype('datetime64[s]')
+    if stamps.size == 0:
+        return np.empty(0, dtype=object)
+    if seconds is not None:
+        stamps = stamps + seconds.astype('timedelta64[s]')
+    return np.char.replace(np.datetime_as_string(stamps, unit='s'), 'T', ' ').astype(object)
+
+
+def _with_nulls(values, null_mask):
+    values = values.astype(object)
+    values[null_mask] = None
+    return values
+
+
+def _insert(conn, table, columns):
+    names = [name for name, _ in SCHEMA[table]]
+    placeholders = ', '.join('?' * len(names))
+    rows = zip(*(columns[name].tolist() if name in columns else [None] * len(next(iter(columns.values())))
+                 for name in names))
+    conn.executemany(f'INSERT INTO {table} ({", ".join(names)}) VALUES ({placeholders})', rows)
+
+
+def _customers(rng, start, count):
+    """Thuộc tính cố định của từng khách hàng trong khối [start, start + count)."""
+    idx = np.arange(start, start + count)
+    dot = rng.integers(1, 21, size=count)
+    may = rng.integers(1, 5, size=count) * 10 + rng.integers(1, 9, size=count)
+    so = rng.integers(1, 500, size=count).astype(str).astype(object)
+    has_hem = rng.random(count) < 0.3
+    so[has_hem] = so[has_hem] + '/' + rng.integers(1, 60, size=int(has_hem.sum())).astype(str)
+    gb = _pick(rng, _GB, count)
+    return {
+        'idx': idx,
+        'danhba': np.char.zfill((2_000_000_000 + idx * 7).astype(str), 11).astype(object),
+        'mlt2': np.char.add(np.char.add(np.char.zfill(dot.astype(str), 2), np.char.zfill(may.astype(str), 2)),
+                            np.char.zfill((idx % 1000).astype(str), 3)).astype(object),
+        'dot': dot, 'may': may, 'gb': gb, 'so': so,
+        'tenkh': (np.asarray(_HO, dtype=object)[rng.integers(0, len(_HO), size=count)] + ' '
+                  + np.asarray(_TEN, dtype=object)[rng.integers(0, len(_TEN), size=count)]),
+        'duong': np.asarray(_DUONG, dtype=object)[rng.integers(0, len(_DUONG), size=count)],
+        'sothan': np.char.add('TH', rng.integers(10 ** 7, 10 ** 8, size=count).astype(str)).astype(object),
+        'hieu': np.asarray(_HIEU, dtype=object)[rng.integers(0, len(_HIEU), size=count)],
+        'co': _pick(rng, _CO, count).astype(np.int64),
+        'hopbaove': _with_nulls(rng.integers(0, 2, size=count), rng.random(count) < 0.15),
+        'sdt': _with_nulls(np.char.add('09', rng.integers(10 ** 7, 10 ** 8, size=count).astype(str)),
+                           rng.random(count) < 0.3),
+        'price': np.array([_GIA_NUOC[g] for g in gb], dtype=np.float64),
+        'base_m3': np.maximum(1.0, rng.lognormal(mean=2.9, sigma=0.6, size=count)),
+        # Số kỳ nợ dồn cuối cùng: phần lớn không nợ, một số khách nợ kéo dài nhiều kỳ
+        'chronic': np.where(rng.random(count) < 0.12, np.minimum(rng.geometric(0.35, size=count), 24), 0),
+    }
+
+
+def _build_chunk(conn, rng, cust, periods, as_of, docso_months, bgw_rate, unc_rate):
+    n_cust, n_per = len(cust['idx']), len(periods)
+    nam = np.array([p[0] for p in periods])
+    ky = np.array([p[1] for p in periods])
+
+    # Tiêu thụ theo kỳ (m3) và chỉ số đồng hồ luỹ kế, dùng chung cho DocSo và tiền hoá đơn
+    m3 = np.maximum(0, np.rint(cust['base_m3'][:, None] * rng.gamma(8.0, 1 / 8.0, size=(n_cust, n_per)))).astype(np.int64)
+    m3[rng.random((n_cust, n_per)) < 0.03] = 0
+    chi_so = rng.integers(0, 5000, size=n_cust)[:, None] + np.cumsum(m3, axis=1)
+    tien_nuoc = m3 * cust['price'][:, None]
+    tong_tien = np.rint(tien_nuoc * 1.15)
+
+    rows = n_cust * n_per
+    c = np.repeat(np.arange(n_cust), n_per)
+    pos = np.tile(np.arange(n_per), n_cust)
+    nam_r, ky_r = nam[pos], ky[pos]
+    period_start = (np.array([f'{y:04d}-{m:02d}' for y, m in periods], dtype='datetime64[M]')
+                    .astype('datetime64[D]'))[pos]
+    ngay_nhan = period_start + np.minimum(cust['dot'][c], 28).astype('timedelta64[D]')
+
+    tongcong_bd = tong_tien.ravel()
+    tongcong = tongcong_bd.copy()
+    adjusted = rng.random(rows) < 0.03
+    tongcong[adjusted] = np.rint(tongcong[adjusted] * rng.uniform(0.8, 1.0, size=int(adjusted.sum())))
+
+    unpaid = pos >= n_per - cust['chronic'][c]
+    unpaid |= (pos == n_per - 1) & (rng.random(rows) < 0.2)
+    unpaid |= (pos == n_per - 2) & (rng.random(rows) < 0.05)
+    as_of_day = np.datetime64(as_of.isoformat(), 'D')
+    ngay_giai_day = np.minimum(ngay_nhan + rng.integers(1, 45, size=rows).astype('timedelta64[D]'), as_of_day)
+    ngay_giai = _with_nulls(_date_text(ngay_giai_day, rng.integers(7 * 3600, 18 * 3600, size=rows)), unpaid)
+    sohoadon = ((nam_r % 100) * 10 ** 9 + ky_r * 10 ** 7 + cust['idx'][c]).astype(str).astype(object)
+
+    _insert(conn, 'HoaDon', {
+        'DANHBA': cust['danhba'][c], 'SOHOADON': sohoadon, 'NAM': nam_r, 'KY': ky_r, 'DOT': cust['dot'][c],
+        'GB': cust['gb'][c], 'TENKH': cust['tenkh'][c], 'SO': cust['so'][c], 'DUONG': cust['duong'][c],
+        'TONGCONG_BD': tongcong_bd, 'TONGCONG': tongcong, 'Ngay_NhanHD': _date_text(ngay_nhan),
+        'NGAYGIAI': ngay_giai, 'NV_GIAI': _with_nulls(_pick(rng, _NV_GIAI, rows), unpaid),
+    })
+
+    # BGW_HD: một phần hoá đơn chưa giải đã được thanh toán qua cổng ngân hàng nhưng chưa gạch nợ
+    bgw = np.flatnonzero(unpaid & (rng.random(rows) < bgw_rate))
+    _insert(conn, 'BGW_HD', {
+        'SHDon': sohoadon[bgw], 'DanhBa': cust['danhba'][c[bgw]], 'SoTien': tongcong[bgw],
+        'NgayThanhToan': _date_text(as_of_day - rng.integers(0, 10, size=len(bgw)).astype('timedelta64[D]'),
+                                    rng.integers(0, 24 * 3600, size=len(bgw))),
+        'NganHang': np.asarray(_NGAN_HANG, dtype=object)[rng.integers(0, len(_NGAN_HANG), size=len(bgw))],
+    })
+
+    # ThuUNC: một phần hoá đơn đã giải được thu qua uỷ nhiệm chi
+    unc = np.flatnonzero(~unpaid & (rng.random(rows) < unc_rate))
+    total = tongcong[unc]
+    giaban, thue, phi = np.rint(total * 0.8), np.rint(total * 0.04), np.rint(total * 0.1)
+    _insert(conn, 'ThuUNC', {
+        'SoBK': np.char.add(np.asarray(_SOBK_PREFIX)[rng.integers(0, len(_SOBK_PREFIX), size=len(unc))],
+                            rng.integers(10 ** 5, 10 ** 6, size=len(unc)).astype(str)).astype(object),
+        'SHDon': sohoadon[unc], 'DanhBa': cust['danhba'][c[unc]], 'NgayThu': ngay_giai[unc],
+        'Giaban': giaban, 'Thue': thue, 'Phi': phi, 'ThueDVTN': total - giaban - thue - phi,
+    })
+
+    # DocSo: chỉ số đọc của docso_months kỳ gần nhất
+    keep = pos >= n_per - docso_months
+    d = c[keep]
+    d_pos = pos[keep]
+    n_doc = len(d)
+    tieu_thu = m3[d, d_pos]
+    tien = tien_nuoc[d, d_pos]
+    _insert(conn, 'DocSo', {
+        'DanhBa': cust['danhba'][d], 'MLT2': cust['mlt2'][d], 'SoNhaCu': cust['so'][d], 'SoNhaMoi': cust['so'][d],
+        'Duong': cust['duong'][d], 'SDT': cust['sdt'][d], 'GB': cust['gb'][d],
+        'DM': np.where(cust['gb'][d] == '11', 16, 0), 'Nam': nam_r[keep], 'Ky': ky_r[keep], 'Dot': cust['dot'][d],
+        'May': cust['may'][d], 'TBTT': np.rint(cust['base_m3'][d]).astype(np.int64),
+        'CSCu': chi_so[d, d_pos] - tieu_thu, 'CSMoi': chi_so[d, d_pos], 'CodeMoi': _pick(rng, _CODE_MOI, n_doc),
+        'TieuThuCu': m3[d, np.maximum(d_pos - 1, 0)], 'TieuThuMoi': tieu_thu,
+        'TuNgay': _date_text(period_start[keep] - np.timedelta64(30, 'D')), 'DenNgay': _date_text(period_start[keep]),
+        'TienNuoc': tien, 'BVMT': np.rint(tien * 0.1), 'Thue': np.rint(tien * 0.05),
+        'TongTien': tong_tien[d, d_pos], 'SoThanCu': cust['sothan'][d], 'HieuCu': cust['hieu'][d],
+        'CoCu': cust['co'][d], 'ViTriCu': np.full(n_doc, 'LỀ', dtype=object),
+        'NVGHI': np.char.add('G', cust['may'][d].astype(str)).astype(object), 'MayTheoMLT': cust['may'][d],
+    })
+    return rows, len(bgw), len(unc), n_doc
+
+
+def generate_database(path, customers=20_000, years=3, seed=20240101, as_of=None, docso_months=24,
+                      bgw_rate=0.12, unc_rate=0.25):
+    """
+    Tạo (ghi đè) tệp SQLite tại `path` với dữ liệu giả lập. Trả về số dòng của từng bảng.
+    Số hoá đơn = customers x số kỳ từ tháng 1 năm (as_of.year - years + 1) đến kỳ của as_of.
+    """
+    as_of = as_of or date.today()
+    periods = _periods(as_of, years)
+    docso_months = min(docso_months, len(periods))
+    if os.path.exists(path):
+        os.remove(path)
+    start_time = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        for table, columns in SCHEMA.items():
+            conn.execute(f'CREATE TABLE {table} ({", ".join(f"{name} {kind}" for name, kind in columns)})')
+
+        counts = dict.fromkeys(SCHEMA, 0)
+        chunk_customers = max(1, _CHUNK_ROWS // len(periods))
+        for start in range(0, customers, chunk_customers):
+            cust = _customers(rng, start, min(chunk_customers, customers - start))
+            _insert(conn, 'KhachHang', {
+                'DanhBa': cust['danhba'], 'MLT2': cust['mlt2'], 'GB': cust['gb'], 'Dot': cust['dot'],
+                'May': cust['may'], 'SoMoi': cust['so'], 'Duong': cust['duong'], 'SoThan': cust['sothan'],
+                'Hieu': cust['hieu'], 'Co': cust['co'], 'HopBaoVe': cust['hopbaove'], 'SDT': cust['sdt'],
+            })
+            hoadon, bgw, unc, docso = _build_chunk(conn, rng, cust, periods, as_of, docso_months, bgw_rate, unc_rate)
+            counts['KhachHang'] += len(cust['idx'])
+            counts['HoaDon'] += hoadon
+            counts['BGW_HD'] += bgw
+            counts['ThuUNC'] += unc
+            counts['DocSo'] += docso
+            conn.commit()
+            logging.info(f"Đã sinh {counts['KhachHang']:,}/{customers:,} khách hàng, {counts['HoaDon']:,} hoá đơn.")
+
+        for table, columns in INDEXES:
+            conn.execute(f'CREATE INDEX ix_{table}_{columns.replace(", ", "_")} ON {table} ({columns})')
+        params = {'customers': customers, 'years': years, 'seed': seed, 'as_of': as_of.isoformat(),
+                  'docso_months': docso_months, 'bgw_rate': bgw_rate, 'unc_rate': unc_rate, 'counts': counts}
+        conn.execute('CREATE TABLE _synthetic_meta (params TEXT)')
+        conn.execute('INSERT INTO _synthetic_meta VALUES (?)', (json.dumps(params),))
+        conn.commit()
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+    logging.info(f"✅ Sinh dữ liệu giả lập {counts} trong {time.perf_counter() - start_time:.1f} giây: {path}")
+    return counts
+
+
+def read_params(path):
+    """Tham số đã dùng để sinh tệp `path`, None nếu tệp không tồn tại hoặc không phải dữ liệu giả lập."""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return json.loads(conn.execute('SELECT params FROM _synthetic_meta').fetchone()[0])
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sinh dữ liệu giả lập HoaDon/DocSo/KhachHang/BGW_HD/ThuUNC.')
+    parser.add_argument('--db', default='stub_data.db', help='Tệp SQLite đầu ra (bị ghi đè)')
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--customers', type=int, default=20_000, help='Số khách hàng')
+    size.add_argument('--invoices', type=int, help='Số hoá đơn mong muốn (tính ra số khách hàng)')
+    parser.add_argument('--years', type=int, default=3, help='Số năm dữ liệu hoá đơn')
+    parser.add_argument('--docso-months', type=int, default=24, help='Số kỳ gần nhất có dữ liệu DocSo')
+    parser.add_argument('--seed', type=int, default=20240101)
+    parser.add_argument('--as-of', type=date.fromisoformat, default=None,
+                        help='Ngày "hiện tại" của dữ liệu (YYYY-MM-DD), mặc định là hôm nay')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    as_of = args.as_of or date.today()
+    customers = args.customers
+    if args.invoices:
+        customers = max(1, -(-args.invoices // len(_periods(as_of, args.years))))
+    generate_database(args.db, customers=customers, years=args.years, seed=args.seed, as_of=as_of,
+                      docso_months=args.docso_months)
+
+
+if __name__ == '__main__':
+    main()